@@ -0,0 +1,185 @@
+"""
+Synthetic geonames.org data generator.
+
+Writes schema-correct stand-ins for the files the downloader fetches, so
+the importer and the lookups can be benchmarked at any size without
+network access::
+
+    countryInfo.txt  timeZones.txt  iso-languagecodes.txt
+    admin1CodesASCII.txt  admin2Codes.txt
+    geonames_<CC>.zip  zipcodes_<CC>.zip  alternateNamesV2.zip
+
+The output is deterministic for a given seed. Rows are streamed into the
+zip members, so allCountries scale (``--countries 250 --places 50000``,
+about 12.5M places) only needs disk space, not memory.
+
+    python benchmarks/generate.py /tmp/geonames --countries 20 --places 5000
+"""
+import argparse
+import io
+import random
+import string
+import zipfile
+from pathlib import Path
+
+CONTINENTS = ['AF', 'AS', 'EU', 'NA', 'OC', 'SA', 'AN']
+LANGUAGES = [('eng', 'eng', 'en', 'English'), ('fra', 'fre', 'fr', 'French'), ('deu', 'ger', 'de', 'German'),
+             ('spa', 'spa', 'es', 'Spanish'), ('rus', 'rus', 'ru', 'Russian'), ('zho', 'chi', 'zh', 'Chinese'),
+             ('ara', 'ara', 'ar', 'Arabic'), ('hin', 'hin', 'hi', 'Hindi'), ('por', 'por', 'pt', 'Portuguese'),
+             ('jpn', 'jpn', 'ja', 'Japanese')]
+FEATURES = [('P', 'PPL', 70), ('P', 'PPLA', 3), ('P', 'PPLX', 7), ('A', 'ADM2', 5), ('H', 'STM', 6),
+            ('T', 'MT', 5), ('S', 'SCH', 2), ('L', 'PRK', 2)]
+SYLLABLES = ['ka', 'lo', 'mar', 'ten', 'shi', 'ber', 'go', 'vil', 'ston', 'ra', 'du', 'ne', 'ham', 'por',
+             'to', 'li', 'san', 'an', 'el', 'burg', 'field', 'ville', 'mo', 'ri', 'za']
+
+COUNTRY_ID_BASE = 9000000
+PLACE_ID_BASE = 10000000
+
+
+class Generator(object):
+
+    def __init__(self, destination, countries=10, places=1000, altnames=2, zipcodes=200, admin1=10, admin2=5,
+                 seed=1):
+        self.destination = Path(destination)
+        self.random = random.Random(seed)
+        self.places = places
+        self.altnames = altnames
+        self.zipcodes = zipcodes
+        self.admin1 = admin1
+        self.admin2 = admin2
+        codes = [a + b for a in string.ascii_uppercase for b in string.ascii_uppercase]
+        self.countries = codes[:countries]
+
+    def name(self, parts=None):
+        parts = parts or self.random.randint(2, 4)
+        return ''.join(self.random.choice(SYLLABLES) for i in range(parts)).capitalize()
+
+    def country_id(self, idx):
+        return COUNTRY_ID_BASE + idx
+
+    def place_id(self, country, idx):
+        return PLACE_ID_BASE + country * self.places + idx
+
+    def write_text(self, fname, lines):
+        with open(str(self.destination / fname), 'w', encoding='utf-8', newline='\n') as f:
+            for line in lines:
+                f.write(line + '\n')
+
+    def write_zip(self, fname, member, lines):
+        with zipfile.ZipFile(str(self.destination / fname), 'w', zipfile.ZIP_DEFLATED) as archive:
+            with archive.open(member, 'w', force_zip64=True) as raw:
+                with io.TextIOWrapper(raw, encoding='utf-8', newline='\n') as f:
+                    for line in lines:
+                        f.write(line + '\n')
+            archive.writestr('readme.txt', 'Synthetic data generated by benchmarks/generate.py\n')
+
+    def country_info(self):
+        yield '#ISO\tISO3\tISO-Numeric\tfips\tCountry\tCapital\tArea(in sq km)\tPopulation\tContinent\ttld\t' \
+              'CurrencyCode\tCurrencyName\tPhone\tPostal Code Format\tPostal Code Regex\tLanguages\tgeonameid\t' \
+              'neighbours\tEquivalentFipsCode'
+        for idx, code in enumerate(self.countries):
+            languages = ','.join(lang[2] for lang in self.random.sample(LANGUAGES, 2))
+            neighbours = ','.join(self.random.sample(self.countries, min(3, len(self.countries))))
+            yield '\t'.join([code, code + 'X', str(idx + 1), code, self.name(3) + 'ia', self.name(2),
+                             str(self.random.randint(1000, 9000000)), str(self.random.randint(10000, 200000000)),
+                             self.random.choice(CONTINENTS), '.' + code.lower(), code + 'D', 'Dollar',
+                             str(idx + 1), '#####', r'^(\d{5})$', languages, str(self.country_id(idx)),
+                             neighbours, ''])
+
+    def timezones(self):
+        yield 'CountryCode\tTimeZoneId\tGMT offset 1. Jan 2020\tDST offset 1. Jul 2020\trawOffset (independant of DST)'
+        for idx, code in enumerate(self.countries):
+            offset = float(idx % 25 - 12)
+            yield '\t'.join([code, self.zone(idx), str(offset), str(offset + 1), str(offset)])
+
+    def zone(self, idx):
+        return 'Synthetic/Zone%03d' % idx
+
+    def languages(self):
+        yield 'ISO 639-3\tISO 639-2\tISO 639-1\tLanguage Name'
+        for lang in LANGUAGES:
+            yield '\t'.join(lang)
+
+    def admin_codes(self, level):
+        for idx, code in enumerate(self.countries):
+            for a1 in range(1, self.admin1 + 1):
+                if level == 1:
+                    yield '\t'.join(['%s.%02d' % (code, a1), self.name(), self.name(), str(self.place_id(idx, a1))])
+                    continue
+                for a2 in range(1, self.admin2 + 1):
+                    yield '\t'.join(['%s.%02d.%03d' % (code, a1, a2), self.name(), self.name(),
+                                     str(self.place_id(idx, a1 * 100 + a2))])
+
+    def geonames(self, idx, code):
+        lat0, lon0 = self.random.uniform(-60, 60), self.random.uniform(-170, 170)
+        features = [(fclass, fcode) for fclass, fcode, weight in FEATURES for i in range(weight)]
+        yield '\t'.join([str(self.country_id(idx)), self.name(3) + 'ia', '', '', '%.5f' % lat0, '%.5f' % lon0,
+                         'A', 'PCLI', code, '', '00', '', '', '', str(self.random.randint(10000, 200000000)),
+                         '', '100', self.zone(idx), '2020-04-20'])
+        for place in range(self.places):
+            name = self.name()
+            fclass, fcode = self.random.choice(features)
+            population = int(self.random.paretovariate(1.2) * 200) if fclass == 'P' else 0
+            yield '\t'.join([str(self.place_id(idx, place)), name, name, '',
+                             '%.5f' % (lat0 + self.random.uniform(-5, 5)), '%.5f' % (lon0 + self.random.uniform(-5, 5)),
+                             fclass, fcode, code, '', '%02d' % self.random.randint(1, self.admin1),
+                             '%03d' % self.random.randint(1, self.admin2), '', '', str(population),
+                             '', str(self.random.randint(0, 3000)), self.zone(idx), '2020-04-20'])
+
+    def zipcode_rows(self, idx, code):
+        for i in range(self.zipcodes):
+            a1 = self.random.randint(1, self.admin1)
+            yield '\t'.join([code, '%05d' % (idx * self.zipcodes + i), self.name(), self.name(), '%02d' % a1,
+                             self.name(), '%03d' % self.random.randint(1, self.admin2), '', '',
+                             '%.4f' % self.random.uniform(-60, 60), '%.4f' % self.random.uniform(-170, 170), '4'])
+
+    def alternate_names(self):
+        altid = 1
+        for idx, code in enumerate(self.countries):
+            ids = [self.country_id(idx)] + [self.place_id(idx, place) for place in range(self.places)]
+            for geoid in ids:
+                for lang in self.random.sample(LANGUAGES, min(self.altnames, len(LANGUAGES))):
+                    preferred = '1' if self.random.random() < 0.3 else ''
+                    short = '1' if self.random.random() < 0.1 else ''
+                    yield '\t'.join([str(altid), str(geoid), lang[2], self.name(), preferred, short, '', '', '', ''])
+                    altid += 1
+            # Links, which the importer is expected to skip
+            yield '\t'.join([str(altid), str(self.country_id(idx)), 'link',
+                             'https://en.wikipedia.org/wiki/' + code, '', '', '', '', '', ''])
+            altid += 1
+
+    def generate(self):
+        '''
+        Writes all the files and returns their paths
+        '''
+        self.destination.mkdir(parents=True, exist_ok=True)
+        self.write_text('countryInfo.txt', self.country_info())
+        self.write_text('timeZones.txt', self.timezones())
+        self.write_text('iso-languagecodes.txt', self.languages())
+        self.write_text('admin1CodesASCII.txt', self.admin_codes(1))
+        self.write_text('admin2Codes.txt', self.admin_codes(2))
+        for idx, code in enumerate(self.countries):
+            self.write_zip('geonames_%s.zip' % code, code + '.txt', self.geonames(idx, code))
+            self.write_zip('zipcodes_%s.zip' % code, code + '.txt', self.zipcode_rows(idx, code))
+        self.write_zip('alternateNamesV2.zip', 'alternateNamesV2.txt', self.alternate_names())
+        return sorted(self.destination.iterdir())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('destination')
+    parser.add_argument('--countries', type=int, default=10)
+    parser.add_argument('--places', type=int, default=1000, help='Places per country')
+    parser.add_argument('--altnames', type=int, default=2, help='Alternate names per place')
+    parser.add_argument('--zipcodes', type=int, default=200, help='Zipcodes per country')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    files = Generator(args.destination, args.countries, args.places, args.altnames, args.zipcodes,
+                      seed=args.seed).generate()
+    for path in files:
+        print('%10d  %s' % (path.stat().st_size, path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Load test for ``pynations serve``.
+
+Fires requests at a running server from a number of client threads over
+keep-alive connections and reports throughput and latency percentiles
+per endpoint.
+
+    pynations serve --port 8080 &
+    python benchmarks/loadtest.py --url http://127.0.0.1:8080 --threads 8 --requests 2000
+
+The keys default to real names, which miss on the synthetic data of
+``run.py --keep``. ``--sample`` draws them from the database served instead.
+"""
+import argparse
+import http.client
+import json
+import random
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+from urllib.parse import urlsplit
+
+COUNTRIES = ['us', 'usa', 'germany', 'deutschland', 'india', 'uk', 'france', 'japan', 'brasil', 'nowhere']
+PLACES = ['London', 'Springfield', 'Berlin', 'Paris', 'San Francisco', 'Munich']
+POSTCODES = [('94103', 'US'), ('10115', 'DE'), ('62701', None), ('SW1A', 'GB')]
+
+
+def sample_keys(dbfile, count=50):
+    """
+    Replaces the keys with names and postcodes drawn from dbfile. One
+    unknown country is kept so that misses are measured too
+    """
+    global COUNTRIES, PLACES, POSTCODES
+    conn = sqlite3.connect(f'file:{dbfile}?mode=ro', uri=True)
+    COUNTRIES = [row[0].lower() for row in conn.execute('select name from countryinfo order by random() limit ?;',
+                                                         (count,))] + ['nowhere']
+    PLACES = [row[0] for row in conn.execute("select name from geonames where feature_class = 'P' "
+                                             'order by random() limit ?;', (count,))]
+    POSTCODES = [(code, country if i % 2 else None) for i, (code, country) in
+                 enumerate(conn.execute('select zipcode, country from zipcodes order by random() limit ?;', (count,)))]
+    conn.close()
+
+
+def requests_for(kind):
+    if kind == 'country':
+        return 'GET', '/country/' + quote(random.choice(COUNTRIES)), None
+    if kind == 'places':
+        return 'GET', '/places?name=' + quote(random.choice(PLACES)), None
+    if kind == 'postcode':
+        code, country = random.choice(POSTCODES)
+        return 'GET', '/postcode/' + code + ('?country=' + country if country else ''), None
+    body = {'countries': random.sample(COUNTRIES, 5),
+            'postcodes': [[code, country] for code, country in random.sample(POSTCODES, min(4, len(POSTCODES)))],
+            'places': random.sample(PLACES, 2)}
+    return 'POST', '/batch', json.dumps(body)
+
+
+def worker(url, kinds, count, results):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+    for i in range(count):
+        kind = random.choice(kinds)
+        method, path, body = requests_for(kind)
+        headers = {'Accept-Encoding': 'gzip', 'Content-Type': 'application/json'}
+        start = time.perf_counter()
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        results.append((kind, time.perf_counter() - start, response.status))
+    conn.close()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per thread')
+    parser.add_argument('--endpoints', default='country,places,postcode,batch')
+    parser.add_argument('--sample', metavar='DBFILE', help='Draw the keys from this database')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.sample:
+        sample_keys(args.sample)
+
+    kinds = args.endpoints.split(',')
+    results = []
+    threads = [threading.Thread(target=worker, args=(args.url, kinds, args.requests, results))
+               for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    print(f'{len(results)} requests in {elapsed:.2f}s, {len(results) / elapsed:.0f} req/s, '
+          f'{args.threads} client threads')
+    print(f"{'endpoint':10} {'count':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for kind in kinds + ['all']:
+        latencies = [latency * 1000 for k, latency, status in results if kind in ('all', k)]
+        errors = sum(1 for k, latency, status in results if kind in ('all', k) and status >= 500)
+        if latencies:
+            print(f'{kind:10} {len(latencies):8} {percentile(latencies, 50):8.2f} '
+                  f'{percentile(latencies, 90):8.2f} {percentile(latencies, 99):8.2f} {errors:7}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Benchmark runner.
+
+Generates a synthetic data set (see ``generate.py``), copies the package to
+a scratch directory so the real database is never touched, and times:
+
+* every ``setupdb()`` loader, with rows/s for the table it fills
+* ``build_CountryInfo``
+* cold (fresh interpreter) and warm ``CountryInfo`` construction
+* batch lookups: ``localized_names``, ``lookup_postcodes`` and ``resolve``
+
+The median of ``--repeat`` runs is compared with a stored baseline; steps
+slower than the baseline by more than ``--tolerance`` (and ``NOISE`` seconds)
+are reported and make the run exit with 1. ``baseline.json`` holds the
+results for the default parameters and the machine they were recorded on.
+
+    python benchmarks/run.py --countries 10 --places 2000          # compare
+    python benchmarks/run.py --countries 10 --places 2000 --save   # new baseline
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from generate import Generator
+
+HERE = Path(__file__).resolve().parent
+SOURCE = HERE.parent / 'src' / 'pynations'
+BASELINE = HERE / 'baseline.json'
+# Slowdowns smaller than this are scheduler noise on steps of a few hundred ms
+NOISE = 0.05
+
+
+def run_steps(workdir, *args):
+    env = dict(os.environ, PYTHONPATH=str(workdir))
+    output = subprocess.run([sys.executable, str(HERE / 'steps.py')] + list(args), cwd=str(workdir), env=env,
+                            stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    return [json.loads(line) for line in output.splitlines() if line.startswith('{"name"')]
+
+
+def benchmark(args):
+    workdir = Path(tempfile.mkdtemp(prefix='pynations-bench-'))
+    try:
+        package = workdir / 'pynations'
+        shutil.copytree(str(SOURCE), str(package), ignore=shutil.ignore_patterns(
+            '__pycache__', '*.sqlite', 'countryinfo.json', 'countrylookup.json', 'columnar', 'reversegeo_*'))
+        data = package / 'data' / 'geonamesdata'
+        Generator(data, args.countries, args.places, args.altnames, args.zipcodes, seed=args.seed).generate()
+
+        results = run_steps(workdir, 'import')
+        # Best of three fresh interpreters, the first one also warms the page cache
+        cold = [run_steps(workdir, 'cold', 'xx')[0] for i in range(3)]
+        results += [min(cold, key=lambda result: result['seconds'])]
+        results += run_steps(workdir, 'lookups', str(args.lookups))
+    finally:
+        if args.keep:
+            print(f'Scratch directory kept at {workdir}')
+        else:
+            shutil.rmtree(str(workdir), ignore_errors=True)
+    return results
+
+
+def median_results(runs):
+    """
+    Merges repeated runs into one result per step with the median time
+    """
+    return [dict(result, seconds=statistics.median(run[i]['seconds'] for run in runs))
+            for i, result in enumerate(runs[0])]
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"{'step':28} {'seconds':>10} {'baseline':>10} {'rows/s':>12} {'change':>10}")
+    for result in results:
+        seconds, rows = result['seconds'], result['rows']
+        rate = f'{rows / seconds:12.0f}' if rows and seconds else f"{'-':>12}"
+        base = baseline.get(result['name'])
+        if base:
+            change = seconds / base['seconds'] - 1 if base['seconds'] else 0
+            regressed = change > tolerance and seconds - base['seconds'] > NOISE
+            if regressed or (base.get('rows') and rows != base['rows']):
+                regressions.append(result['name'])
+            print(f"{result['name']:28} {seconds:10.4f} {base['seconds']:10.4f} {rate} {change * 100:+9.1f}%"
+                  f"{' <--' if regressed else ''}")
+        else:
+            print(f"{result['name']:28} {seconds:10.4f} {'-':>10} {rate} {'-':>10}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--countries', type=int, default=10)
+    parser.add_argument('--places', type=int, default=2000, help='Places per country')
+    parser.add_argument('--altnames', type=int, default=2, help='Alternate names per place')
+    parser.add_argument('--zipcodes', type=int, default=200, help='Zipcodes per country')
+    parser.add_argument('--lookups', type=int, default=10000, help='Keys per batch lookup step')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs to take the median of (default: %(default)s)')
+    parser.add_argument('--baseline', default=str(BASELINE), help='Baseline file (default: %(default)s)')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown (default: %(default)s)')
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch directory')
+    args = parser.parse_args()
+
+    results = median_results([benchmark(args) for i in range(args.repeat)])
+
+    baseline = {}
+    if Path(args.baseline).exists():
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored['params'] == params(args):
+            baseline = {result['name']: result for result in stored['results']}
+        else:
+            print(f"Baseline was recorded with {stored['params']}, not comparing")
+        if baseline and stored.get('environment') != environment():
+            print(f"Baseline was recorded on {stored.get('environment')}, timings may not be comparable")
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'params': params(args), 'environment': environment(), 'results': results}, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def params(args):
+    return {key: getattr(args, key) for key in ('countries', 'places', 'altnames', 'zipcodes', 'lookups', 'seed')}
+
+
+def environment():
+    return {'machine': platform.machine(), 'processor': platform.processor() or platform.machine(),
+            'cpus': os.cpu_count(), 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version}
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+Benchmark steps, run by ``benchmarks/run.py`` inside an isolated copy of
+the package whose data directory holds the synthetic files. Prints one JSON
+object per step on stdout: name, seconds and rows processed where that
+applies.
+"""
+import json
+import random
+import sqlite3
+import sys
+import time
+
+
+def emit(name, seconds, rows=None):
+    print(json.dumps({'name': name, 'seconds': seconds, 'rows': rows}))
+    sys.stdout.flush()
+
+
+def count(conn, table):
+    try:
+        return conn.execute('select count(*) from %s;' % table).fetchone()[0]
+    except sqlite3.Error:
+        return None
+
+
+def timed(name, func, conn=None, table=None):
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    emit(name, seconds, count(conn, table) if table else None)
+    return result
+
+
+def import_steps():
+    start = time.perf_counter()
+    from pynations import geosqlite
+    geosqlite.connect()
+    emit('setupdb.schema', time.perf_counter() - start)
+
+    conn = sqlite3.connect(str(geosqlite.DBFILE))
+    timed('setupdb.countryinfo', geosqlite.load_countryinfo, conn, 'countryinfo')
+    timed('setupdb.timezones', geosqlite.load_timezones, conn, 'timezones')
+    timed('setupdb.languages', geosqlite.load_languages, conn, 'languages')
+    timed('setupdb.admincodes', geosqlite.load_admincodes, conn, 'admincodes')
+    timed('setupdb.geonames', lambda: geosqlite.load_geodata('geonames'), conn, 'geonames')
+    timed('setupdb.zipcodes', lambda: geosqlite.load_geodata('zipcodes'), conn, 'zipcodes')
+    timed('setupdb.altnames', lambda: geosqlite.load_all_geodata('alternateNamesV2.zip'), conn, 'altnames')
+    timed('setupdb.preferrednames', geosqlite.build_preferrednames, conn, 'preferrednames')
+
+    from pynations import CountryInfo
+    timed('build_CountryInfo', CountryInfo.build_CountryInfo)
+
+
+def lookup_steps(lookups):
+    from pynations import places
+    from pynations.CountryInfo import CountryInfo
+    from pynations.CountryInfo import load_json
+    from pynations.CountryInfo import COUNTRYLOOKUPFILE
+
+    rand = random.Random(1)
+    names = list(load_json(COUNTRYLOOKUPFILE))
+    timed('CountryInfo.warm', lambda: [CountryInfo(rand.choice(names)) for i in range(lookups)])
+
+    conn = places.connection()
+    ids = [row[0] for row in conn.execute('select geonameid from geonames;')]
+    ids = [rand.choice(ids) for i in range(lookups)] if ids else []
+    timed('places.localized_names', lambda: places.localized_names(ids, 'fr'))
+
+    codes = [row[0] for row in conn.execute('select zipcode from zipcodes;')]
+    keys = [(rand.choice(codes), None) for i in range(lookups)] if codes else []
+    timed('places.lookup_postcodes', lambda: places.lookup_postcodes(keys))
+
+    import io
+    from pynations.resolve import resolve_stream
+    infile = io.StringIO('name\n' + '\n'.join(rand.choice(names) for i in range(lookups)) + '\n')
+    timed('resolve.country', lambda: resolve_stream(infile, io.StringIO(), 'country', 'name'))
+
+
+def cold_step(name):
+    start = time.perf_counter()
+    from pynations.CountryInfo import CountryInfo
+    CountryInfo(name)
+    emit('CountryInfo.cold', time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'import':
+        import_steps()
+    elif sys.argv[1] == 'lookups':
+        lookup_steps(int(sys.argv[2]))
+    else:
+        cold_step(sys.argv[2])
@@ -79,6 +79,8 @@ setup(
         # eg:
         #   'rst': ['docutils>=0.11'],
         #   ':python_version=="2.6"': ['argparse'],
+        'numpy': ['numpy>=1.16'],
+        'geocoding': ['numpy>=1.16', 'scipy>=1.1'],
     },
     entry_points={
         'console_scripts': [
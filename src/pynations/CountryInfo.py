@@ -1,11 +1,16 @@
+from contextlib import closing
 from pathlib import Path
-import sqlite3
 from tqdm import tqdm
 from unidecode import unidecode
 import json
 import os
+import sqlite3
+import time
 import pkg_resources
 
+from pynations import instrument
+from pynations import places
+
 
 DBFILE = Path(pkg_resources.resource_filename('pynations',
                                                 'data/pynations.sqlite'))
@@ -13,6 +18,8 @@ COUNTRYINFOFILE = Path(pkg_resources.resource_filename('pynations',
                                                     'data/countryinfo.json'))
 COUNTRYLOOKUPFILE = Path(pkg_resources.resource_filename('pynations',
                                                     'data/countrylookup.json'))
+COUNTRYDISTANCEFILE = Path(pkg_resources.resource_filename('pynations',
+                                                    'data/countrydistances.npz'))
 
 try:
     COLS = os.get_terminal_size()[0]
@@ -23,6 +30,8 @@ CONTINENTS = {"AF":"Africa","AS":"Asia","EU":"Europe",
                 "NA":"North America","OC":"Oceania","SA":"South America",
                 "AN":"Antartica"}
 
+EARTH_RADIUS = 6371.0088    # Mean earth radius in km
+
 Country = {   "Geonameid": 0,
               "ISO2": "",
               "ISO3": "",
@@ -44,18 +53,77 @@ Country = {   "Geonameid": 0,
               "Languages": [],
               "Neighbours": [],
               "EquivalentFipsCode": "",
-              "Timezones": []
+              "Timezones": [],
+              "LocalizedNames": {},
+              "CapitalCoordinates": None,
+              "Centroid": None
         }
 
-def build_CountryInfo():
+def country_coordinates(cursor):
+    '''
+    Returns the coordinates [latitude, longitude] of the capital and of the
+    centroid (the country's own geonames feature) of every country, keyed
+    by ISO2, in one query. Coordinates not in the database are None, as are
+    all the capitals of databases built before the capitals table
+    '''
+    query = """select ci.iso2, {capital}, g.latitude, g.longitude
+               from countryinfo ci {join}
+               left join geonames g on g.geonameid = ci.geonameId;"""
+    try:
+        cursor.execute(query.format(capital='cap.latitude, cap.longitude',
+                                    join='left join capitals cap on cap.country = ci.iso2'))
+    except sqlite3.OperationalError:
+        cursor.execute(query.format(capital='null, null',join=''))
+    return {iso2:([caplat,caplon] if caplat is not None else None,
+                  [lat,lon] if lat is not None else None)
+            for iso2,caplat,caplon,lat,lon in cursor.fetchall()}
+
+def build_distances(conn=None,destination=None):
+    '''
+    Precomputes the great-circle distances (km, float32) between the
+    capitals and between the centroids of all the countries and saves them
+    with the country geonameids to destination (COUNTRYDISTANCEFILE by
+    default). Pairs without coordinates are NaN. Requires numpy
+    '''
+    import numpy as np
+
+    if conn is None:
+        with closing(instrument.connect(str(DBFILE))) as conn:
+            return build_distances(conn,destination)
+    c = conn.cursor()
+    c.execute('select iso2, geonameId from countryinfo;')
+    geoids = dict(c.fetchall())
+    coordinates = country_coordinates(c)
+
+    arrays = {'geonameid':np.array(sorted(geoids.values()),dtype=np.int64)}
+    order = sorted(geoids,key=geoids.get)
+    for idx,kind in enumerate(['capital','centroid']):
+        latlon = np.array([coordinates[iso2][idx] or [np.nan,np.nan] for iso2 in order],
+                          dtype=np.float64).reshape(-1,2)
+        lat,lon = np.radians(latlon[:,0]),np.radians(latlon[:,1])
+        # Haversine between every pair
+        a = (np.sin((lat[:,None]-lat[None,:])/2)**2 +
+             np.cos(lat[:,None])*np.cos(lat[None,:])*np.sin((lon[:,None]-lon[None,:])/2)**2)
+        arrays[kind] = (2*EARTH_RADIUS*np.arcsin(np.sqrt(np.clip(a,0,1)))).astype(np.float32)
+
+    destination = Path(destination or COUNTRYDISTANCEFILE)
+    temp = destination.with_name(destination.name+'.tmp')
+    with open(temp,'wb') as f:
+        np.savez(f,**arrays)
+    os.replace(str(temp),str(destination))
+    _loaded.pop(str(destination),None)
+    return len(order)
+
+def build_CountryInfo(force=False):
 
     '''
     Builds CountryInfo and CountryLookup files
-    These files are necessary for CountryInfo to work
+    These files are necessary for CountryInfo to work. With force they are
+    rebuilt even if they exist, e.g. after a refresh of the database
     '''
 
     #Check if CountryInfo and CountryLookup files exist
-    if COUNTRYINFOFILE.exists() and COUNTRYLOOKUPFILE.exists():
+    if not force and COUNTRYINFOFILE.exists() and COUNTRYLOOKUPFILE.exists():
         return True # No need to create the files
 
     if not DBFILE.exists():
@@ -63,7 +131,8 @@ def build_CountryInfo():
                 and import geosqlite and run setupdb() before executing this''')
         exit(1)
 
-    conn = sqlite3.connect(DBFILE)
+    start = time.perf_counter()
+    conn = instrument.connect(str(DBFILE))
     c = conn.cursor()
     c2 = conn.cursor()
 
@@ -74,6 +143,11 @@ def build_CountryInfo():
     print('Building Country Info and Country Lookup files'.center(COLS))
     print('='*COLS)
 
+    coordinates = country_coordinates(c)
+    # Databases built by older versions lack the capitals and preferrednames
+    # tables. Their countries keep what the previous files had
+    previous = load_json(COUNTRYINFOFILE) if COUNTRYINFOFILE.exists() else {}
+
     c.execute('Select * from countryinfo;')
     c_result = c.fetchall()
 
@@ -115,6 +189,10 @@ def build_CountryInfo():
                 country["Languages"].append(language)
 
         country["Continent"] = CONTINENTS[country["Continent"]]
+        country["CapitalCoordinates"],country["Centroid"] = coordinates[country["ISO2"]]
+        old = previous.get(str(country['Geonameid']),{})
+        if country["CapitalCoordinates"] is None:
+            country["CapitalCoordinates"] = old.get("CapitalCoordinates")
 
 
         countrylookup[country['ISO2'].lower()] = country['Geonameid']
@@ -130,6 +208,14 @@ def build_CountryInfo():
         altnames = c2.fetchall()
         country['AlternateNames'] = [row[0] for row in altnames]
 
+        # Preferred name of the country in each language
+        try:
+            c2.execute("""Select isolanguage, name from preferrednames
+                            where geonameId=:geoid;""",{'geoid':country['Geonameid']})
+            country['LocalizedNames'] = dict(c2.fetchall())
+        except sqlite3.OperationalError:
+            country['LocalizedNames'] = old.get('LocalizedNames',{})
+
         for altname in altnames:
             countrylookup[altname[0].lower()] = country['Geonameid']
             countrylookup[unidecode(altname[0]).lower()] = country['Geonameid']
@@ -142,9 +228,9 @@ def build_CountryInfo():
         country['States'] = [row[0] for row in c2.fetchall()]
 
         c2.execute("""select distinct
-                            CASE when gmt_offset < '0.0' then 'GMT'||GMT_offset
-                                 when gmt_offset > '0.0'  then 'GMT+'||GMT_offset
-                                 when gmt_offset = '0.0'  then 'GMT'
+                            CASE when gmt_offset < 0 then 'GMT'||GMT_offset
+                                 when gmt_offset > 0 then 'GMT+'||GMT_offset
+                                 when gmt_offset = 0 then 'GMT'
                             End Timezone
                       from timezones where country = :cc;""",{'cc':country['ISO2']})
         country['Timezones'] = [row[0] for row in c2.fetchall()]
@@ -153,11 +239,25 @@ def build_CountryInfo():
 
     #Saving the information
 
-    with open(COUNTRYINFOFILE,'w') as json_file:
-        json.dump(countries,json_file)
+    # Written next to the files and renamed, so that readers in other
+    # processes never see a partial file
+    for path,content in ((COUNTRYINFOFILE,countries),(COUNTRYLOOKUPFILE,countrylookup)):
+        temp = path.with_name(path.name+'.tmp')
+        with open(temp,'w') as json_file:
+            json.dump(content,json_file)
+        os.replace(str(temp),str(path))
 
-    with open(COUNTRYLOOKUPFILE,'w') as json_file:
-        json.dump(countrylookup,json_file)
+    # Drop copies of the previous files loaded by load_json
+    _loaded.clear()
+
+    try:
+        build_distances(conn)
+    except ImportError:
+        print('numpy is not installed, the country distance matrix is not built')
+    conn.close()
+
+    instrument.emit('stage',stage='countryinfo.build',seconds=round(time.perf_counter()-start,6),
+                    rows=len(countries),lookups=len(countrylookup))
 
     print(' Build Complete '.center(COLS,"#"))
 
@@ -165,6 +265,94 @@ def build_CountryInfo():
     #pprint(countries)
 
 
+# path: (size and modification time of the file, content)
+_loaded = {}
+
+def _stamp(path):
+    stat = os.stat(str(path))
+    return (stat.st_size,stat.st_mtime_ns)
+
+def load_json(path):
+    '''
+    Loads a json file once and returns the cached copy afterwards. The file
+    is read again once it was rebuilt (see generations.refresh)
+    '''
+    key = str(path)
+    stamp = _stamp(path)
+    if key not in _loaded or _loaded[key][0] != stamp:
+        with open(path) as json_file:
+            _loaded[key] = (stamp,json.load(json_file))
+    return _loaded[key][1]
+
+def load_distances(path=None):
+    '''
+    Loads the distance matrices (COUNTRYDISTANCEFILE by default) once,
+    building them first if needed. Returns the arrays and the matrix index
+    of every geonameid
+    '''
+    import numpy as np
+
+    path = Path(path or COUNTRYDISTANCEFILE)
+    key = str(path)
+    if not path.exists():
+        if not DBFILE.exists():
+            raise FileNotFoundError(f'{path} not found. Please run geosqlite.setupdb() first')
+        build_distances(destination=path)
+    stamp = _stamp(path)
+    if key not in _loaded or _loaded[key][0] != stamp:
+        with np.load(key) as npz:
+            arrays = {name:npz[name] for name in npz.files}
+        index = {int(geoid):idx for idx,geoid in enumerate(arrays['geonameid'])}
+        _loaded[key] = (stamp,(arrays,index))
+    return _loaded[key][1]
+
+def _country_index(name,index):
+    geoid = load_json(COUNTRYLOOKUPFILE).get(str(name).lower())
+    if geoid not in index:
+        raise KeyError(f'Country {name} not found')
+    return index[geoid]
+
+def distances(pairs,kind='capital'):
+    '''
+    Returns the great-circle distances in km between the countries of every
+    (a, b) pair as a float32 numpy array. Countries can be given by any
+    valid name. kind is 'capital' for the distance between the capitals or
+    'centroid' for the distance between the country centers. Unknown
+    countries raise KeyError. Requires numpy
+    '''
+    import numpy as np
+
+    build_CountryInfo()
+    arrays,index = load_distances()
+    if kind not in ('capital','centroid'):
+        raise ValueError(f'kind must be capital or centroid, not {kind}')
+    pairs = list(pairs)
+    positions = {name:_country_index(name,index) for pair in pairs for name in pair}
+    rows = np.array([positions[a] for a,b in pairs],dtype=np.int64)
+    cols = np.array([positions[b] for a,b in pairs],dtype=np.int64)
+    return arrays[kind][rows,cols]
+
+def distance(a,b,kind='capital'):
+    '''
+    Returns the great-circle distance in km between the countries a and b.
+    See distances()
+    '''
+    return float(distances([(a,b)],kind)[0])
+
+def lookup_country(countryname):
+    '''
+    Returns the country information for any valid name of a country,
+    None if the name is not known. Hits, misses and latencies are counted
+    in pynations.instrument.metrics()
+    '''
+    start = time.perf_counter()
+    build_CountryInfo()
+    geoid = load_json(COUNTRYLOOKUPFILE).get(countryname.lower())
+    country = None if geoid is None else load_json(COUNTRYINFOFILE)[str(geoid)]
+    instrument.observe('lookup_country',time.perf_counter()-start,'miss' if country is None else 'hit')
+    return country
+
+
 class CountryInfo:
     '''
     Country Info class is used to represent the information of a given country.
@@ -184,6 +372,12 @@ class CountryInfo:
     c.timezones()           <-- Returns the list of timezones
     c.population()          <-- Returns the population
     c.continent()           <-- Returns the continent
+    c.localized_name('de')  <-- Returns the country name in German
+    c.largest_cities(5)     <-- Returns the 5 most populous places
+    c.capital_place()       <-- Returns the capital's geonameid and coordinates
+    c.capital_coordinates() <-- Returns the capital's (latitude, longitude)
+    c.centroid()            <-- Returns the center of the country
+    c.distance_to('fr')     <-- Returns the distance between the capitals in km
 
     allcountries = CountryInfo().all()
 
@@ -199,14 +393,9 @@ class CountryInfo:
             #Load the country Lookup File
 
             if countryname:
-                self.countrylookup = json.load(open(COUNTRYLOOKUPFILE))
-                if countryname.lower() in self.countrylookup:
-                    geoid = self.countrylookup[countryname.lower()]
-
-                    #Now load the country information
-                    countryinfo = json.load(open(COUNTRYINFOFILE))
-                    self.country = countryinfo[str(geoid)]
-                else:
+                self.countrylookup = load_json(COUNTRYLOOKUPFILE)
+                self.country = lookup_country(countryname)
+                if self.country is None:
                     print(f'Country information not found for {countryname}')
 
     def info(self):
@@ -245,6 +434,64 @@ class CountryInfo:
     def languages(self):
         return self.country['Languages'] if self.country else None
 
+    def localizednames(self):
+        return self.country.get('LocalizedNames',{}) if self.country else None
+
+    def localized_name(self,lang):
+        '''
+        Returns the preferred name of the country in the language lang
+        (ISO 639 code). Falls back to the default name if there is none
+        '''
+        if not self.country:
+            return None
+        return self.country.get('LocalizedNames',{}).get(lang,self.country['Country'])
+
+    def largest_cities(self,n=10):
+        '''
+        Returns the n most populous places of the country, largest first
+        '''
+        return places.largest_places(self.country['ISO2'],n) if self.country else None
+
+    def feature_counts(self):
+        '''
+        Returns the number of features and their population per feature class
+        '''
+        return places.feature_summary(self.country['ISO2']) if self.country else None
+
+    def admin_counts(self):
+        '''
+        Returns the number of features and populated places per admin1 code
+        '''
+        return places.admin_summary(self.country['ISO2']) if self.country else None
+
+    def capital_place(self):
+        '''
+        Returns the geonameid, population and coordinates of the capital
+        '''
+        return places.capital(self.country['ISO2']) if self.country else None
+
+    def capital_coordinates(self):
+        '''
+        Returns the (latitude, longitude) of the capital. None for countries
+        without a capital and for country files built before the coordinates
+        were added (rebuild with build_CountryInfo(force=True))
+        '''
+        return self.country.get('CapitalCoordinates') if self.country else None
+
+    def centroid(self):
+        '''
+        Returns the (latitude, longitude) of the center of the country. None
+        if unknown, see capital_coordinates()
+        '''
+        return self.country.get('Centroid') if self.country else None
+
+    def distance_to(self,other,kind='capital'):
+        '''
+        Returns the great-circle distance in km to the country other. See
+        distances()
+        '''
+        return distance(self.country['ISO2'],other,kind) if self.country else None
+
     def all(self):
         return json.load(open(COUNTRYINFOFILE))
 
@@ -0,0 +1,193 @@
+"""
+Purpose : asyncio facade over the pynations lookups
+
+All file loads and SQLite queries run in a bounded thread pool, each thread
+holding its own read only connection, so the event loop is never blocked.
+Identical requests that are in flight at the same time share one query,
+each caller getting its own copy of the result, and small lookups issued concurrently (country names, postcodes) are
+collected for one loop iteration and answered with a single query.
+
+Usage
+-----
+from pynations.aio import AsyncPyNations
+
+async with AsyncPyNations() as pn:
+    country = await pn.resolve_country('deutschland')
+    places = await pn.find_places('springfield', country='US', admin1='IL')
+    postcodes = await pn.lookup_postcode('94103', country='US')
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import asyncio
+import copy
+import threading
+import pkg_resources
+
+from pynations import instrument
+from pynations.generations import generation
+from pynations.CountryInfo import lookup_country
+from pynations.places import find_places
+from pynations.places import lookup_postcodes
+from pynations.places import search_places
+
+DBFILE = Path(pkg_resources.resource_filename('pynations','data/pynations.sqlite'))
+
+
+class AsyncPyNations:
+    '''
+    Async lookups against the pynations data.
+
+    max_workers bounds the number of threads (and so of SQLite connections)
+    used. max_batch caps the number of keys answered by a single query
+    '''
+
+    def __init__(self,max_workers=4,max_batch=500,dbfile=DBFILE):
+        self.dbfile = dbfile
+        self.max_batch = max_batch
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,thread_name_prefix='pynations')
+        self.local = threading.local()
+        # Every connection opened, so that close() can close them from the
+        # calling thread
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.pending = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self,*exc):
+        self.close()
+
+    def close(self):
+        '''
+        Waits for the running lookups, stops the thread pool and closes the
+        connections of its threads
+        '''
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+
+    def connection(self):
+        '''
+        Returns the read only connection of the calling worker thread,
+        reopened once a new generation of the database was promoted
+        '''
+        conn = getattr(self.local,'conn',None)
+        current = generation(self.dbfile)
+        if conn is None or current != self.local.generation:
+            with self.lock:
+                if conn is not None:
+                    conn.close()
+                    self.connections.discard(conn)
+                conn = instrument.connect(f'file:{self.dbfile}?mode=ro',uri=True,check_same_thread=False)
+                self.connections.add(conn)
+            self.local.conn = conn
+            self.local.generation = current
+        return conn
+
+    async def run(self,func,*args):
+        '''
+        Runs func(*args) in the thread pool
+        '''
+        return await asyncio.get_running_loop().run_in_executor(self.executor,func,*args)
+
+    async def coalesce(self,key,func,*args):
+        '''
+        Runs func(*args) unless a request with the same key is already in
+        flight, in which case its result is shared. Every caller gets a copy,
+        so that changing it does not change the result of the others
+        '''
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.run(func,*args))
+            self.inflight[key] = future
+            future.add_done_callback(lambda f: self.inflight.pop(key,None))
+        # Shielded so that a cancelled caller does not cancel the others
+        return copy.deepcopy(await asyncio.shield(future))
+
+    async def batched(self,kind,key,func):
+        '''
+        Queues key for a batch of kind. The batch is flushed on the next loop
+        iteration (or once max_batch keys are queued) by calling func with the
+        list of keys in the thread pool. func returns a dictionary of key to
+        result, of which every caller gets a copy
+        '''
+        future = self.inflight.get((kind,key))
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.inflight[(kind,key)] = future
+            future.add_done_callback(lambda f: self.inflight.pop((kind,key),None))
+
+            batch = self.pending.get(kind)
+            if batch is None:
+                batch = self.pending[kind] = {}
+                loop.call_soon(self.flush,kind,func)
+            batch[key] = future
+            if len(batch) >= self.max_batch:
+                self.flush(kind,func)
+        return copy.deepcopy(await asyncio.shield(future))
+
+    def flush(self,kind,func):
+        batch = self.pending.pop(kind,None)
+        if batch:
+            asyncio.ensure_future(self.resolve_batch(batch,func))
+
+    async def resolve_batch(self,batch,func):
+        try:
+            results = await self.run(func,list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for key,future in batch.items():
+                if not future.done():
+                    future.set_result(results.get(key))
+
+    def _resolve_countries(self,names):
+        return {name:lookup_country(name) for name in names}
+
+    def _lookup_postcodes(self,keys):
+        return lookup_postcodes(keys,self.connection())
+
+    def _search_places(self,name,country,feature_class,limit):
+        return search_places(name,country,feature_class,limit,self.connection())
+
+    def _find_places(self,name,country,admin1,feature_class,limit):
+        return find_places(name,country,admin1,feature_class,limit,self.connection())
+
+    async def resolve_country(self,name):
+        '''
+        Returns the country information (see CountryInfo.info()) for any
+        valid name of a country, None if not known
+        '''
+        return await self.batched('country',name,self._resolve_countries)
+
+    async def search_places(self,name,country=None,feature_class=None,limit=10):
+        '''
+        Returns the places with the given name as a list of dictionaries,
+        largest first
+        '''
+        key = ('places',name,country,feature_class,limit)
+        return await self.coalesce(key,self._search_places,name,country,feature_class,limit)
+
+    async def find_places(self,name,country=None,admin1=None,feature_class=None,limit=10):
+        '''
+        Returns the places called name, ignoring case and accents, as a list
+        of dictionaries, largest first (see places.find_places)
+        '''
+        key = ('find',name,country,admin1,feature_class,limit)
+        return await self.coalesce(key,self._find_places,name,country,admin1,feature_class,limit)
+
+    async def lookup_postcode(self,postcode,country=None):
+        '''
+        Returns the zipcodes rows for a postcode as a list of dictionaries,
+        limited to a country (ISO2) if given
+        '''
+        key = (postcode,country.upper() if country else None)
+        return await self.batched('postcode',key,self._lookup_postcodes)
@@ -0,0 +1,331 @@
+"""
+Purpose : Population ranked type-ahead over the place names
+
+build_autocomplete() writes every name of the populated places and
+administrative areas (the geonames names and their alternate names) to
+data/autocomplete as a sorted array of normalized keys (see
+places.normalize). Every key is stored a second time prefixed with the
+country code ('US:springfield'), so that searches within a country are
+prefix searches too.
+
+A prefix matches a contiguous range of the keys. Small ranges are ranked
+on the fly. For every prefix matching more than THRESHOLD keys, the NODE_K
+most populous places are precomputed, so short prefixes like 'sa' do not
+scan millions of keys. The arrays are memory mapped on load.
+
+Usage
+-----
+from pynations.autocomplete import autocomplete, build_autocomplete
+build_autocomplete(languages=['en', 'de'])      <-- Optional, built on first use
+autocomplete('sprin', 5)
+autocomplete('mün', 5, country='DE')
+
+Note: Requires numpy (pip install pynations[numpy])
+"""
+
+from bisect import bisect_left
+from pathlib import Path
+import json
+import os
+import shutil
+import sqlite3
+import numpy as np
+import pkg_resources
+
+from pynations.generations import generation
+from pynations.geosqlite import NONLANGUAGES
+from pynations.places import normalize
+
+DBFILE = Path(pkg_resources.resource_filename('pynations','data/pynations.sqlite'))
+AUTOCOMPLETEDIR = Path(pkg_resources.resource_filename('pynations','data/autocomplete'))
+
+THRESHOLD = 2000    # Ranges up to this size are ranked when queried
+NODE_K = 50         # Places precomputed for the prefixes of larger ranges
+MAXDEPTH = 16       # Longest prefix (in bytes, including 'CC:') precomputed
+FETCHSIZE = 100000
+
+def dbstamp(dbfile):
+    '''
+    Size and modification time of the database. Used to detect a stale index
+    '''
+    stat = os.stat(str(dbfile))
+    return [stat.st_size,stat.st_mtime_ns]
+
+def build_autocomplete(dbfile=DBFILE,destination=AUTOCOMPLETEDIR,languages=None,countries=None,
+                       feature_classes=('P','A')):
+    '''
+    Builds the autocomplete index of the places of feature_classes. The
+    alternate names in languages (ISO codes, all languages if None) are
+    included, names without a language always. countries (ISO2) limits the
+    places indexed.
+
+    The keys are sorted by SQLite in a temporary table and streamed into
+    memory mapped files, so memory use stays flat. The index is written to a
+    temporary directory and swapped in when complete. Returns the number of
+    keys written
+    '''
+    destination = Path(destination)
+    temp = destination.with_name(destination.name+'.tmp')
+    if temp.exists():
+        shutil.rmtree(str(temp))
+    temp.mkdir(parents=True)
+
+    conn = sqlite3.connect(f'file:{dbfile}?mode=ro',uri=True)
+    conn.create_function('normalize',1,lambda name: normalize(name) if name else '')
+
+    where = [f"g.feature_class IN ({','.join('?'*len(feature_classes))})"]
+    params = list(feature_classes)
+    if countries:
+        where.append(f"g.country IN ({','.join('?'*len(countries))})")
+        params += [code.upper() for code in countries]
+    if languages:
+        langfilter = f"(a.isolanguage = '' OR a.isolanguage IN ({','.join('?'*len(languages))}))"
+        langparams = list(languages)
+    else:
+        # NONLANGUAGES has '' too, which is a name all the same here
+        langfilter = f"(a.isolanguage = '' OR a.isolanguage NOT IN ({','.join('?'*len(NONLANGUAGES))}))"
+        langparams = list(NONLANGUAGES)
+
+    conn.execute("""create temp table names (key TEXT, geonameid INTEGER, name TEXT,
+                                              country TEXT, population INTEGER);""")
+    conn.execute(f"""insert into temp.names
+                     select normalize(g.name), g.geonameid, g.name, g.country, g.population
+                     from geonames g where {' and '.join(where)}
+                     union
+                     select normalize(g.asciiname), g.geonameid, g.name, g.country, g.population
+                     from geonames g where {' and '.join(where)}
+                     union
+                     select normalize(a.alternate_name), g.geonameid, a.alternate_name, g.country, g.population
+                     from altnames a join geonames g on g.geonameid = a.geonameId
+                     where {' and '.join(where)} and {langfilter};""",params+params+params+langparams)
+    conn.execute("delete from temp.names where key = '';")
+    conn.execute("""insert into temp.names
+                    select country||':'||key, geonameid, name, country, population from temp.names;""")
+
+    rows,keybytes,namebytes = conn.execute("""select count(*), sum(length(cast(key as blob))),
+                                                     sum(length(cast(name as blob)))
+                                              from temp.names;""").fetchone()
+    rows,keybytes,namebytes = rows or 0,keybytes or 0,namebytes or 0
+
+    def memmap(name,dtype,shape):
+        return np.lib.format.open_memmap(str(temp.joinpath(f'{name}.npy')),mode='w+',dtype=dtype,shape=shape)
+
+    arrays = {'keys':memmap('keys',np.uint8,(keybytes,)),
+              'keyoffsets':memmap('keyoffsets',np.int64,(rows+1,)),
+              'names':memmap('names',np.uint8,(namebytes,)),
+              'nameoffsets':memmap('nameoffsets',np.int64,(rows+1,)),
+              'geonameid':memmap('geonameid',np.int64,(rows,)),
+              'population':memmap('population',np.int64,(rows,)),
+              'country':memmap('country','S2',(rows,))}
+    arrays['keyoffsets'][0] = arrays['nameoffsets'][0] = 0
+
+    # Same ordering as bytes comparisons in python (memcmp on UTF-8)
+    cursor = conn.execute("""select key, name, geonameid, population, country from temp.names
+                             order by key, population desc, geonameid;""")
+    start = keypos = namepos = 0
+    while True:
+        chunk = cursor.fetchmany(FETCHSIZE)
+        if not chunk:
+            break
+        end = start+len(chunk)
+        for column,offsets,pos in (('keys','keyoffsets',keypos),('names','nameoffsets',namepos)):
+            encoded = [row[0 if column == 'keys' else 1].encode('utf-8') for row in chunk]
+            lengths = np.fromiter((len(value) for value in encoded),np.int64,len(encoded))
+            arrays[offsets][start+1:end+1] = pos + np.cumsum(lengths)
+            blob = b''.join(encoded)
+            arrays[column][pos:pos+len(blob)] = np.frombuffer(blob,np.uint8)
+            if column == 'keys':
+                keypos += len(blob)
+            else:
+                namepos += len(blob)
+        arrays['geonameid'][start:end] = [row[2] for row in chunk]
+        arrays['population'][start:end] = [row[3] or 0 for row in chunk]
+        arrays['country'][start:end] = [(row[4] or '').encode() for row in chunk]
+        start = end
+    conn.close()
+
+    nodekeys,nodetop = prefix_nodes(arrays['keys'],arrays['keyoffsets'],arrays['geonameid'],
+                                    arrays['population'])
+    lengths = np.fromiter((len(key) for key in nodekeys),np.int64,len(nodekeys))
+    np.save(str(temp.joinpath('nodekeys.npy')),np.frombuffer(b''.join(nodekeys),np.uint8))
+    np.save(str(temp.joinpath('nodeoffsets.npy')),np.concatenate([[0],np.cumsum(lengths)]).astype(np.int64))
+    np.save(str(temp.joinpath('nodetop.npy')),nodetop)
+
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    with open(str(temp.joinpath('meta.json')),'w') as f:
+        json.dump({'rows':rows,'nodes':len(nodekeys),'threshold':THRESHOLD,'node_k':NODE_K,
+                   'languages':languages,'countries':countries,'feature_classes':list(feature_classes),
+                   'dbstamp':dbstamp(dbfile)},f)
+
+    if destination.exists():
+        old = destination.with_name(destination.name+'.old')
+        os.replace(str(destination),str(old))
+        os.replace(str(temp),str(destination))
+        shutil.rmtree(str(old))
+    else:
+        os.replace(str(temp),str(destination))
+
+    return rows
+
+def prefix_nodes(keys,offsets,geonameids,population):
+    '''
+    Returns the prefixes (up to MAXDEPTH bytes) matching more than THRESHOLD
+    keys, sorted, and a matrix with the positions of the NODE_K most populous
+    distinct places of each (-1 padded)
+    '''
+    rows = len(offsets)-1
+    lengths = np.diff(offsets)
+    nodes = {}
+    changed = np.zeros(max(rows-1,0),dtype=bool)
+    for depth in range(1,MAXDEPTH+1):
+        present = lengths >= depth
+        byte = np.zeros(rows,dtype=np.uint8)
+        byte[present] = keys[offsets[:-1][present]+depth-1]
+        changed |= byte[1:] != byte[:-1]
+        starts = np.concatenate([[0],np.flatnonzero(changed)+1])
+        ends = np.concatenate([starts[1:],[rows]])
+        large = (ends-starts > THRESHOLD) & (byte[starts] != 0)
+        if not large.any():
+            break
+        for lo,hi in zip(starts[large],ends[large]):
+            prefix = keys[offsets[lo]:offsets[lo]+depth].tobytes()
+            nodes[prefix] = ranked(lo,hi,geonameids,population,NODE_K)
+
+    nodekeys = sorted(nodes)
+    nodetop = np.full((len(nodekeys),NODE_K),-1,dtype=np.int64)
+    for idx,prefix in enumerate(nodekeys):
+        nodetop[idx,:len(nodes[prefix])] = nodes[prefix]
+    return nodekeys,nodetop
+
+def ranked(lo,hi,geonameids,population,k):
+    '''
+    Returns the positions in [lo, hi) of the k most populous distinct places
+    '''
+    size = hi-lo
+    pop = np.asarray(population[lo:hi])
+    wanted = 4*k
+    while True:
+        # Places have several names, so more candidates than k are ranked
+        if size > wanted:
+            candidates = np.argpartition(-pop,wanted)[:wanted]
+        else:
+            candidates = np.arange(size)
+        candidates = candidates[np.lexsort((candidates,-pop[candidates]))]
+        positions = []
+        seen = set()
+        for pos in candidates:
+            geoid = int(geonameids[lo+pos])
+            if geoid not in seen:
+                seen.add(geoid)
+                positions.append(lo+int(pos))
+                if len(positions) == k:
+                    return positions
+        if size <= wanted:
+            return positions
+        wanted *= 4
+
+def load_autocomplete(source=AUTOCOMPLETEDIR):
+    '''
+    Memory maps an index written by build_autocomplete()
+    '''
+    return Autocompleter(source)
+
+
+class _Strings:
+    '''
+    Sequence view of the byte strings in a blob, for bisect
+    '''
+    def __init__(self,blob,offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self,idx):
+        return self.blob[self.offsets[idx]:self.offsets[idx+1]].tobytes()
+
+
+class Autocompleter:
+    '''
+    Read only, memory mapped autocomplete index
+    '''
+
+    def __init__(self,source=AUTOCOMPLETEDIR):
+        source = Path(source)
+        if not source.joinpath('meta.json').exists():
+            raise FileNotFoundError(f'No autocomplete index in {source}. Run build_autocomplete() first')
+        with open(str(source.joinpath('meta.json'))) as f:
+            self.meta = json.load(f)
+
+        def load(name):
+            return np.load(str(source.joinpath(f'{name}.npy')),mmap_mode='r')
+
+        self.keys = _Strings(load('keys'),load('keyoffsets'))
+        self.names = _Strings(load('names'),load('nameoffsets'))
+        self.geonameid = load('geonameid')
+        self.population = load('population')
+        self.country = load('country')
+        self.nodes = _Strings(load('nodekeys'),load('nodeoffsets'))
+        self.nodetop = load('nodetop')
+
+    def complete(self,prefix,k=10,country=None):
+        '''
+        Returns the k most populous places with a name starting with prefix
+        (ignoring case and accents), optionally within a country (ISO2), as
+        a list of dictionaries with the geonameid, the matching name, the
+        country and the population
+        '''
+        key = normalize(prefix)
+        if country:
+            key = f'{country.upper()}:{key}'
+        elif not key:
+            return []
+        key = key.encode('utf-8')
+
+        lo = bisect_left(self.keys,key)
+        hi = bisect_left(self.keys,key+b'\xff',lo)
+        if hi-lo <= self.meta['threshold'] or k > self.meta['node_k']:
+            positions = ranked(lo,hi,self.geonameid,self.population,k)
+        else:
+            node = bisect_left(self.nodes,key)
+            if node < len(self.nodes) and self.nodes[node] == key:
+                positions = [int(pos) for pos in self.nodetop[node][:k] if pos >= 0]
+            else:
+                # Prefixes longer than MAXDEPTH
+                positions = ranked(lo,hi,self.geonameid,self.population,k)
+
+        return [{'geonameid':int(self.geonameid[pos]),
+                 'name':self.names[pos].decode('utf-8'),
+                 'country':self.country[pos].decode(),
+                 'population':int(self.population[pos])} for pos in positions]
+
+
+_autocompleter = None
+_generation = None     # Database and generation _autocompleter was checked against
+
+def autocomplete(prefix,k=10,country=None):
+    '''
+    Returns the k most populous places with a name starting with prefix.
+    See Autocompleter.complete. The index is built with the defaults of
+    build_autocomplete on first use, and rebuilt if the database changed.
+    It is checked again once a new generation of the database was promoted
+    (see pynations.generations)
+    '''
+    global _autocompleter,_generation
+    current = (DBFILE,generation(DBFILE))
+    if _autocompleter is None or current != _generation:
+        try:
+            _autocompleter = load_autocomplete(AUTOCOMPLETEDIR)
+            stale = _autocompleter.meta['dbstamp'] != dbstamp(DBFILE)
+        except FileNotFoundError:
+            stale = True
+        if stale:
+            print('Building the autocomplete index ...')
+            build_autocomplete(DBFILE,AUTOCOMPLETEDIR)
+            _autocompleter = load_autocomplete(AUTOCOMPLETEDIR)
+        _generation = current
+    return _autocompleter.complete(prefix,k,country)
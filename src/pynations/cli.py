@@ -14,9 +14,68 @@ Why does this file exist, and why not put this in __main__?
 
   Also see (1) from http://click.pocoo.org/5/setuptools/#setuptools-integration
 """
+import argparse
 import sys
 
 
+def serve(args):
+    from pynations.server import serve
+    serve(args.host, args.port, args.verbose)
+    return 0
+
+
+def resolve(args):
+    from pynations.resolve import main
+    return main(args)
+
+
+def export(args):
+    from pynations.export import main
+    return main(args)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='pynations', description='Country and place information from geonames.org')
+    commands = parser.add_subparsers(dest='command')
+
+    parser_serve = commands.add_parser('serve', help='Start a local HTTP lookup service')
+    parser_serve.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: %(default)s)')
+    parser_serve.add_argument('--port', type=int, default=8080, help='Port to listen on (default: %(default)s)')
+    parser_serve.add_argument('-v', '--verbose', action='store_true', help='Log every request')
+    parser_serve.set_defaults(func=serve)
+
+    parser_resolve = commands.add_parser('resolve', help='Resolve a column of a CSV/TSV/JSON lines stream')
+    parser_resolve.add_argument('input', nargs='?', default='-', help='Input file (default: stdin)')
+    parser_resolve.add_argument('-t', '--type', default='country', choices=['country', 'postcode', 'latlon'],
+                                help='What the column holds (default: %(default)s)')
+    parser_resolve.add_argument('-c', '--column', help='Column to resolve')
+    parser_resolve.add_argument('--lat', help='Latitude column for --type latlon')
+    parser_resolve.add_argument('--lon', help='Longitude column for --type latlon')
+    parser_resolve.add_argument('--country-column', help='Country (ISO2) column restricting --type postcode')
+    parser_resolve.add_argument('-f', '--format', choices=['csv', 'tsv', 'jsonl'],
+                                help='Input and output format (default: from the file extension, csv for stdin)')
+    parser_resolve.add_argument('-b', '--batch-size', type=int, default=10000, help='Rows per batch (default: %(default)s)')
+    parser_resolve.add_argument('-p', '--processes', type=int, default=None, help='Resolve batches in this many processes')
+    parser_resolve.set_defaults(func=resolve)
+
+    parser_export = commands.add_parser('export', help='Export places with their country, admin and timezone names')
+    parser_export.add_argument('destination', nargs='?', default='-',
+                               help='Output file, or directory with --partition (default: stdout)')
+    parser_export.add_argument('-f', '--format', choices=['jsonl', 'csv', 'tsv'],
+                               help='Output format (default: from the file extension, jsonl for stdout)')
+    parser_export.add_argument('-z', '--gzip', action='store_true', help='Gzip the output (default for .gz names)')
+    parser_export.add_argument('-c', '--country', action='append', help='Only places in this country (ISO2), repeatable')
+    parser_export.add_argument('--feature-class', action='append', help='Only places of this feature class, repeatable')
+    parser_export.add_argument('--min-population', type=int, default=0, help='Only places with at least this population')
+    parser_export.add_argument('--partition', action='store_true', help='Write one file per country into destination')
+    parser_export.add_argument('-p', '--processes', type=int, default=None,
+                               help='Write the country partitions in this many processes')
+    parser_export.add_argument('--chunk-size', type=int, default=10000, help='Rows read per query (default: %(default)s)')
+    parser_export.set_defaults(func=export)
+
+    return parser
+
+
 def main(argv=sys.argv):
     """
     Args:
@@ -25,7 +84,11 @@ def main(argv=sys.argv):
     Returns:
         int: A return code
 
-    Does stuff.
+    Runs the pynations command given in argv. Prints the help if there is none.
     """
-    print(argv)
-    return 0
+    parser = build_parser()
+    args = parser.parse_args(argv[1:])
+    if not args.command:
+        parser.print_help()
+        return 0
+    return args.func(args)
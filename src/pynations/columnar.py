@@ -0,0 +1,253 @@
+"""
+Purpose : Columnar NumPy snapshot of the geonames table for analytics
+
+export_columnar() writes every column below as a .npy array in
+data/columnar. String columns are dictionary encoded: the array holds int32
+codes and <column>.vocab.npy the distinct values. load_columnar() memory maps
+the arrays, so a snapshot of all the places loads instantly and is shared
+between processes through the page cache.
+
+Usage
+-----
+from pynations.columnar import export_columnar, load_columnar
+export_columnar()                       <-- Run once after setupdb()
+snap = load_columnar()
+snap.top_populous('US', 10)             <-- geonameids of the 10 largest places
+snap.population_in_bbox(51.3, -0.5, 51.7, 0.3)
+
+Note: Requires numpy (pip install pynations[numpy])
+"""
+
+from pathlib import Path
+import json
+import os
+import shutil
+import sqlite3
+import numpy as np
+import pkg_resources
+
+DBFILE = Path(pkg_resources.resource_filename('pynations','data/pynations.sqlite'))
+COLUMNARDIR = Path(pkg_resources.resource_filename('pynations','data/columnar'))
+
+# Column name and dtype. None is used for dictionary encoded string columns
+COLUMNS = [('geonameid',np.int64),
+           ('latitude',np.float64),
+           ('longitude',np.float64),
+           ('population',np.int64),
+           ('elevation',np.int32),
+           ('dem',np.int32),
+           ('feature_class',None),
+           ('feature_code',None),
+           ('country',None),
+           ('admin1',None),
+           ('admin2',None)]
+
+FETCHSIZE = 100000
+
+def export_columnar(dbfile=DBFILE,destination=COLUMNARDIR):
+    '''
+    Writes the geonames table of dbfile as a columnar snapshot to destination.
+    Rows are streamed from SQLite in geonameid order straight into memory mapped
+    output files, so memory use does not grow with the table size.
+
+    The snapshot is written to a temporary directory first and swapped in
+    when complete. Returns the number of rows written
+    '''
+    destination = Path(destination)
+    temp = destination.with_name(destination.name+'.tmp')
+    if temp.exists():
+        shutil.rmtree(str(temp))
+    temp.mkdir(parents=True)
+
+    conn = sqlite3.connect(str(dbfile))
+    rows = conn.execute('select count(*) from geonames;').fetchone()[0]
+
+    arrays = {}
+    vocabs = {}
+    for name,dtype in COLUMNS:
+        if rows:
+            arrays[name] = np.lib.format.open_memmap(str(temp.joinpath(f'{name}.npy')),mode='w+',
+                                                    dtype=dtype or np.int32,shape=(rows,))
+        else:
+            # Some numpy versions cannot memory map zero length arrays
+            np.save(str(temp.joinpath(f'{name}.npy')),np.zeros(0,dtype=dtype or np.int32))
+        if dtype is None:
+            vocabs[name] = {}
+
+    names = [name for name,dtype in COLUMNS]
+    cursor = conn.execute(f"""select {','.join(names)} from geonames
+                                order by geonameid;""")
+    start = 0
+    while True:
+        chunk = cursor.fetchmany(FETCHSIZE)
+        if not chunk:
+            break
+        end = start+len(chunk)
+        for idx,(name,dtype) in enumerate(COLUMNS):
+            values = [row[idx] for row in chunk]
+            if dtype is None:
+                vocab = vocabs[name]
+                values = [vocab.setdefault(value or '',len(vocab)) for value in values]
+            else:
+                # Empty strings from the text import are treated as 0
+                values = [value if value not in (None,'') else 0 for value in values]
+            arrays[name][start:end] = values
+        start = end
+    conn.close()
+
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    for name,vocab in vocabs.items():
+        np.save(str(temp.joinpath(f'{name}.vocab.npy')),np.array(list(vocab),dtype=str))
+
+    with open(str(temp.joinpath('meta.json')),'w') as f:
+        json.dump({'rows':start,'columns':names},f)
+
+    if destination.exists():
+        old = destination.with_name(destination.name+'.old')
+        os.replace(str(destination),str(old))
+        os.replace(str(temp),str(destination))
+        shutil.rmtree(str(old))
+    else:
+        os.replace(str(temp),str(destination))
+
+    return start
+
+def load_columnar(source=COLUMNARDIR):
+    '''
+    Memory maps a snapshot written by export_columnar()
+    '''
+    return GeonamesSnapshot(source)
+
+
+class GeonamesSnapshot:
+    '''
+    Read only, memory mapped columnar view of the geonames table.
+
+    Every column in COLUMNS is an attribute holding a numpy array. For
+    dictionary encoded columns the attribute holds the codes; use
+    decode(column,codes) and code(column,value) to convert
+    '''
+
+    def __init__(self,source=COLUMNARDIR):
+        source = Path(source)
+        if not source.joinpath('meta.json').exists():
+            raise FileNotFoundError(f'No columnar snapshot in {source}. Run export_columnar() first')
+
+        with open(str(source.joinpath('meta.json'))) as f:
+            self.meta = json.load(f)
+
+        self.vocabs = {}
+        self.lookups = {}
+        mmap_mode = 'r' if self.meta['rows'] else None
+        for name,dtype in COLUMNS:
+            setattr(self,name,np.load(str(source.joinpath(f'{name}.npy')),mmap_mode=mmap_mode))
+            if dtype is None:
+                vocab = np.load(str(source.joinpath(f'{name}.vocab.npy')))
+                self.vocabs[name] = vocab
+                self.lookups[name] = {value:idx for idx,value in enumerate(vocab.tolist())}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def code(self,column,value):
+        '''
+        Returns the code of value in a dictionary encoded column, -1 if the
+        value does not occur
+        '''
+        return self.lookups[column].get(value,-1)
+
+    def decode(self,column,codes):
+        '''
+        Returns the string values of the codes of a dictionary encoded column
+        '''
+        return self.vocabs[column][codes]
+
+    def mask(self,country=None,feature_class=None):
+        '''
+        Returns a boolean mask of the rows matching the given country (ISO2)
+        and feature class. None matches everything
+        '''
+        mask = np.ones(len(self),dtype=bool)
+        if country is not None:
+            mask &= self.country == self.code('country',country.upper())
+        if feature_class is not None:
+            mask &= self.feature_class == self.code('feature_class',feature_class.upper())
+        return mask
+
+    def top_populous(self,country=None,n=10,feature_class='P'):
+        '''
+        Returns the geonameids of the n most populous places in a country,
+        largest first
+        '''
+        idx = np.flatnonzero(self.mask(country,feature_class))
+        population = self.population[idx]
+        if len(idx) > n:
+            top = np.argpartition(population,-n)[-n:]
+            idx,population = idx[top],population[top]
+        return self.geonameid[idx[np.argsort(-population,kind='stable')]]
+
+    def in_bbox(self,south,west,north,east):
+        '''
+        Returns a boolean mask of the places inside the bounding box.
+        Boxes crossing the antimeridian (west > east) are supported
+        '''
+        mask = (self.latitude >= south) & (self.latitude <= north)
+        if west <= east:
+            mask &= (self.longitude >= west) & (self.longitude <= east)
+        else:
+            mask &= (self.longitude >= west) | (self.longitude <= east)
+        return mask
+
+    def in_polygon(self,polygon):
+        '''
+        Returns a boolean mask of the places inside polygon, a sequence of
+        (latitude, longitude) vertices. Uses the even-odd rule on the plane,
+        after cutting down to the bounding box of the polygon.
+
+        Edges take the shorter way around, so polygons crossing the
+        antimeridian work. Polygons around a pole (spanning all longitudes)
+        are not supported
+        '''
+        polygon = np.asarray(polygon,dtype=np.float64)
+        lats,lons = polygon[:,0],polygon[:,1]
+        # Unwrap the longitudes so that no edge is longer than 180 degrees
+        steps = (np.diff(lons,append=lons[:1])+180) % 360-180
+        if abs(steps.sum()) > 180:
+            raise ValueError('Polygons around a pole are not supported')
+        lons = lons[0]+np.concatenate([[0],np.cumsum(steps[:-1])])
+        west,east = lons.min(),lons.max()
+        mask = self.in_bbox(lats.min(),(west+180) % 360-180,lats.max(),(east+180) % 360-180)
+        idx = np.flatnonzero(mask)
+        # Shift the places into the longitude range of the polygon
+        y,x = self.latitude[idx],(self.longitude[idx]-west) % 360+west
+
+        inside = np.zeros(len(idx),dtype=bool)
+        for i in range(len(polygon)):
+            y1,x1 = lats[i-1],lons[i-1]
+            y2,x2 = lats[i],lons[i]
+            if y1 == y2:
+                continue
+            crosses = (y1 > y) != (y2 > y)
+            inside ^= crosses & (x < (x2-x1)*(y-y1)/(y2-y1)+x1)
+
+        mask[idx] = inside
+        return mask
+
+    def population_in_bbox(self,south,west,north,east,feature_class='P'):
+        '''
+        Returns the total population of the places of feature_class inside the
+        bounding box
+        '''
+        mask = self.in_bbox(south,west,north,east) & self.mask(feature_class=feature_class)
+        return int(self.population[mask].sum())
+
+    def population_in_polygon(self,polygon,feature_class='P'):
+        '''
+        Returns the total population of the places of feature_class inside
+        the polygon. See in_polygon
+        '''
+        mask = self.in_polygon(polygon) & self.mask(feature_class=feature_class)
+        return int(self.population[mask].sum())
@@ -0,0 +1,262 @@
+"""
+Purpose : Streaming export of the places with resolved names (pynations export)
+
+Writes the geonames places as JSON lines, CSV or TSV (gzip compressed for
+names ending in .gz) with the names of their country, admin1 and admin2
+and the GMT offset of their timezone joined in.
+
+Rows are read in geonameid order in chunks of CHUNKSIZE. Every chunk
+starts after the last geonameid of the previous one (keyset pagination),
+so no read transaction is held over the whole export and memory use does
+not depend on the number of rows.
+
+With partition=True every country is written to its own file in the
+destination directory. The countries are split over processes, each
+making a single pass over the table.
+
+Usage
+-----
+pynations export places.jsonl.gz
+pynations export --country US --country CA --feature-class P places.csv
+pynations export --partition --processes 4 --format tsv exports/
+
+from pynations.export import export_places
+export_places('places.jsonl', countries=['DE'], min_population=1000)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import csv
+import gzip
+import io
+import json
+import sqlite3
+import sys
+import pkg_resources
+
+from pynations import instrument
+
+DBFILE = Path(pkg_resources.resource_filename('pynations','data/pynations.sqlite'))
+
+CHUNKSIZE = 10000
+
+FIELDS = ['geonameid','name','asciiname','latitude','longitude','feature_class','feature_code',
+          'country','country_name','admin1','admin1_name','admin2','admin2_name',
+          'population','elevation','timezone','gmt_offset','modification_date']
+
+FORMATS = ('jsonl','csv','tsv')
+
+# The unary + keeps SQLite on the rowid order rather than the country index,
+# so every chunk continues where the previous one stopped
+EXPORT_QUERY = """select g.geonameid, g.name, g.asciiname, g.latitude, g.longitude,
+                         g.feature_class, g.feature_code, g.country, ci.name,
+                         g.admin1, a1.name, g.admin2, a2.name,
+                         g.population, g.elevation, g.timezone, tz.GMT_offset,
+                         g.modification_date
+                  from geonames g
+                  left join countryinfo ci on ci.iso2 = g.country
+                  left join admincodes a1 on a1.code = g.country||'.'||g.admin1
+                  left join admincodes a2 on a2.code = g.country||'.'||g.admin1||'.'||g.admin2
+                  left join timezones tz on tz.timezoneid = g.timezone
+                  where g.geonameid > ? {filters}
+                  order by g.geonameid
+                  limit ?;"""
+
+def guess_format(filename):
+    '''
+    Returns the format and if the file is gzip compressed from its name
+    '''
+    name = str(filename).lower()
+    compress = name.endswith('.gz')
+    if compress:
+        name = name[:-3]
+    for ext,fmt in (('.tsv','tsv'),('.txt','tsv'),('.jsonl','jsonl'),('.ndjson','jsonl'),('.json','jsonl')):
+        if name.endswith(ext):
+            return fmt,compress
+    return 'csv',compress
+
+def iter_places(conn,countries=None,feature_classes=None,min_population=0,chunksize=CHUNKSIZE):
+    '''
+    Yields the enriched places as lists of values in FIELDS order, in
+    geonameid order, reading chunksize rows per query
+    '''
+    filters = []
+    params = []
+    if countries:
+        filters.append(f"and +g.country in ({','.join('?'*len(countries))})")
+        params += [code.upper() for code in countries]
+    if feature_classes:
+        filters.append(f"and g.feature_class in ({','.join('?'*len(feature_classes))})")
+        params += [fclass.upper() for fclass in feature_classes]
+    if min_population:
+        filters.append('and g.population >= ?')
+        params.append(int(min_population))
+    query = EXPORT_QUERY.format(filters=' '.join(filters))
+
+    last = -1
+    while True:
+        rows = conn.execute(query,[last]+params+[chunksize]).fetchall()
+        if not rows:
+            return
+        yield from rows
+        last = rows[-1][0]
+        if len(rows) < chunksize:
+            return
+
+def open_output(path,compress=None):
+    '''
+    Opens path ('-' for stdout) for writing text, gzip compressed if
+    compress or if the name ends in .gz. Closing a compressed stdout stream
+    finishes the gzip data but leaves stdout open
+    '''
+    if str(path) == '-':
+        if not compress:
+            return sys.stdout
+        sys.stdout.flush()
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=sys.stdout.buffer,mode='wb',compresslevel=6),
+                                encoding='utf-8',newline='')
+    if compress is None:
+        compress = str(path).lower().endswith('.gz')
+    if compress:
+        return io.TextIOWrapper(gzip.open(str(path),'wb',compresslevel=6),encoding='utf-8',newline='')
+    return open(str(path),'w',encoding='utf-8',newline='')
+
+def row_writer(outfile,fmt):
+    '''
+    Writes the header (for csv and tsv) and returns a function writing one
+    row of FIELDS values to outfile
+    '''
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format {fmt}. Use one of {", ".join(FORMATS)}')
+    if fmt == 'jsonl':
+        def write(row):
+            outfile.write(json.dumps(dict(zip(FIELDS,row)),ensure_ascii=False)+'\n')
+        return write
+    writer = csv.writer(outfile,delimiter='\t' if fmt == 'tsv' else ',',lineterminator='\n')
+    writer.writerow(FIELDS)
+    return writer.writerow
+
+def partition_path(directory,country,fmt,compress):
+    return Path(directory).joinpath(f"{country or 'XX'}.{fmt}{'.gz' if compress else ''}")
+
+def country_groups(dbfile,groups,countries=None):
+    '''
+    Splits the countries (all countries with places if None) into at most
+    groups lists with about the same number of places each
+    '''
+    conn = instrument.connect(f'file:{dbfile}?mode=ro',uri=True)
+    try:
+        sizes = dict(conn.execute('select country, sum(features) from featuresummary group by country;'))
+    except sqlite3.OperationalError:
+        sizes = {}
+    if not sizes:
+        sizes = dict(conn.execute('select country, count(*) from geonames group by country;'))
+    conn.close()
+
+    if countries:
+        sizes = {code.upper():sizes.get(code.upper(),0) for code in countries}
+    split = [[] for idx in range(min(groups,len(sizes)) or 1)]
+    totals = [0]*len(split)
+    # Largest countries first, each to the group with the fewest places so far
+    for country in sorted(sizes,key=sizes.get,reverse=True):
+        idx = totals.index(min(totals))
+        split[idx].append(country)
+        totals[idx] += sizes[country]
+    return split
+
+def export_partitions(dbfile,directory,fmt,compress,countries,feature_classes,min_population,chunksize):
+    '''
+    Writes the places of the countries to one file per country in directory
+    in a single pass over the table. Runs in the worker processes when
+    exporting in parallel. Returns the number of rows written per country
+    '''
+    conn = instrument.connect(f'file:{dbfile}?mode=ro',uri=True)
+    outputs = {}
+    counts = {}
+    try:
+        for row in iter_places(conn,countries,feature_classes,min_population,chunksize):
+            country = row[7]
+            if country not in outputs:
+                outfile = open_output(partition_path(directory,country,fmt,compress),compress)
+                outputs[country] = (outfile,row_writer(outfile,fmt))
+                counts[country] = 0
+            outputs[country][1](row)
+            counts[country] += 1
+    finally:
+        for outfile,write in outputs.values():
+            outfile.close()
+        conn.close()
+    return counts
+
+def export_places(destination,fmt=None,compress=None,countries=None,feature_classes=None,
+                  min_population=0,partition=False,processes=None,chunksize=CHUNKSIZE,dbfile=DBFILE):
+    '''
+    Exports the places matching the filters with the resolved names in
+    FIELDS to destination ('-' for stdout) as fmt (jsonl, csv or tsv,
+    guessed from the name by default). compress gzips the output, by
+    default if the name ends in .gz.
+
+    With partition destination is a directory which gets one file per
+    country (<ISO2>.<fmt>[.gz]), written by up to processes workers.
+    Returns the number of rows written
+    '''
+    if not Path(dbfile).exists():
+        raise FileNotFoundError(f'{dbfile} not found. Please run geosqlite.setupdb() first')
+
+    with instrument.stage('export',file=str(destination)) as stats:
+        if partition:
+            if str(destination) == '-':
+                raise ValueError('--partition needs a destination directory')
+            fmt = fmt or 'jsonl'
+            compress = bool(compress)
+            row_writer(io.StringIO(),fmt)   # Fails early on unknown formats
+            Path(destination).mkdir(parents=True,exist_ok=True)
+            counts = {}
+            if processes and processes > 1:
+                groups = country_groups(dbfile,processes,countries)
+                with ProcessPoolExecutor(max_workers=len(groups)) as pool:
+                    futures = [pool.submit(export_partitions,dbfile,destination,fmt,compress,group,
+                                           feature_classes,min_population,chunksize)
+                               for group in groups]
+                    for future in futures:
+                        counts.update(future.result())
+            else:
+                counts = export_partitions(dbfile,destination,fmt,compress,countries,
+                                           feature_classes,min_population,chunksize)
+            stats['files'] = len(counts)
+            stats['rows'] = sum(counts.values())
+            return stats['rows']
+
+        if fmt is None:
+            fmt,guessed = guess_format(destination) if str(destination) != '-' else ('jsonl',False)
+            compress = guessed if compress is None else compress
+        outfile = open_output(destination,compress)
+        conn = instrument.connect(f'file:{dbfile}?mode=ro',uri=True)
+        count = 0
+        try:
+            write = row_writer(outfile,fmt)
+            for row in iter_places(conn,countries,feature_classes,min_population,chunksize):
+                write(row)
+                count += 1
+        finally:
+            conn.close()
+            if outfile is sys.stdout:
+                outfile.flush()
+            else:
+                outfile.close()
+                if str(destination) == '-':
+                    sys.stdout.buffer.flush()
+        stats['rows'] = count
+        return count
+
+def main(args):
+    try:
+        count = export_places(args.destination,args.format,True if args.gzip else None,args.country,
+                              args.feature_class,args.min_population,args.partition,args.processes,
+                              args.chunk_size)
+    except (ValueError,FileNotFoundError) as e:
+        print(f'pynations export: {e}',file=sys.stderr)
+        return 2
+    if args.destination != '-':
+        print(f'Exported {count} places to {args.destination}',file=sys.stderr)
+    return 0
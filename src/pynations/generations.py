@@ -0,0 +1,189 @@
+"""
+Purpose : Blue/green refresh of the pynations database
+
+setupdb() refreshes pynations.sqlite in place, so readers see countries
+disappear while they are reimported and wait on the write transaction.
+refresh() instead builds a new generation of the database next to the live
+one, validates it and promotes it with an atomic rename.
+
+Readers which already hold a connection keep reading the previous
+generation. They move to the new one at their next connection checkout
+(places.connection() and the thread connections of AsyncPyNations and of
+the HTTP server), as those reopen the database once the file was replaced.
+
+The replaced database is kept as pynations.<stamp>.old.sqlite so that it
+can be rolled back to. gc() removes all but the KEEP newest of those.
+
+Once the live database was refreshed, the country files built from it
+(countryinfo.json, countrylookup.json and countrydistances.npz) are
+rebuilt as well. Running processes pick them up at their next lookup.
+rollback() does not rebuild them; run CountryInfo.build_CountryInfo(force=True)
+after rolling back.
+
+Usage
+-----
+from pynations import generations
+generations.refresh()                               <-- setupdb() into a new generation
+generations.refresh(lambda: geosqlite.load_geodata('geonames'))
+generations.rollback()                              <-- Back to the previous generation
+"""
+
+from datetime import datetime
+from pathlib import Path
+import os
+import shutil
+import sqlite3
+import pkg_resources
+
+DBFILE = Path(pkg_resources.resource_filename('pynations','data/pynations.sqlite'))
+
+KEEP = 1    # Previous generations kept for rollback
+
+# Tables a generation needs to have rows in before it is promoted
+REQUIRED_TABLES = ('countryinfo',)
+
+
+class GenerationError(Exception):
+    pass
+
+
+def generation(dbfile=DBFILE):
+    '''
+    Returns a token identifying the file at dbfile, None if there is none.
+    The token changes whenever a new generation is promoted
+    '''
+    try:
+        stat = os.stat(str(dbfile))
+    except FileNotFoundError:
+        return None
+    return (stat.st_dev,stat.st_ino)
+
+def generation_path(kind,dbfile=DBFILE):
+    '''
+    Returns a new file name next to dbfile for a generation being built
+    (kind 'build') or kept after being replaced (kind 'old')
+    '''
+    dbfile = Path(dbfile)
+    stamp = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    return dbfile.with_name(f'{dbfile.stem}.{stamp}.{kind}{dbfile.suffix}')
+
+def old_generations(dbfile=DBFILE):
+    '''
+    Returns the kept generations of dbfile, newest first
+    '''
+    dbfile = Path(dbfile)
+    return sorted(dbfile.parent.glob(f'{dbfile.stem}.*.old{dbfile.suffix}'),reverse=True)
+
+def new_generation(dbfile=DBFILE,copy=True):
+    '''
+    Returns the path of a new generation file. With copy the live database
+    is copied into it (consistently, while readers keep going), so that
+    only the files reimported into it change
+    '''
+    path = generation_path('build',dbfile)
+    if copy and Path(dbfile).exists():
+        source = sqlite3.connect(f'file:{dbfile}?mode=ro',uri=True)
+        try:
+            if hasattr(source,'backup'):
+                target = sqlite3.connect(str(path))
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+            else:
+                # A read transaction keeps writers from committing during the copy
+                source.execute('begin;')
+                source.execute('select count(*) from sqlite_master;').fetchone()
+                shutil.copyfile(str(dbfile),str(path))
+        finally:
+            source.close()
+    return path
+
+def validate(path,tables=REQUIRED_TABLES):
+    '''
+    Checks the integrity of the generation at path and that the tables are
+    not empty. Raises GenerationError otherwise
+    '''
+    conn = sqlite3.connect(f'file:{path}?mode=ro',uri=True)
+    try:
+        result = conn.execute('pragma quick_check;').fetchone()[0]
+        if result != 'ok':
+            raise GenerationError(f'{path} is corrupt: {result}')
+        for table in tables:
+            try:
+                row = conn.execute(f'select 1 from {table} limit 1;').fetchone()
+            except sqlite3.OperationalError as e:
+                raise GenerationError(f'{path}: {e}')
+            if row is None:
+                raise GenerationError(f'{path}: table {table} is empty')
+    finally:
+        conn.close()
+
+def promote(path,dbfile=DBFILE,keep=KEEP):
+    '''
+    Validates the generation at path and atomically makes it the live
+    database. The replaced database is kept as an old generation
+    '''
+    validate(path)
+    dbfile = Path(dbfile)
+    if dbfile.exists():
+        old = generation_path('old',dbfile)
+        try:
+            os.link(str(dbfile),str(old))
+        except OSError:
+            shutil.copy2(str(dbfile),str(old))
+    os.replace(str(path),str(dbfile))
+    gc(keep,dbfile)
+
+def gc(keep=KEEP,dbfile=DBFILE):
+    '''
+    Removes all but the keep newest old generations. Returns the files
+    removed
+    '''
+    removed = old_generations(dbfile)[keep:]
+    for path in removed:
+        os.remove(str(path))
+    return removed
+
+def rollback(dbfile=DBFILE):
+    '''
+    Makes the newest old generation the live database again. The current
+    one is dropped
+    '''
+    kept = old_generations(dbfile)
+    if not kept:
+        raise GenerationError(f'No previous generation of {dbfile} to roll back to')
+    os.replace(str(kept[0]),str(dbfile))
+    return kept[0]
+
+def refresh(loader=None,dbfile=DBFILE,copy=True,keep=KEEP,countryinfo=True):
+    '''
+    Runs loader (geosqlite.setupdb by default) against a new generation of
+    the database and promotes it once it is complete. With copy=False the
+    generation starts empty rather than from a copy of the live database.
+    A failed load or validation leaves the live database untouched.
+    With countryinfo the country files are rebuilt from the new generation
+    if dbfile is the database they are built from.
+    Returns the path of the live database
+    '''
+    from pynations import geosqlite
+    from pynations import CountryInfo
+
+    previous = geosqlite.DBFILE
+    path = new_generation(dbfile,copy)
+    try:
+        geosqlite.use_database(path)
+        geosqlite.connect()
+        (loader or geosqlite.setupdb)()
+        geosqlite.close()
+        promote(path,dbfile,keep)
+    except BaseException:
+        if path.exists():
+            os.remove(str(path))
+        raise
+    finally:
+        geosqlite.use_database(previous)
+
+    if countryinfo and Path(dbfile) == CountryInfo.DBFILE:
+        CountryInfo.build_CountryInfo(force=True)
+    return Path(dbfile)
@@ -12,17 +12,225 @@ ZIPCODES = "http://download.geonames.org/export/zip/"
 ALTNAMES = "http://download.geonames.org/export/dump/alternatenames/"
 
 import requests
+from requests.adapters import HTTPAdapter
 from menu import Menu
 from tqdm import tqdm
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+import json
+import os
+import time
 import pkg_resources
 
 DESTINATION = Path(pkg_resources.resource_filename('pynations','data/geonamesdata'))
 
+CHUNKSIZE = 1024*1024   # 1 MB
+WORKERS = 4
+RETRIES = 3
+BACKOFF = 1.0           # Seconds, doubled on every retry
+TIMEOUT = 60
+
+SUPPORTING_URLS = [GEONAMES + "timeZones.txt",
+                   GEONAMES + "iso-languagecodes.txt",
+                   GEONAMES + "admin1CodesASCII.txt",
+                   GEONAMES + "admin2Codes.txt"]
+
+class DownloadError(Exception):
+    pass
+
+def make_session(workers=WORKERS):
+    '''
+    Returns a requests session whose connection pool can keep a connection
+    alive for each of the workers
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers,pool_maxsize=workers)
+    session.mount('http://',adapter)
+    session.mount('https://',adapter)
+    return session
+
+def country_urls(countries,optionType='G'):
+    '''
+    Returns the (url, filename) pairs of the per country files of optionType
+    (G for geonames, A for altnames, Z for zipcodes)
+    '''
+    base,prefix = {'G':(GEONAMES,'geonames_'),
+                   'A':(ALTNAMES,'altnames_'),
+                   'Z':(ZIPCODES,'zipcodes_')}[optionType]
+    countries = [country.strip().upper() for country in countries if country.strip()]
+    return [(base + country + '.zip',prefix + country + '.zip') for country in countries]
+
+def metadata_path(path):
+    '''
+    Returns the path of the hidden file holding the HTTP validators of a
+    downloaded file. Hidden files are skipped by geosqlite.findFiles
+    '''
+    path = Path(path)
+    return path.with_name('.'+path.name+'.json')
+
+def read_metadata(path):
+    try:
+        with open(str(metadata_path(path))) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+def write_metadata(path,metadata):
+    meta = metadata_path(path)
+    temp = meta.with_name(meta.name+'.tmp')
+    with open(str(temp),'w') as f:
+        json.dump(metadata,f)
+    os.replace(str(temp),str(meta))
+
+def validators(r):
+    return {'etag':r.headers.get('ETag'),
+            'last_modified':r.headers.get('Last-Modified')}
+
+def fetch(session,url,path,chunksize=CHUNKSIZE,retries=RETRIES,backoff=BACKOFF,timeout=TIMEOUT):
+    '''
+    Streams url to path. Returns a tuple of 'downloaded' or 'skipped' and
+    the number of bytes fetched.
+
+    - If path was downloaded before, the request is conditional on the
+      stored ETag/Last-Modified and an unchanged file is skipped.
+    - The data goes to <path>.part, which is renamed to path once complete.
+      An existing .part file from an interrupted transfer is resumed with
+      a Range request, guarded by If-Range so a changed file starts over.
+      A .part which turns out complete (416 with the same size) is kept,
+      one longer than the file is dropped and fetched again.
+
+    Connection errors, streams that die partway and 5xx responses are
+    retried with exponential backoff (resuming where the transfer stopped),
+    other error responses raise DownloadError straight away
+    '''
+    path = Path(path)
+    part = path.with_name(path.name+'.part')
+    fetched = 0
+    attempt = 0
+    while True:
+        metadata = read_metadata(path)
+        # Ranges and lengths have to refer to the bytes as stored
+        headers = {'Accept-Encoding':'identity'}
+        offset = part.stat().st_size if part.exists() else 0
+        if offset and metadata.get('partial') and (metadata.get('etag') or metadata.get('last_modified')):
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = metadata.get('etag') or metadata.get('last_modified')
+        elif path.exists() and not metadata.get('partial') and metadata.get('url') == url:
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+
+        try:
+            with session.get(url,stream=True,timeout=timeout,headers=headers) as r:
+                if r.status_code == 304:
+                    return 'skipped',fetched
+                if r.status_code >= 500:
+                    raise requests.HTTPError(f'{r.status_code} {r.reason}')
+                if r.status_code == 416 and 'Range' in headers:
+                    # Nothing left after offset: the .part is either complete,
+                    # going by the size in Content-Range (bytes */<size>), or
+                    # longer than the file and is fetched again from the start
+                    size = r.headers.get('Content-Range','').rpartition('/')[2]
+                    if size != str(offset):
+                        os.remove(str(part))
+                        continue
+                elif r.status_code not in (200,206):
+                    raise DownloadError(f'{url}: {r.status_code} {r.reason}')
+                else:
+                    if r.status_code == 206:
+                        mode = 'ab'
+                    else:
+                        # A full response, the file changed or ranges are not supported
+                        mode,offset = 'wb',0
+                        write_metadata(path,dict(validators(r),url=url,partial=True))
+
+                    with open(str(part),mode) as f:
+                        for chunk in r.iter_content(chunk_size=chunksize):
+                            if chunk:
+                                f.write(chunk)
+                                fetched += len(chunk)
+
+                    length = r.headers.get('Content-Length')
+                    if length is not None and part.stat().st_size != offset + int(length):
+                        raise requests.ConnectionError('Transfer ended before Content-Length bytes')
+
+            os.replace(str(part),str(path))
+            write_metadata(path,dict(read_metadata(path),partial=False,size=path.stat().st_size))
+            return 'downloaded',fetched
+        except RETRIED as e:
+            attempt += 1
+            if attempt > retries:
+                raise DownloadError(f'{url}: {e}') from e
+            time.sleep(backoff*2**(attempt-1))
+
+# Errors retried by fetch. Streams which die partway raise
+# ChunkedEncodingError, ContentDecodingError or a plain OSError
+RETRIED = (requests.ConnectionError,requests.Timeout,requests.HTTPError,
+           requests.exceptions.ChunkedEncodingError,requests.exceptions.ContentDecodingError,OSError)
+
+def download_files(urls,destination=DESTINATION,workers=WORKERS,chunksize=CHUNKSIZE,
+                    retries=RETRIES,backoff=BACKOFF,session=None,progress=True):
+    '''
+    Downloads many files concurrently over one keep-alive session.
+
+    urls is a list of urls or of (url, filename) pairs. The filename
+    defaults to the last part of the url. Returns a report dictionary with
+    the files downloaded, the files skipped as unchanged, the failures, the
+    bytes fetched, the elapsed time and the aggregate throughput in MB/s
+    '''
+    destination = Path(destination)
+    jobs = [(url,url[url.rfind('/')+1:]) if isinstance(url,str) else tuple(url) for url in urls]
+    session = session or make_session(workers)
+
+    report = {'files':[],'skipped':[],'failed':[],'bytes':0,'seconds':0.0,'MBps':0.0}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fetch,session,url,destination.joinpath(fname),
+                                chunksize,retries,backoff):(url,fname) for url,fname in jobs}
+        for future in tqdm(as_completed(futures),total=len(futures),disable=not progress):
+            url,fname = futures[future]
+            try:
+                status,fetched = future.result()
+                report['bytes'] += fetched
+                report['files' if status == 'downloaded' else 'skipped'].append(fname)
+            except DownloadError as e:
+                report['failed'].append((url,str(e)))
+            except Exception as e:
+                # One broken file must not abort the rest of the batch
+                report['failed'].append((url,f'{url}: {e!r}'))
+
+    report['seconds'] = time.perf_counter() - start
+    if report['seconds'] > 0:
+        report['MBps'] = report['bytes']/report['seconds']/1024/1024
+    if progress:
+        print(f"Downloaded {len(report['files'])} file(s), {report['bytes']/1024/1024:.1f} MB "
+              f"in {report['seconds']:.1f}s ({report['MBps']:.2f} MB/s)")
+        if report['skipped']:
+            print(f"Unchanged, skipped: {', '.join(report['skipped'])}")
+        for url,err in report['failed']:
+            print(f'Failed: {err}')
+    return report
+
+def download_countries(countries,optionType='G',**kwargs):
+    '''
+    Non interactive download of the per country files. See country_urls and
+    download_files for the arguments
+    '''
+    return download_files(country_urls(countries,optionType),**kwargs)
+
+def download_supporting_info(**kwargs):
+    '''
+    Non interactive download of the countryInfo file and the supporting
+    files (timezones, languages, admin1 and admin2 codes)
+    '''
+    return download_files([GEONAMES + "countryInfo.txt"] + SUPPORTING_URLS,**kwargs)
+
 class GeonamesDownloader:
     def __init__(self):
         self.countries = []
-        self.CHUNKSIZE = 2048
+        self.CHUNKSIZE = CHUNKSIZE
 
         geonames_options = [
             ("Specify Country code(s)", self.download_countries,{'optionType':'G'}),
@@ -85,34 +293,16 @@ class GeonamesDownloader:
         """
 
         self.countries = input("Enter Country code(s) <US,GB ..>: ").upper().split(',')
-        fname = ''
-        err = ''
-
-        for country in tqdm(self.countries):
-            country = country.strip()
+        report = download_countries(self.countries,optionType or 'Z',chunksize=self.CHUNKSIZE)
 
+        for url,err in report['failed']:
+            country = url[url.rfind('/')+1:].replace('.zip','')
             if optionType == 'G':
-                url = GEONAMES + country + '.zip'
-                fname = 'geonames_'+country+'.zip'
-                err = f'Geonames information for {country} not found'
+                print(f'Geonames information for {country} not found')
             elif optionType == 'A':
-                url = ALTNAMES + country + '.zip'
-                fname = 'altnames_'+country+'.zip'
-                err = f'Alternate name information for {country} not found'
+                print(f'Alternate name information for {country} not found')
             else:
-                url = ZIPCODES + country + '.zip'
-                fname = 'zipcodes_'+country+'.zip'
-                err = f'Zipcode information for {country} not found'
-
-            r = requests.get(url,stream=True)
-
-            if r.status_code == 200:
-                with open(str(DESTINATION.joinpath(fname)),'wb') as f:
-                    for chunk in r.iter_content(chunk_size=self.CHUNKSIZE):
-                        if chunk:
-                            f.write(chunk)
-            else:
-                print(err)
+                print(f'Zipcode information for {country} not found')
 
         if optionType == 'G':
             self.geonames_menu.set_message(f'>> Geonames download for {self.countries} completed <<\n\nPlease select an option')
@@ -148,13 +338,7 @@ class GeonamesDownloader:
             self.zipcodes_menu.set_message(f'>> Zipcode download for all countries completed <<\n\nPlease select an option')
 
         print(f'Downloading data from {url} and saving to {fname}')
-
-        r = requests.get(url,stream=True)
-        if r.status_code == 200:
-            with open(str(DESTINATION.joinpath(fname)),'wb') as f:
-                for chunk in tqdm(r.iter_content(chunk_size=self.CHUNKSIZE)):
-                    if chunk:
-                        f.write(chunk)
+        download_files([(url,fname)],workers=1,chunksize=self.CHUNKSIZE)
 
     def download_all_countryinfo(self):
         """
@@ -177,17 +361,7 @@ class GeonamesDownloader:
             3. admin2 codes
         """
 
-        urls = ["http://download.geonames.org/export/dump/timeZones.txt",
-                "http://download.geonames.org/export/dump/iso-languagecodes.txt",
-                "http://download.geonames.org/export/dump/admin1CodesASCII.txt",
-                "http://download.geonames.org/export/dump/admin2Codes.txt"]
-        for url in urls:
-            print(f'Downloading {url} ...')
-            fname = url[url.rfind('/')+1:]
-            r = requests.get(url)
-            if r.status_code == 200:
-                with open(str(DESTINATION.joinpath(fname)),'w') as f:
-                    f.write(r.content.decode('utf-8'))
+        download_files(SUPPORTING_URLS,chunksize=self.CHUNKSIZE)
         self.main_menu.set_message('>> Download completed for supporting info. <<\n\nPlease select an option')
 
     def run(self):
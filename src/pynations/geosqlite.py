@@ -7,11 +7,15 @@ Purpose : Load the geonames data to SQLite tables
 
 from tqdm import tqdm
 from pathlib import Path
-import sqlite3
+import hashlib
 import os
+import shutil
+import subprocess
 from zipfile import ZipFile
 import pkg_resources
 
+from pynations import instrument
+
 SOURCE = Path(pkg_resources.resource_filename('pynations','data/geonamesdata'))
 DBFILE = Path(pkg_resources.resource_filename('pynations','data/pynations.sqlite'))
 
@@ -20,6 +24,39 @@ try:
 except:
     COLS = 80
 
+def shell(cmd):
+    '''
+    Runs a shell command and returns its exit code. The import commands use
+    bash syntax ($'..' and <<<), so bash is used where /bin/sh is another
+    shell (dash on Debian and Ubuntu)
+    '''
+    return subprocess.call(cmd,shell=True,executable=shutil.which('bash'))
+
+def import_file(fname,table,quote=True):
+    '''
+    Imports the tab separated file fname into table with the sqlite3 shell.
+    With quote the fields are quoted first (sed), as the geonames files
+    contain stray double quotes. Both steps are reported as stages (see
+    pynations.instrument). Returns the exit code of the import
+    '''
+    connect()   # The sqlite3 shell imports into the existing tables
+    quoted = str(SOURCE.joinpath('quoted.txt'))
+    with instrument.stage(f'{table}.quote',file=Path(fname).name) as stats:
+        if quote:
+            cmd = f"""sed $'s/"/""/g;s/[^\t]*/"&"/g' {fname} > {quoted} """
+        else:
+            cmd = f"""sed $'/^#/d' {fname} > {quoted} """
+        rc = shell(cmd)
+        stats['bytes'] = os.path.getsize(fname)
+        stats['rc'] = rc
+
+    with instrument.stage(f'{table}.import',file=Path(fname).name) as stats:
+        cmd = f""" sqlite3 {DBFILE} <<< ".mode tabs\n.import {quoted} {table}" """
+        rc = shell(cmd)
+        stats['rows_inserted'],stats['bytes'] = instrument.count_lines(quoted) if rc == 0 else (0,0)
+        stats['rc'] = rc
+    return rc
+
 def findFiles(directory='.',exts=None,recursive=True,returnString=True):
     '''
         Find files inside a given directory. The file types can be given as a string or list.
@@ -45,142 +82,255 @@ def findFiles(directory='.',exts=None,recursive=True,returnString=True):
     else:
         return [str(p) for p in files]
 
-# Connecting to the SQLite db File. If it doesn't exist then the command
-# will create it
-dbexists = DBFILE.exists()
-conn = sqlite3.connect(str(DBFILE))
-c = conn.cursor()
+# Offsets are stored in hours. timezoneid is the key used by geonames.timezone
+TIMEZONES_TABLE = """create table timezones   (country TEXT,
+                                                timezoneid TEXT PRIMARY KEY,
+                                                GMT_offset REAL,
+                                                DST_offset REAL,
+                                                RAW_offset REAL) WITHOUT ROWID;"""
 
-if not dbexists:    # Now we need to create the tables
-    print('-'*COLS)
-    print("BUILDING PYNATION TABLES".center(COLS))
-    print('-'*COLS)
+# Connection to DBFILE, opened by connect() on first use so that importing
+# the module does not create a database
+conn = None
+c = None
 
-    with conn:
-        c.execute("""create table geonames   (geonameid INTEGER PRIMARY KEY,
-                                              name TEXT,
-                                              asciiname TEXT,
-                                              alternatenames TEXT,
-                                              latitude DECIMAL(10,7),
-                                              longitude DECIMAL(10,7),
-                                              feature_class TEXT,
-                                              feature_code TEXT,
-                                              country TEXT,
-                                              cc2 TEXT,
-                                              admin1 TEXT,
-                                              admin2 TEXT,
-                                              admin3 TEXT,
-                                              admin4 TEXT,
-                                              population INTEGER,
-                                              elevation INTEGER,
-                                              dem INTEGER,
-                                              timezone TEXT,
-                                              modification_date DATETIME);""")
-
-        c.execute("create index onname on geonames(name);")
-        c.execute("create index onasciiname on geonames(asciiname);")
-        c.execute("create index onaltnames on geonames(alternatenames);")
-        print(" GEONAMES - TABLE BUILD COMPLETE ".center(COLS,'-'))
-
-        c.execute("""create table zipcodes (country TEXT,
-                                            zipcode TEXT,
-                                            place_name TEXT,
-                                            state_name TEXT,
-                                            state_code TEXT,
-                                            county_name TEXT,
-                                            county_code TEXT,
-                                            community_name TEXT,
-                                            community_code TEXT,
-                                            latitude DECIMAL(10,7),
-                                            longitude DECIMAL(10,7),
-                                            accuracy INTEGER);""")
-
-        c.execute("create index zipcode on zipcodes(zipcode);")
-        c.execute("create index zipcountry on zipcodes(country);")
-        c.execute("create index zipnames on zipcodes(place_name);")
-        print(" ZIPCODES - TABLE BUILD COMPLETE ".center(COLS,'-'))
-
-        c.execute("""create table altnames (alternateNameId INTEGER PRIMARY KEY,
-                                            geonameId INTEGER,
-                                            isolanguage TEXT,
-                                            alternate_name TEXT,
-                                            isPreferredName INTEGER,
-                                            isShortName INTEGER,
-                                            isColloquial INTEGER,
-                                            isHistoric INTEGER,
-                                            from_date TEXT,
-                                            to_date TEXT);""")
-
-        c.execute("create index altnames_idx on altnames(alternate_name);")
-        c.execute("create index altnames_idx2 on altnames(geonameId);")
-
-        print(" ALTNAMES - TABLE BUILD COMPLETE ".center(COLS,'-'))
-
-        c.execute("""create table countryinfo  (iso2 TEXT PRIMARY KEY,
-                                                iso3 TEXT,
-                                                iso_numeric INTEGER,
-                                                fips_code TEXT,
-                                                name TEXT,
-                                                capital TEXT,
-                                                area REAL,
-                                                population INTEGER,
-                                                continent TEXT,
-                                                tld TEXT,
-                                                currency TEXT,
-                                                currencyName TEXT,
-                                                phone TEXT,
-                                                zipcode_format TEXT,
-                                                zipcode_regex TEXT,
-                                                languages TEXT,
-                                                geonameId INTEGER,
-                                                neighbours TEXT,
-                                                equivalent_fipscode TEXT);""")
+def connect():
+    '''
+    Opens DBFILE unless it is open already, creating the file and the
+    tables if needed. Returns the connection
+    '''
+    global conn,c
+
+    if conn is None:
+        exists = DBFILE.exists()
+        conn = instrument.connect(str(DBFILE))
+        c = conn.cursor()
+        create_tables(not exists)
+    return conn
+
+def close():
+    '''
+    Closes the connection to DBFILE. The next load reopens it
+    '''
+    global conn,c
 
-        c.execute("create index iso_3 on countryinfo(iso3);")
-        print(" COUNTRYINFO - TABLE BUILD COMPLETE ".center(COLS,'-'))
+    if conn is not None:
+        conn.close()
+    conn = c = None
 
-        c.execute("""create table countryaltnames (alternateNameId INTEGER PRIMARY KEY,
+def create_tables(new):
+    '''
+    Creates the pynations tables in the database conn is connected to.
+    new is True for a database file which did not exist yet
+    '''
+    if new:    # Now we need to create the tables
+        print('-'*COLS)
+        print("BUILDING PYNATION TABLES".center(COLS))
+        print('-'*COLS)
+
+        with conn:
+            c.execute("""create table geonames   (geonameid INTEGER PRIMARY KEY,
+                                                  name TEXT,
+                                                  asciiname TEXT,
+                                                  alternatenames TEXT,
+                                                  latitude DECIMAL(10,7),
+                                                  longitude DECIMAL(10,7),
+                                                  feature_class TEXT,
+                                                  feature_code TEXT,
+                                                  country TEXT,
+                                                  cc2 TEXT,
+                                                  admin1 TEXT,
+                                                  admin2 TEXT,
+                                                  admin3 TEXT,
+                                                  admin4 TEXT,
+                                                  population INTEGER,
+                                                  elevation INTEGER,
+                                                  dem INTEGER,
+                                                  timezone TEXT,
+                                                  modification_date DATETIME);""")
+
+            c.execute("create index onname on geonames(name);")
+            c.execute("create index onasciiname on geonames(asciiname);")
+            c.execute("create index onaltnames on geonames(alternatenames);")
+            print(" GEONAMES - TABLE BUILD COMPLETE ".center(COLS,'-'))
+
+            c.execute("""create table zipcodes (country TEXT,
+                                                zipcode TEXT,
+                                                place_name TEXT,
+                                                state_name TEXT,
+                                                state_code TEXT,
+                                                county_name TEXT,
+                                                county_code TEXT,
+                                                community_name TEXT,
+                                                community_code TEXT,
+                                                latitude DECIMAL(10,7),
+                                                longitude DECIMAL(10,7),
+                                                accuracy INTEGER);""")
+
+            c.execute("create index zipcode on zipcodes(zipcode);")
+            c.execute("create index zipcountry on zipcodes(country);")
+            c.execute("create index zipnames on zipcodes(place_name);")
+            print(" ZIPCODES - TABLE BUILD COMPLETE ".center(COLS,'-'))
+
+            c.execute("""create table altnames (alternateNameId INTEGER PRIMARY KEY,
+                                                geonameId INTEGER,
+                                                isolanguage TEXT,
+                                                alternate_name TEXT,
+                                                isPreferredName INTEGER,
+                                                isShortName INTEGER,
+                                                isColloquial INTEGER,
+                                                isHistoric INTEGER,
+                                                from_date TEXT,
+                                                to_date TEXT);""")
+
+            c.execute("create index altnames_idx on altnames(alternate_name);")
+            c.execute("create index altnames_idx2 on altnames(geonameId);")
+
+            print(" ALTNAMES - TABLE BUILD COMPLETE ".center(COLS,'-'))
+
+            c.execute("""create table countryinfo  (iso2 TEXT PRIMARY KEY,
+                                                    iso3 TEXT,
+                                                    iso_numeric INTEGER,
+                                                    fips_code TEXT,
+                                                    name TEXT,
+                                                    capital TEXT,
+                                                    area REAL,
+                                                    population INTEGER,
+                                                    continent TEXT,
+                                                    tld TEXT,
+                                                    currency TEXT,
+                                                    currencyName TEXT,
+                                                    phone TEXT,
+                                                    zipcode_format TEXT,
+                                                    zipcode_regex TEXT,
+                                                    languages TEXT,
                                                     geonameId INTEGER,
-                                                    isolanguage TEXT,
-                                                    alternate_name TEXT,
-                                                    isPreferredName INTEGER,
-                                                    isShortName INTEGER,
-                                                    isColloquial INTEGER,
-                                                    isHistoric INTEGER,
-                                                    from_date TEXT,
-                                                    to_date TEXT);""")
-
-        c.execute("create index caltnames_idx on countryaltnames(alternate_name);")
-        c.execute("create index caltnames_idx2 on countryaltnames(geonameId);")
-        print(" COUNTRYALTNAMES - TABLE BUILD COMPLETE ".center(COLS,'-'))
-
-        c.execute("""create table admincodes   (code TEXT PRIMARY KEY,
-                                                name TEXT,
-                                                asciiname TEXT,
-                                                geonameId INTEGER);""")
-
-        c.execute("create index admincode_idx1 on admincodes(geonameId);")
-        c.execute("create index admincode_idx2 on admincodes(name);")
-        print(" ADMINCODES - TABLE BUILD COMPLETE ".center(COLS,'-'))
-
-        c.execute("""create table timezones   (country TEXT,
-                                                timezoneid TEXT,
-                                                GMT_offset TEXT,
-                                                DST_offset TEXT,
-                                                RAW_offset TEXT);""")
-
-        c.execute("create index timezones_idx1 on timezones(country);")
-        print(" TIMEZONES - TABLE BUILD COMPLETE ".center(COLS,'-'))
-
-        c.execute("""create table languages   (ISO639_3 TEXT,
-                                                ISO639_2 TEXT,
-                                                ISO639_1 TEXT,
-                                                language TEXT);""")
-
-        c.execute("create index languages_idx1 on languages(ISO639_2);")
-        print(" LANGUAGES - TABLE BUILD COMPLETE ".center(COLS,'-'))
-
-        print(' PYNATION TABLE BUILD COMPLETE '.center(COLS,'#'))
+                                                    neighbours TEXT,
+                                                    equivalent_fipscode TEXT);""")
+
+            c.execute("create index iso_3 on countryinfo(iso3);")
+            print(" COUNTRYINFO - TABLE BUILD COMPLETE ".center(COLS,'-'))
+
+            c.execute("""create table countryaltnames (alternateNameId INTEGER PRIMARY KEY,
+                                                        geonameId INTEGER,
+                                                        isolanguage TEXT,
+                                                        alternate_name TEXT,
+                                                        isPreferredName INTEGER,
+                                                        isShortName INTEGER,
+                                                        isColloquial INTEGER,
+                                                        isHistoric INTEGER,
+                                                        from_date TEXT,
+                                                        to_date TEXT);""")
+
+            c.execute("create index caltnames_idx on countryaltnames(alternate_name);")
+            c.execute("create index caltnames_idx2 on countryaltnames(geonameId);")
+            print(" COUNTRYALTNAMES - TABLE BUILD COMPLETE ".center(COLS,'-'))
+
+            c.execute("""create table admincodes   (code TEXT PRIMARY KEY,
+                                                    name TEXT,
+                                                    asciiname TEXT,
+                                                    geonameId INTEGER);""")
+
+            c.execute("create index admincode_idx1 on admincodes(geonameId);")
+            c.execute("create index admincode_idx2 on admincodes(name);")
+            print(" ADMINCODES - TABLE BUILD COMPLETE ".center(COLS,'-'))
+
+            c.execute(TIMEZONES_TABLE)
+            c.execute("create index timezones_idx1 on timezones(country);")
+            print(" TIMEZONES - TABLE BUILD COMPLETE ".center(COLS,'-'))
+
+            c.execute("""create table languages   (ISO639_3 TEXT,
+                                                    ISO639_2 TEXT,
+                                                    ISO639_1 TEXT,
+                                                    language TEXT);""")
+
+            c.execute("create index languages_idx1 on languages(ISO639_2);")
+            print(" LANGUAGES - TABLE BUILD COMPLETE ".center(COLS,'-'))
+
+            print(' PYNATION TABLE BUILD COMPLETE '.center(COLS,'#'))
+
+    # Tables derived from the imported data. These use "if not exists" so that
+    # databases built by older versions pick them up as well
+    with conn:
+        c.execute("""create table if not exists preferrednames (geonameId INTEGER,
+                                                                isolanguage TEXT,
+                                                                name TEXT,
+                                                                isPreferredName INTEGER,
+                                                                isShortName INTEGER,
+                                                                PRIMARY KEY (geonameId, isolanguage))
+                                                                WITHOUT ROWID;""")
+        c.execute("create index if not exists ontimezone on geonames(timezone);")
+        # Covers pynations.places.find_places: the places are filtered and
+        # ranked in the index, only the rows returned are read from the table.
+        # asciiname is repeated at the end as SQLite only treats an expression
+        # index as covering if the columns of the expression are in it too.
+        # find_places pins it with INDEXED BY, as the planner would otherwise
+        # pick oncountry for lookups within a country
+        c.execute("""create index if not exists onplacekey on geonames(lower(asciiname),country,admin1,
+                                                                     feature_class,population DESC,asciiname);""")
+        # Places of a country by feature class, largest first. Serves
+        # build_summaries and the per country deletes of remove_existing
+        c.execute("create index if not exists oncountry on geonames(country,feature_class,population DESC);")
+        # Summaries of the places of every country, see build_summaries
+        c.execute("""create table if not exists featuresummary (country TEXT,
+                                                                feature_class TEXT,
+                                                                features INTEGER,
+                                                                population INTEGER,
+                                                                PRIMARY KEY (country, feature_class))
+                                                                WITHOUT ROWID;""")
+        c.execute("""create table if not exists adminsummary (country TEXT,
+                                                              admin1 TEXT,
+                                                              features INTEGER,
+                                                              places INTEGER,
+                                                              population INTEGER,
+                                                              PRIMARY KEY (country, admin1))
+                                                              WITHOUT ROWID;""")
+        c.execute("""create table if not exists topplaces (country TEXT,
+                                                           rank INTEGER,
+                                                           geonameid INTEGER,
+                                                           name TEXT,
+                                                           admin1 TEXT,
+                                                           population INTEGER,
+                                                           latitude REAL,
+                                                           longitude REAL,
+                                                           PRIMARY KEY (country, rank))
+                                                           WITHOUT ROWID;""")
+        c.execute("""create table if not exists topadminplaces (country TEXT,
+                                                                admin1 TEXT,
+                                                                rank INTEGER,
+                                                                geonameid INTEGER,
+                                                                name TEXT,
+                                                                population INTEGER,
+                                                                latitude REAL,
+                                                                longitude REAL,
+                                                                PRIMARY KEY (country, admin1, rank))
+                                                                WITHOUT ROWID;""")
+        c.execute("""create table if not exists capitals (country TEXT PRIMARY KEY,
+                                                          geonameid INTEGER,
+                                                          name TEXT,
+                                                          population INTEGER,
+                                                          latitude REAL,
+                                                          longitude REAL);""")
+        # Size and content hash of every source file imported, so that
+        # unchanged files are skipped the next time (see check_source)
+        c.execute("""create table if not exists sourcefiles (filename TEXT PRIMARY KEY,
+                                                             size INTEGER,
+                                                             sha1 TEXT,
+                                                             imported DATETIME);""")
+
+def use_database(path):
+    '''
+    Points the loaders at the database file path. It is opened (and the
+    tables created) on first use. Used to build a new generation next to
+    the live database (see pynations.generations)
+    '''
+    global DBFILE
+
+    close()
+    DBFILE = Path(path)
+
+# isolanguage values in altnames which are not languages
+NONLANGUAGES = ('','link','wkdt','post','iata','icao','faac','abbr','unlc','tcid','fr_1793')
 
 # Check and import the data
 files = findFiles(SOURCE,recursive=False)
@@ -189,28 +339,160 @@ if files == []:
     print('No files to import')
     exit(1)
 
-def load_countryinfo():
+def source_digest(fname,profile=None):
+    '''
+    Returns the size and sha1 of the source file fname. The import profile
+    the file is filtered with is part of the hash
+    '''
+    sha1 = hashlib.sha1()
+    with open(fname,'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024),b''):
+            sha1.update(chunk)
+    if profile:
+        sha1.update(profile.fingerprint().encode())
+    return (os.path.getsize(fname),sha1.hexdigest())
+
+def source_unchanged(fname,digest):
+    '''
+    True if the source file fname with digest was imported before
+    '''
+    connect()
+    c.execute('SELECT size, sha1 FROM sourcefiles WHERE filename = ?;',(Path(fname).name,))
+    return c.fetchone() == tuple(digest)
+
+def skip_source(fname):
+    print(f'Skipping {Path(fname).name}, unchanged since the last import')
+    instrument.emit('skip',file=Path(fname).name)
+
+def check_source(fname,force=False,profile=None):
+    '''
+    Returns the (size, sha1) of the source file fname, or None if it is byte
+    identical to the file imported last time with the same profile (unless
+    force). Pass the result to record_source once the file is imported
+    '''
+    digest = source_digest(fname,profile)
+    if not force and source_unchanged(fname,digest):
+        skip_source(fname)
+        return None
+    return digest
+
+def record_source(fname,digest):
+    '''
+    Remembers the (size, sha1) of the imported source file fname
+    '''
+    with connect():
+        c.execute("INSERT OR REPLACE INTO sourcefiles VALUES (?,?,?,datetime('now'));",
+                  (Path(fname).name,)+tuple(digest))
+
+def load_countryinfo(force=False):
+    '''
+    Imports countryInfo.txt unless it is unchanged since the last import.
+    Returns True if it was imported
+    '''
     countryinfopath = str(SOURCE.joinpath("countryInfo.txt"))
-    if  countryinfopath in files:
+    digest = None
+    if countryinfopath in files:
+        digest = check_source(countryinfopath,force)
+    if digest:
         print('='*COLS)
         print("Loading countryInfo file to db")
         print('='*COLS)
         print("Removing existing entries ...")
-        with conn:
+        with instrument.stage('countryinfo.delete') as stats, conn:
             c.execute(f'DELETE FROM countryinfo;')
+            stats['rows_deleted'] = c.rowcount
         print("Importing data ...")
-        cmd = f"""sed $'/^#/d' {countryinfopath} > {str(SOURCE.joinpath("temp.txt"))} """
-        rc = os.system(cmd)
-
-        cmd = f""" sqlite3 {DBFILE} <<< ".mode tabs\n.import {str(SOURCE.joinpath("temp.txt"))} countryinfo" """
-        rc = os.system(cmd)
+        rc = import_file(countryinfopath,'countryinfo',quote=False)
         if rc == 0:
             print(f'Data import successful for countryinfo')
+            record_source(countryinfopath,digest)
         else:
             print(f'Data import failed with {rc} for countryinfo')
         print('#'*COLS)
+        return rc == 0
+    return False
 
-def load_geodata(recordtype):
+# Number of columns in the geonames files of each table
+COLUMNS = {'geonames':19,'zipcodes':12,'altnames':10}
+
+def remove_existing(recordtype,countrycode):
+    '''
+    Deletes the rows of a country (ISO2) from the table recordtype before it
+    is reimported. allCountries deletes every row. Returns the number of
+    rows deleted. The caller commits
+    '''
+    if countrycode == 'allCountries':
+        c.execute(f'DELETE FROM {recordtype};')
+    elif recordtype != 'altnames':
+        c.execute(f'DELETE FROM {recordtype} WHERE country = :value;',{'value':countrycode})
+    else:
+        c.execute(f'DELETE FROM {recordtype} WHERE geonameId IN (SELECT geonameId from geonames WHERE country = :value);',{'value':countrycode})
+    return c.rowcount
+
+def insert_rows(recordtype,rows):
+    '''
+    Inserts rows (lists of the text fields of a geonames file) into the
+    table recordtype. The caller commits
+    '''
+    c.executemany(f"INSERT OR REPLACE INTO {recordtype} VALUES ({','.join('?'*COLUMNS[recordtype])});",rows)
+
+# Rows per insert when streaming a file into the database
+BATCHSIZE = 5000
+
+def import_stream(file,member,recordtype,countrycode,profile=None):
+    '''
+    Streams member of the zip archive file (or file itself if member is
+    None) into the table recordtype, replacing the rows of countrycode. Rows
+    outside of profile (see pynations.profiles) are dropped before they are
+    inserted. Runs in a single transaction and returns the rows inserted
+    '''
+    from pynations.pipeline import iter_rows
+
+    connect()
+    keep = profile.predicate(recordtype) if profile else None
+    with instrument.stage(f'{recordtype}.stream',file=Path(file).name) as stats:
+        archive = ZipFile(file,'r') if member else None
+        f = archive.open(member) if archive else open(file,'rb')
+        read = inserted = 0
+        try:
+            with conn:
+                stats['rows_deleted'] = remove_existing(recordtype,countrycode)
+                batch = []
+                for row in iter_rows(iter(lambda: f.read(1024*1024),b''),COLUMNS[recordtype]):
+                    read += 1
+                    if keep is None or keep(row):
+                        batch.append(row)
+                        if len(batch) >= BATCHSIZE:
+                            insert_rows(recordtype,batch)
+                            inserted += len(batch)
+                            batch = []
+                insert_rows(recordtype,batch)
+                inserted += len(batch)
+        finally:
+            f.close()
+            if archive:
+                archive.close()
+        stats.update(bytes=os.path.getsize(file),rows_read=read,rows_inserted=inserted)
+    return inserted
+
+def populate_countryaltnames():
+    '''
+    Copies the alternate names of the countries from altnames to
+    countryaltnames. Returns the number of rows copied. The caller commits
+    '''
+    print(f'Populating countryaltnames table')
+    connect()
+    c.execute('DELETE FROM countryaltnames;')
+    c.execute("INSERT INTO countryaltnames SELECT * from altnames where geonameid in (select geonameid from countryinfo);")
+    return c.rowcount
+
+def load_geodata(recordtype,force=False,profile=None):
+    '''
+    Imports the per country zip files of recordtype. Files which are
+    unchanged since the last import and countries outside of profile are
+    skipped. Returns the country codes imported
+    '''
+    imported = []
     #Find if there are any geoname Files
     geofiles = [file for file in files if file.find(f'{recordtype}_') > -1 and
                                             file.endswith('.zip')]
@@ -221,86 +503,72 @@ def load_geodata(recordtype):
         print('='*COLS)
 
         for file in tqdm(geofiles):
-            # Unzip the file and extract the text files
             idx = file.find(f'{recordtype}_')
             countrycode = file[idx:].replace(f'{recordtype}_','').replace('.zip','')
             infile = f'{countrycode}.txt'
-            outfile = f'{recordtype}_'+infile
 
-            with ZipFile(file, 'r') as zipObj:
-                # Get a list of all archived file names from the zip
-                print(f'Unzipping {infile} ...')
-                zipObj.extract(infile,str(SOURCE))
-                os.rename(str(SOURCE.joinpath(infile)),
-                            str(SOURCE.joinpath(outfile)))
-
-            print("Removing existing entries ...")
-            with conn:
-                if recordtype != 'altnames':
-                    c.execute(f'DELETE FROM {recordtype} WHERE country = :value;',{'value':countrycode})
-                else:
-                    c.execute(f'DELETE FROM {recordtype} WHERE geonameId IN (SELECT geonameId from geonames WHERE country = :value);',{'value':countrycode})
-
-            print("Importing data ...")
-            cmd = f"""sed $'s/"/""/g;s/[^\t]*/"&"/g' {str(SOURCE.joinpath(outfile))} > {str(SOURCE.joinpath('quoted.txt'))} """
-            #print(SOURCE.joinpath(outfile).resolve())
-            rc = os.system(cmd)
-
-            cmd = f""" sqlite3 {DBFILE} <<< ".mode tabs\n.separator \\t\n.import {str(SOURCE.joinpath('quoted.txt'))} {recordtype}" """
-            #print(cmd)
-            #rc=0
-            rc = os.system(cmd)
-            if rc == 0:
-                print(f'Data import successful for {infile}')
-                os.remove(str(SOURCE.joinpath(outfile)))
-            else:
-                print(f'Data import failed with {rc} for {infile}')
+            if profile and not profile.wants_country(countrycode):
+                continue
+            digest = check_source(file,force,profile)
+            if digest is None:
+                continue
+
+            # The text file is read straight out of the archive
+            print(f'Importing {infile} ...')
+            try:
+                rows = import_stream(file,infile,recordtype,countrycode,profile)
+            except Exception as e:
+                print(f'Data import failed for {infile}: {e}')
+                continue
+            print(f'Data import successful for {infile}, {rows} rows')
+            record_source(file,digest)
+            imported.append(countrycode)
         print('#'*COLS)
+    return imported
 
 
-def load_all_geodata(filename):
-
+def load_all_geodata(filename,force=False,profile=None):
+    '''
+    Imports an all countries file (alternateNamesV2.zip) unless it is
+    unchanged since the last import. With profile, the alternate names are
+    filtered on the places imported before. Returns True if it was imported
+    '''
     file = str(SOURCE.joinpath(filename))
     infile = str(Path(filename).with_suffix('.txt'))
-    recordtype = ''
-
-    # if the filename ends with zip, extract the files
-    if file.lower().endswith('.zip'):
-        with ZipFile(file, 'r') as zipObj:
-            # Get a list of all archived file names from the zip
-            print(f'Unzipping {file} ...')
-            zipObj.extract(infile,str(SOURCE))
-
-    print("Removing existing entries ...")
-    with conn:
-        if filename.lower().startswith('alternatenamesv2'):
-            recordtype = 'altnames'
-            c.execute(f'DELETE FROM altnames;')
 
-    if recordtype == '':
+    if not Path(file).exists():
+        return False
+    if not filename.lower().startswith('alternatenamesv2'):
         exit()
+    recordtype = 'altnames'
+
+    digest = check_source(file,force,profile)
+    if digest is None:
+        return False
+    if profile:
+        profile.prepare(connect())
+
+    print(f'Importing {infile} ...')
+    member = infile if file.lower().endswith('.zip') else None
+    try:
+        rows = import_stream(file,member,recordtype,'allCountries',profile)
+    except Exception as e:
+        print(f'Data import failed for {infile}: {e}')
+        print('#'*COLS)
+        return False
 
-    print("Importing data ...")
-    cmd = f"""sed $'s/"/""/g;s/[^\t]*/"&"/g' {str(SOURCE.joinpath(infile))} > {str(SOURCE.joinpath('quoted.txt'))} """
-    rc = os.system(cmd)
-
-    cmd = f""" sqlite3 {DBFILE} <<< ".mode tabs\n.separator \\t\n.import {str(SOURCE.joinpath('quoted.txt'))} {recordtype}" """
-    rc = os.system(cmd)
-    if rc == 0:
-        print(f'Data import successful for {infile}')
-        os.remove(str(SOURCE.joinpath(infile)))
-
-        print(f'Populating countryaltnames table')
-        #Populate country altnames
-        caltnamequery = "INSERT INTO countryaltnames SELECT * from altnames where geonameid in (select geonameid from countryinfo);"
-        with conn:
-            c.execute('DELETE FROM countryaltnames;')
-            c.execute(caltnamequery)
-    else:
-        print(f'Data import failed with {rc} for {infile}')
+    print(f'Data import successful for {infile}, {rows} rows')
+    with instrument.stage('countryaltnames.build') as stats, conn:
+        stats['rows_inserted'] = populate_countryaltnames()
+    record_source(file,digest)
     print('#'*COLS)
+    return True
 
-def load_admincodes():
+def load_admincodes(force=False):
+    '''
+    Imports the admin1 and admin2 codes. Both are reimported if either
+    changed since the last import. Returns True if they were imported
+    '''
     files = ['admin1CodesASCII.txt','admin2Codes.txt']
 
     fnames = []
@@ -310,91 +578,251 @@ def load_admincodes():
         if Path(fname).exists():
             fnames.append(fname)
 
-    if fnames != []:
+    if fnames == []:
+        return False
+
+    connect()
+    digests = [source_digest(fname) for fname in fnames]
+    if force or not all(source_unchanged(fname,digest) for fname,digest in zip(fnames,digests)):
+        imported = True
         #Remove existing records
         print("Deleting existing data ...")
-        with conn:
+        with instrument.stage('admincodes.delete') as stats, conn:
             c.execute('DELETE FROM admincodes;')
+            stats['rows_deleted'] = c.rowcount
 
         print("Importing data ...")
-        for fname in fnames:
-            cmd = f"""sed $'s/"/""/g;s/[^\t]*/"&"/g' {fname} > {str(SOURCE.joinpath('quoted.txt'))} """
-            #print(SOURCE.joinpath(outfile).resolve())
-            rc = os.system(cmd)
-
-            cmd = f""" sqlite3 {DBFILE} <<< ".mode tabs\n.separator \\t\n.import {str(SOURCE.joinpath('quoted.txt'))} admincodes" """
-            #print(cmd)
-            #rc=0
-            rc = os.system(cmd)
+        for fname,digest in zip(fnames,digests):
+            rc = import_file(fname,'admincodes')
             if rc == 0:
                 print(f'Data import successful for {fname}')
+                record_source(fname,digest)
             else:
                 print(f'Data import failed with {rc} for {fname}')
-    print('#'*COLS)
-
-def load_timezones():
+                imported = False
+        print('#'*COLS)
+        return imported
+    for fname in fnames:
+        skip_source(fname)
+    return False
 
+def load_timezones(force=False):
+    '''
+    Imports timeZones.txt unless it is unchanged since the last import.
+    Returns True if it was imported
+    '''
     file = "timeZones.txt"
+    fname = str(SOURCE.joinpath(file))
 
-    if Path(SOURCE.joinpath(file)).exists():
+    digest = check_source(fname,force) if Path(fname).exists() else None
+    if digest:
         #Remove existing records
-        fname = str(SOURCE.joinpath(file))
         print("Deleting existing data ...")
-        with conn:
-            c.execute('DELETE FROM timezones;')
+        with instrument.stage('timezones.delete'), conn:
+            # The table is recreated so that databases which still have
+            # the offsets as TEXT are moved to the numeric model
+            c.execute('DROP TABLE IF EXISTS timezones;')
+            c.execute(TIMEZONES_TABLE)
+            c.execute("create index timezones_idx1 on timezones(country);")
 
         print("Importing data ...")
-        cmd = f"""sed $'s/"/""/g;s/[^\t]*/"&"/g' {fname} > {str(SOURCE.joinpath('quoted.txt'))} """
-        #print(SOURCE.joinpath(outfile).resolve())
-        rc = os.system(cmd)
-
-        cmd = f""" sqlite3 {DBFILE} <<< ".mode tabs\n.separator \\t\n.import {str(SOURCE.joinpath('quoted.txt'))} timezones" """
-        #print(cmd)
-        #rc=0
-        rc = os.system(cmd)
-        if rc == 0:
-            print(f'Data import successful for {file}')
-        else:
-            print(f'Data import failed with {rc} for {file}')
-    print('#'*COLS)
+        with instrument.stage('timezones.import',file=file) as stats:
+            rows = []
+            with open(fname,encoding='utf-8') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    #Skipping the header and blank lines
+                    if len(fields) < 5 or fields[0] == 'CountryCode':
+                        continue
+                    rows.append((fields[0],fields[1],float(fields[2]),
+                                    float(fields[3]),float(fields[4])))
 
-def load_languages():
+            with conn:
+                c.executemany('INSERT OR REPLACE INTO timezones VALUES (?,?,?,?,?);',rows)
+            stats['rows_inserted'] = len(rows)
+            stats['bytes'] = os.path.getsize(fname)
+        print(f'Data import successful for {file}')
+        record_source(fname,digest)
+        print('#'*COLS)
+        return True
+    return False
 
+def load_languages(force=False):
+    '''
+    Imports iso-languagecodes.txt unless it is unchanged since the last
+    import. Returns True if it was imported
+    '''
     file = "iso-languagecodes.txt"
+    fname = str(SOURCE.joinpath(file))
 
-    if Path(SOURCE.joinpath(file)).exists():
+    digest = check_source(fname,force) if Path(fname).exists() else None
+    if digest:
         #Remove existing records
-        fname = str(SOURCE.joinpath(file))
         print("Deleting existing data ...")
-        with conn:
+        with instrument.stage('languages.delete') as stats, conn:
             c.execute('DELETE FROM languages;')
+            stats['rows_deleted'] = c.rowcount
 
         print("Importing data ...")
-        cmd = f"""sed $'s/"/""/g;s/[^\t]*/"&"/g' {fname} > {str(SOURCE.joinpath('quoted.txt'))} """
-        #print(SOURCE.joinpath(outfile).resolve())
-        rc = os.system(cmd)
-
-        cmd = f""" sqlite3 {DBFILE} <<< ".mode tabs\n.separator \\t\n.import {str(SOURCE.joinpath('quoted.txt'))} languages" """
-        #print(cmd)
-        #rc=0
-        rc = os.system(cmd)
+        rc = import_file(fname,'languages')
         if rc == 0:
             print(f'Data import successful for {file}')
+            record_source(fname,digest)
         else:
             print(f'Data import failed with {rc} for {file}')
+        print('#'*COLS)
+        return rc == 0
+    return False
+
+def build_preferrednames():
+    '''
+    Materializes the preferred name of every geonameid in every language
+    into the preferrednames table, one row per (geonameId, isolanguage).
+
+    The name picked for a language follows the chain
+        preferred name -> short name -> any other name
+    where colloquial and historic names are only used as a last resort.
+    The final fallback to the default geonames name is done while querying
+    (see pynations.places.localized_names)
+    '''
+    print('='*COLS)
+    print("Building preferred names")
+    print('='*COLS)
+
+    query = f"""INSERT INTO preferrednames
+                SELECT geonameId, isolanguage, alternate_name,
+                       isPreferredName, isShortName
+                FROM (SELECT geonameId, isolanguage, alternate_name,
+                             isPreferredName = 1 AS isPreferredName,
+                             isShortName = 1 AS isShortName,
+                             row_number() OVER (
+                                PARTITION BY geonameId, isolanguage
+                                ORDER BY isPreferredName = 1 DESC,
+                                         isShortName = 1 DESC,
+                                         isColloquial = 1,
+                                         isHistoric = 1,
+                                         alternateNameId) AS rank
+                      FROM altnames
+                      WHERE isolanguage NOT IN ({','.join('?' for i in NONLANGUAGES)}))
+                WHERE rank = 1;"""
+
+    with instrument.stage('preferrednames.build') as stats, connect():
+        c.execute('DELETE FROM preferrednames;')
+        stats['rows_deleted'] = c.rowcount
+        c.execute(query,NONLANGUAGES)
+        stats['rows_inserted'] = c.rowcount
     print('#'*COLS)
 
-def setupdb():
-    load_countryinfo()
-    load_timezones()
-    load_languages()
-    load_admincodes()
+# Places kept per country and per admin1 in topplaces and topadminplaces
+TOPK = 100
 
-    for recordtype in ['geonames','zipcodes']:
-        load_geodata(recordtype)
+SUMMARY_TABLES = ('featuresummary','adminsummary','topplaces','topadminplaces','capitals')
+
+def build_summaries(countries=None):
+    '''
+    Refreshes the summary tables for the countries (ISO2 codes) given, or
+    for all of them if countries is None:
+        featuresummary  features and population per feature class
+        adminsummary    features, populated places and their population per admin1
+        topplaces       TOPK most populous places of the country
+        topadminplaces  TOPK most populous places of every admin1
+        capitals        the capital (PPLC, or the place named as capital in
+                        countryinfo) and its coordinates
+    '''
+    print('='*COLS)
+    print("Building summaries")
+    print('='*COLS)
 
-    for filename in ['alternateNamesV2.zip']:
-        load_all_geodata(filename)
+    if countries is None:
+        where,params = '',[]
+    else:
+        countries = sorted(set(countries))
+        where,params = f"WHERE country IN ({','.join('?'*len(countries))})",countries
+    where_and = where.replace('WHERE','AND')
+    where_iso2 = where.replace('country','iso2')
+
+    ranked = """SELECT country, admin1, geonameid, name, population, latitude, longitude,
+                       row_number() OVER (PARTITION BY {partition}
+                                          ORDER BY population DESC, geonameid) AS rank
+                FROM geonames WHERE feature_class = 'P' {filter}"""
+
+    with instrument.stage('summaries.build',countries=len(countries) if countries else 'all'), connect():
+        for table in SUMMARY_TABLES:
+            c.execute(f'DELETE FROM {table} {where};',params)
+
+        c.execute(f"""INSERT INTO featuresummary
+                      SELECT country, feature_class, count(*), sum(population)
+                      FROM geonames {where} GROUP BY country, feature_class;""",params)
+        c.execute(f"""INSERT INTO adminsummary
+                      SELECT country, admin1, count(*), sum(feature_class = 'P'),
+                             sum(CASE WHEN feature_class = 'P' THEN population ELSE 0 END)
+                      FROM geonames {where} GROUP BY country, admin1;""",params)
+        c.execute(f"""INSERT INTO topplaces
+                      SELECT country, rank, geonameid, name, admin1, population, latitude, longitude
+                      FROM ({ranked.format(partition='country',filter=where_and)})
+                      WHERE rank <= ?;""",params+[TOPK])
+        c.execute(f"""INSERT INTO topadminplaces
+                      SELECT country, admin1, rank, geonameid, name, population, latitude, longitude
+                      FROM ({ranked.format(partition='country, admin1',filter=where_and)})
+                      WHERE rank <= ?;""",params+[TOPK])
+        c.execute(f"""INSERT INTO capitals
+                      SELECT iso2, geonameid, name, population, latitude, longitude
+                      FROM (SELECT iso2,
+                                   (SELECT geonameid FROM geonames
+                                    WHERE country = iso2 AND feature_class = 'P' AND
+                                          (feature_code = 'PPLC' OR name = capital)
+                                    ORDER BY feature_code = 'PPLC' DESC, population DESC
+                                    LIMIT 1) AS capitalid
+                            FROM countryinfo {where_iso2}) AS ci
+                      JOIN geonames ON geonames.geonameid = ci.capitalid;""",params)
+    print('#'*COLS)
+
+def setupdb(columnar=False,force=False,profile=None):
+    '''
+    Imports all the downloaded files to the database. Files which are byte
+    identical to the ones imported last time are skipped, unless force.
+    profile (see pynations.profiles) limits the places, zipcodes and
+    alternate names imported.
+    With columnar=True a NumPy snapshot of the geonames table is exported
+    afterwards (see pynations.columnar). Every step is reported as a stage,
+    see pynations.instrument
+    '''
+    with instrument.stage('setupdb'):
+        connect()
+        countryinfo = load_countryinfo(force)
+        load_timezones(force)
+        load_languages(force)
+        load_admincodes(force)
+
+        geonames = load_geodata('geonames',force,profile)
+        load_geodata('zipcodes',force,profile)
+
+        c.execute('SELECT 1 FROM featuresummary LIMIT 1;')
+        if countryinfo or force or 'allCountries' in geonames or c.fetchone() is None:
+            build_summaries()
+        elif geonames:
+            build_summaries(geonames)
+
+        altnames = False
+        for filename in ['alternateNamesV2.zip']:
+            altnames = load_all_geodata(filename,force or bool(geonames and profile),profile) or altnames
+
+        if countryinfo and not altnames:
+            with conn:
+                populate_countryaltnames()
+
+        c.execute('SELECT 1 FROM preferrednames LIMIT 1;')
+        if altnames or force or c.fetchone() is None:
+            build_preferrednames()
+
+        if columnar:
+            from pynations.columnar import COLUMNARDIR
+            from pynations.columnar import export_columnar
+            if geonames or force or not COLUMNARDIR.exists():
+                print('Exporting columnar snapshot ...')
+                with instrument.stage('columnar.export') as stats:
+                    rows = stats['rows'] = export_columnar(DBFILE)
+                print(f'{rows} rows exported')
 
 def main():
     setupdb()
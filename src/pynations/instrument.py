@@ -0,0 +1,195 @@
+"""
+Purpose : Timings, counters and SQL tracing for pynations
+
+Every measurement is an event, a dictionary with at least an 'event' key.
+Events are logged on the 'pynations' logger and passed to the registered
+hooks, so they can be scraped into any metrics system.
+
+stage       A timed step of the importer: 'stage', 'seconds' and, where
+            known, 'file', 'rows', 'rows_per_s', 'bytes', 'rows_deleted'
+            and 'rows_inserted'
+sql         One statement on a traced connection: 'sql', 'seconds',
+            'rowcount'. Only emitted while SQL tracing is on
+
+Lookups (CountryInfo) are not emitted one by one. They are counted, with
+a latency histogram, in metrics() instead.
+
+Usage
+-----
+from pynations import instrument
+instrument.add_hook(print)              <-- Any callable taking the event
+instrument.trace_sql(True)              <-- Or set PYNATIONS_TRACE_SQL=1
+instrument.metrics()                    <-- Lookup counters and histograms
+"""
+
+from contextlib import contextmanager
+from threading import Lock
+import bisect
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger('pynations')
+
+_hooks = []
+_trace = os.environ.get('PYNATIONS_TRACE_SQL','') not in ('','0')
+
+def add_hook(hook):
+    '''
+    Registers hook, a callable which is called with every event
+    '''
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+def remove_hook(hook):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+def emit(event,**fields):
+    '''
+    Sends an event to the logger and the hooks
+    '''
+    fields = dict(event=event,**fields)
+    level = logging.DEBUG if event == 'sql' else logging.INFO
+    if logger.isEnabledFor(level):
+        logger.log(level,' '.join(f'{key}={value}' for key,value in fields.items()),extra={'pynations':fields})
+    for hook in list(_hooks):
+        hook(fields)
+
+@contextmanager
+def stage(name,**fields):
+    '''
+    Times the enclosed block and emits it as a stage event. The block can
+    add fields (rows, bytes, rows_deleted ...) to the yielded dictionary.
+    rows_per_s is worked out from rows or rows_inserted
+    '''
+    fields = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        seconds = time.perf_counter() - start
+        rows = fields.get('rows',fields.get('rows_inserted'))
+        if rows and seconds > 0:
+            fields['rows_per_s'] = round(rows/seconds,1)
+        emit('stage',stage=name,seconds=round(seconds,6),**fields)
+
+def count_lines(path,chunksize=1024*1024):
+    '''
+    Returns the number of lines and bytes of a file
+    '''
+    lines = 0
+    size = 0
+    last = b'\n'
+    with open(str(path),'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize),b''):
+            lines += chunk.count(b'\n')
+            size += len(chunk)
+            last = chunk[-1:]
+    if last != b'\n':
+        lines += 1
+    return lines,size
+
+def trace_sql(enabled=True):
+    '''
+    Turns the per statement sql events of connections made with connect()
+    on or off
+    '''
+    global _trace
+    _trace = enabled
+
+def tracing():
+    return _trace
+
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self,sql,*args):
+        if not _trace:
+            return super().execute(sql,*args)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql,*args)
+        finally:
+            emit('sql',sql=' '.join(sql.split())[:200],seconds=round(time.perf_counter()-start,6),
+                 rowcount=self.rowcount)
+
+    def executemany(self,sql,*args):
+        if not _trace:
+            return super().executemany(sql,*args)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql,*args)
+        finally:
+            emit('sql',sql=' '.join(sql.split())[:200],seconds=round(time.perf_counter()-start,6),
+                 rowcount=self.rowcount,many=True)
+
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self,factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self,sql,*args):
+        return self.cursor().execute(sql,*args)
+
+    def executemany(self,sql,*args):
+        return self.cursor().executemany(sql,*args)
+
+
+def connect(database,**kwargs):
+    '''
+    sqlite3.connect() returning a connection whose statements are timed
+    while SQL tracing is on
+    '''
+    return sqlite3.connect(database,factory=TracedConnection,**kwargs)
+
+
+# Upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.00001,0.00005,0.0001,0.0005,0.001,0.005,0.01,0.05,0.1,0.5,1.0,float('inf'))
+
+
+class Histogram:
+    def __init__(self,buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self,seconds):
+        self.counts[bisect.bisect_left(self.buckets,seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def snapshot(self):
+        return {'count':self.count,'sum':self.total,
+                'buckets':{str(bound):count for bound,count in zip(self.buckets,self.counts)}}
+
+
+_lock = Lock()
+_counters = {}
+_histograms = {}
+
+def observe(name,seconds,outcome):
+    '''
+    Counts a lookup of name with the outcome ('hit' or 'miss') and records
+    its latency
+    '''
+    with _lock:
+        key = f'{name}.{outcome}'
+        _counters[key] = _counters.get(key,0) + 1
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        _histograms[name].observe(seconds)
+
+def metrics():
+    '''
+    Returns the lookup counters and latency histograms
+    '''
+    with _lock:
+        return {'counters':dict(_counters),
+                'histograms':{name:hist.snapshot() for name,hist in _histograms.items()}}
+
+def reset_metrics():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
@@ -0,0 +1,417 @@
+"""
+Purpose : Stream geonames downloads straight into the database
+
+The files are not downloaded, extracted, quoted and imported one after the
+other. Instead, for every file
+    - a fetch thread streams the HTTP response (optionally keeping a copy
+      of the archive),
+    - a parse thread inflates the zip member on the fly and splits it into
+      batches of rows,
+    - the calling thread inserts the batches with the geosqlite loaders.
+The stages are joined by bounded queues, so network, decompression and
+database writes overlap while memory stays flat. Each file is imported in
+a single transaction, so a failed transfer leaves the previous data in
+place. The files are streamed into a new generation of the database, which
+replaces the live one once all of them were imported (see
+pynations.generations).
+
+Usage
+-----
+from pynations import pipeline
+pipeline.stream_countries(['US', 'GB'], 'G')        <-- geonames_US, geonames_GB
+pipeline.stream_all('A', keep_archive=True)         <-- alternateNamesV2.zip
+pipeline.stream_all('G', profile=ImportProfile(feature_classes=['P', 'A']))
+"""
+
+from pathlib import Path
+import hashlib
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+from pynations import instrument
+from pynations.geodownloader import CHUNKSIZE
+from pynations.geodownloader import DESTINATION
+from pynations.geodownloader import GEONAMES
+from pynations.geodownloader import TIMEOUT
+from pynations.geodownloader import ZIPCODES
+from pynations.geodownloader import DownloadError
+from pynations.geodownloader import country_urls
+from pynations.geodownloader import make_session
+
+BATCHSIZE = 5000    # Rows per insert
+QUEUESIZE = 16      # Chunks or batches buffered between two stages
+
+RECORDTYPES = {'G':'geonames','A':'altnames','Z':'zipcodes'}
+
+ALL_URLS = {'G':(GEONAMES + 'allCountries.zip','geonames_allCountries.zip'),
+            'A':(GEONAMES + 'alternateNamesV2.zip','alternateNamesV2.zip'),
+            'Z':(ZIPCODES + 'allCountries.zip','zipcodes_allCountries.zip')}
+
+_EOF = object()
+
+
+class QueueReader:
+    '''
+    File like object reading the byte chunks put on a queue. _EOF ends the
+    stream and exceptions put on the queue are raised to the reader
+    '''
+    def __init__(self,chunks):
+        self.chunks = chunks
+        self.buffer = bytearray()
+        self.eof = False
+
+    def read(self,size):
+        while len(self.buffer) < size and not self.eof:
+            chunk = self.chunks.get()
+            if chunk is _EOF:
+                self.eof = True
+            elif isinstance(chunk,BaseException):
+                raise chunk
+            else:
+                self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def unread(self,data):
+        self.buffer[:0] = data
+
+    def read_exactly(self,size):
+        data = self.read(size)
+        if len(data) != size:
+            raise zlib.error('Unexpected end of zip stream')
+        return data
+
+
+def zip_members(stream,chunksize=CHUNKSIZE):
+    '''
+    Reads a zip archive sequentially from stream (see QueueReader) using the
+    local file headers, without needing the central directory at the end.
+    Yields (name, chunks) for every member, chunks being an iterator over
+    the uncompressed data. The CRC of every member is verified
+    '''
+    while True:
+        header = stream.read(30)
+        if len(header) < 30 or header[:4] != b'PK\x03\x04':
+            return  # Central directory reached
+
+        (flags,method,crc,csize,usize,namelen,extralen) = struct.unpack('<6xHH4xIIIHH',header)
+        name = stream.read_exactly(namelen).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = stream.read_exactly(extralen)
+
+        zip64 = False
+        pos = 0
+        while pos + 4 <= len(extra):
+            tag,size = struct.unpack('<HH',extra[pos:pos+4])
+            if tag == 0x0001:
+                zip64 = True
+                fields = extra[pos+4:pos+4+size]
+                if usize == 0xFFFFFFFF:
+                    usize,fields = struct.unpack('<Q',fields[:8])[0],fields[8:]
+                if csize == 0xFFFFFFFF:
+                    csize = struct.unpack('<Q',fields[:8])[0]
+            pos += 4 + size
+
+        if method not in (0,8) or (method == 0 and flags & 0x08):
+            raise zlib.error(f'Unsupported zip compression for {name}')
+
+        state = {'crc':0}
+
+        def chunks():
+            if method == 8:
+                inflater = zlib.decompressobj(-15)
+                while not inflater.eof:
+                    data = stream.read(chunksize)
+                    if not data:
+                        raise zlib.error('Unexpected end of zip stream')
+                    out = inflater.decompress(data)
+                    if out:
+                        state['crc'] = zlib.crc32(out,state['crc'])
+                        yield out
+                stream.unread(inflater.unused_data)
+            else:
+                remaining = csize
+                while remaining:
+                    out = stream.read_exactly(min(chunksize,remaining))
+                    remaining -= len(out)
+                    state['crc'] = zlib.crc32(out,state['crc'])
+                    yield out
+
+        data = chunks()
+        yield name,data
+        # Skip whatever the caller did not read
+        for chunk in data:
+            pass
+
+        if flags & 0x08:
+            signature = stream.read_exactly(4)
+            size = 16 if zip64 else 8
+            if signature == b'PK\x07\x08':
+                crc = struct.unpack('<I',stream.read_exactly(4))[0]
+            else:
+                crc = struct.unpack('<I',signature)[0]
+            stream.read_exactly(size)
+
+        if state['crc'] != crc:
+            raise zlib.error(f'CRC mismatch for {name}')
+
+
+def iter_rows(chunks,columns):
+    '''
+    Splits the uncompressed chunks of a tab separated geonames file into
+    rows of exactly columns text fields
+    '''
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield split_row(line,columns)
+    if pending:
+        yield split_row(pending,columns)
+
+def split_row(line,columns):
+    fields = line.decode('utf-8').rstrip('\r').split('\t')
+    if len(fields) < columns:
+        fields += ['']*(columns-len(fields))
+    return fields[:columns]
+
+
+class StreamJob:
+    '''
+    Fetches url and parses member of the zip archive into row batches in
+    background threads. batches() yields them as they become available.
+    keep, a predicate on the rows (see ImportProfile.predicate), drops rows
+    before they are queued.
+
+    With archive set, the raw download is also written to that path
+    (through a .part file renamed on completion)
+    '''
+    def __init__(self,url,recordtype,member,countrycode,session,archive=None,
+                 chunksize=CHUNKSIZE,batchsize=BATCHSIZE,columns=None,keep=None):
+        self.url = url
+        self.recordtype = recordtype
+        self.member = member
+        self.countrycode = countrycode
+        self.session = session
+        self.archive = archive
+        self.chunksize = chunksize
+        self.batchsize = batchsize
+        self.columns = columns
+        self.keep = keep
+        self.chunks = queue.Queue(QUEUESIZE)
+        self.rows = queue.Queue(QUEUESIZE)
+        self.stopped = threading.Event()
+        self.bytes = 0
+        self.sha1 = hashlib.sha1()
+
+    def digest(self,profile=None):
+        '''
+        Returns the (size, sha1) of the download once it is complete, as
+        geosqlite.source_digest does for a downloaded file
+        '''
+        sha1 = self.sha1.copy()
+        if profile:
+            sha1.update(profile.fingerprint().encode())
+        return (self.bytes,sha1.hexdigest())
+
+    def start(self):
+        threading.Thread(target=self.fetch,daemon=True).start()
+        threading.Thread(target=self.parse,daemon=True).start()
+        return self
+
+    def put(self,target,item):
+        # Gives up when the consumer went away
+        while not self.stopped.is_set():
+            try:
+                target.put(item,timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch(self):
+        archive = None
+        try:
+            with self.session.get(self.url,stream=True,timeout=TIMEOUT,
+                                  headers={'Accept-Encoding':'identity'}) as r:
+                if r.status_code != 200:
+                    raise DownloadError(f'{self.url}: {r.status_code} {r.reason}')
+                if self.archive:
+                    archive = open(str(self.archive)+'.part','wb')
+                for chunk in r.iter_content(chunk_size=self.chunksize):
+                    if chunk:
+                        self.bytes += len(chunk)
+                        self.sha1.update(chunk)
+                        if archive:
+                            archive.write(chunk)
+                        if not self.put(self.chunks,chunk):
+                            return
+            if archive:
+                archive.close()
+                archive = None
+                os.replace(str(self.archive)+'.part',str(self.archive))
+            self.put(self.chunks,_EOF)
+        except Exception as e:
+            self.put(self.chunks,e)
+        finally:
+            if archive:
+                archive.close()
+
+    def parse(self):
+        try:
+            found = False
+            for name,chunks in zip_members(QueueReader(self.chunks),self.chunksize):
+                if name != self.member:
+                    continue
+                found = True
+                batch = []
+                for row in iter_rows(chunks,self.columns):
+                    if self.keep and not self.keep(row):
+                        continue
+                    batch.append(row)
+                    if len(batch) >= self.batchsize:
+                        if not self.put(self.rows,batch):
+                            return
+                        batch = []
+                if batch:
+                    self.put(self.rows,batch)
+            if not found:
+                raise DownloadError(f'{self.member} not found in {self.url}')
+            self.put(self.rows,_EOF)
+        except Exception as e:
+            self.put(self.rows,e)
+
+    def batches(self):
+        try:
+            while True:
+                batch = self.rows.get()
+                if batch is _EOF:
+                    return
+                if isinstance(batch,BaseException):
+                    raise batch
+                yield batch
+        finally:
+            self.stopped.set()
+
+
+def stream(jobs,workers=2,keep_archive=False,session=None,batchsize=BATCHSIZE,profile=None,dbfile=None):
+    '''
+    Streams jobs, a list of (url, filename, optionType) tuples, into a new
+    generation of the database dbfile (the live database by default), which
+    is promoted once every file was streamed (see pynations.generations).
+    Readers keep reading the previous generation until then. Up to workers
+    files are fetched and parsed ahead while the current one is written.
+    Returns a report with the rows imported per file and the failures.
+    Every file is also reported as a stage (see pynations.instrument)
+
+    Rows outside of profile (see pynations.profiles) are dropped as they are
+    parsed
+    '''
+    from pynations import generations
+
+    report = {}
+    generations.refresh(lambda: report.update(stream_jobs(jobs,workers,keep_archive,session,batchsize,profile)),
+                        dbfile or generations.DBFILE)
+    return report
+
+def stream_jobs(jobs,workers=2,keep_archive=False,session=None,batchsize=BATCHSIZE,profile=None):
+    '''
+    Streams jobs into the database geosqlite is pointed at, in place. See
+    stream, which runs this against a new generation.
+
+    The places and zipcodes are streamed before the alternate names, as the
+    alternate names kept by a profile depend on the places imported. Every
+    file is imported in its own transaction and recorded in sourcefiles
+    '''
+    from pynations import geosqlite
+
+    session = session or make_session(workers)
+    conn = geosqlite.connect()
+    report = {'rows':{},'failed':[],'bytes':0,'seconds':0.0}
+    start = time.perf_counter()
+    altnames = False
+    countries = []
+
+    for kinds in (('G','Z'),('A',)):
+        if profile and 'A' in kinds and any(optionType == 'A' for url,fname,optionType in jobs):
+            profile.prepare(conn)
+        pending = []
+        for url,fname,optionType in jobs:
+            if optionType not in kinds:
+                continue
+            recordtype = RECORDTYPES[optionType]
+            stem = Path(fname).stem
+            if stem == 'alternateNamesV2':
+                countrycode,member = 'allCountries','alternateNamesV2.txt'
+            else:
+                countrycode = stem.replace(f'{recordtype}_','')
+                member = Path(url).stem + '.txt'
+            if profile and not profile.wants_country(countrycode):
+                continue
+            archive = DESTINATION.joinpath(fname) if keep_archive else None
+            keep = profile.predicate(recordtype) if profile else None
+            pending.append((fname,StreamJob(url,recordtype,member,countrycode,session,archive,
+                                            batchsize=batchsize,columns=geosqlite.COLUMNS[recordtype],keep=keep)))
+
+        for fname,job in pending[:workers]:
+            job.start()
+
+        for idx,(fname,job) in enumerate(pending):
+            print(f'Streaming {job.url} into {job.recordtype} ...')
+            rows = 0
+            with instrument.stage(f'{job.recordtype}.stream',file=Path(job.url).name) as stats:
+                try:
+                    stats['rows_deleted'] = geosqlite.remove_existing(job.recordtype,job.countrycode)
+                    for batch in job.batches():
+                        geosqlite.insert_rows(job.recordtype,batch)
+                        rows += len(batch)
+                    # Commits the rows along with the source file
+                    geosqlite.record_source(fname,job.digest(profile))
+                    report['rows'][job.url] = rows
+                    altnames = altnames or job.recordtype == 'altnames'
+                    if job.recordtype == 'geonames':
+                        countries.append(job.countrycode)
+                    print(f'Data import successful for {job.url}, {rows} rows')
+                except Exception as e:
+                    conn.rollback()
+                    report['failed'].append((job.url,str(e)))
+                    stats['error'] = str(e)
+                    rows = 0
+                    print(f'Data import failed for {job.url}: {e}')
+                stats['rows_inserted'] = rows
+                stats['bytes'] = job.bytes
+            report['bytes'] += job.bytes
+
+            if idx + workers < len(pending):
+                pending[idx+workers][1].start()
+
+        if countries and kinds == ('G','Z'):
+            geosqlite.build_summaries(None if 'allCountries' in countries else countries)
+
+    if altnames:
+        with instrument.stage('countryaltnames.build') as stats, conn:
+            stats['rows_inserted'] = geosqlite.populate_countryaltnames()
+        geosqlite.build_preferrednames()
+
+    report['seconds'] = time.perf_counter() - start
+    return report
+
+def stream_countries(countries,optionType='G',**kwargs):
+    '''
+    Streams the per country files of optionType (G geonames, A altnames,
+    Z zipcodes) into the database. See stream
+    '''
+    return stream([(url,fname,optionType) for url,fname in country_urls(countries,optionType)],**kwargs)
+
+def stream_all(optionType='G',**kwargs):
+    '''
+    Streams the all-in-one file of optionType into the database. See stream
+    '''
+    url,fname = ALL_URLS[optionType]
+    return stream([(url,fname,optionType)],**kwargs)
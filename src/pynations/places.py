@@ -0,0 +1,226 @@
+"""
+Purpose : Place level lookups against the pynations database
+
+Note: The database needs to be built before using these functions.
+Import geodownloader and run download() and import geosqlite and
+run setupdb() first
+"""
+
+from pathlib import Path
+import sqlite3
+import threading
+import pkg_resources
+from unidecode import unidecode
+
+from pynations import instrument
+from pynations.generations import generation
+
+DBFILE = Path(pkg_resources.resource_filename('pynations','data/pynations.sqlite'))
+
+# SQLite versions before 3.32 allow at most 999 host parameters per query
+BATCHSIZE = 900
+
+_local = threading.local()
+
+def connection():
+    '''
+    Returns the read only connection of the calling thread to the pynations
+    database. The connection is opened on first use and reopened once a new
+    generation of the database was promoted (see pynations.generations).
+    Every thread has its own connection, so the previous one can be closed
+    right away and does not keep the replaced generation file open
+    '''
+    conn = getattr(_local,'conn',None)
+    current = generation(DBFILE)
+    if conn is None or current != _local.generation:
+        if current is None:
+            raise FileNotFoundError(f'{DBFILE} not found. Please import geodownloader and run download() '
+                                    'and import geosqlite and run setupdb() before executing this')
+        if conn is not None:
+            conn.close()
+        conn = _local.conn = instrument.connect(f'file:{DBFILE}?mode=ro',uri=True)
+        _local.generation = current
+    return conn
+
+def batches(items,size=BATCHSIZE):
+    '''
+    Splits a list into lists of at most size items
+    '''
+    for i in range(0,len(items),size):
+        yield items[i:i+size]
+
+PLACE_COLUMNS = ['geonameid','name','asciiname','latitude','longitude',
+                 'feature_class','feature_code','country','admin1','admin2',
+                 'population','timezone']
+
+ZIPCODE_COLUMNS = ['country','zipcode','place_name','state_name','state_code',
+                   'county_name','county_code','community_name','community_code',
+                   'latitude','longitude','accuracy']
+
+def search_places(name,country=None,feature_class=None,limit=10,conn=None):
+    '''
+    Returns the places named name (or with that ascii name) as a list of
+    dictionaries, largest first
+    '''
+    query = f"select {','.join(PLACE_COLUMNS)} from geonames where (name = ? or asciiname = ?)"
+    params = [name,name]
+    if country:
+        query += ' and country = ?'
+        params.append(country.upper())
+    if feature_class:
+        query += ' and feature_class = ?'
+        params.append(feature_class.upper())
+    query += ' order by population desc limit ?;'
+    params.append(limit)
+    rows = (conn or connection()).execute(query,params)
+    return [dict(zip(PLACE_COLUMNS,row)) for row in rows]
+
+def normalize(name):
+    '''
+    Returns the key find_places matches on: the ascii transliteration of
+    name in lower case, as in geonames.asciiname
+    '''
+    return unidecode(name).strip().lower()
+
+def find_places(name,country=None,admin1=None,feature_class=None,limit=10,conn=None):
+    '''
+    Returns the places called name as a list of dictionaries, largest
+    first. The name is matched ignoring case and accents. country (ISO2),
+    admin1 (code, e.g. 'IL') and feature_class narrow the search down.
+
+    The places are picked and ranked from the onplacekey index alone
+    (see geosqlite), only the rows returned are read from the table. The
+    index is pinned so that the planner does not switch to oncountry
+
+    Usage
+    -----
+    find_places('springfield', 'US', 'IL', 'P', limit=1)
+    '''
+    where = ['lower(asciiname) = ?']
+    params = [normalize(name)]
+    for column,value in (('country',country),('admin1',admin1),('feature_class',feature_class)):
+        if value:
+            where.append(f'{column} = ?')
+            params.append(value.upper())
+    params.append(limit)
+
+    query = f"""select {','.join('g.'+column for column in PLACE_COLUMNS)}
+                from (select geonameid, population from geonames {{indexed}}
+                      where {' and '.join(where)}
+                      order by population desc limit ?) k
+                join geonames g on g.geonameid = k.geonameid
+                order by k.population desc;"""
+    conn = conn or connection()
+    try:
+        rows = conn.execute(query.format(indexed='indexed by onplacekey'),params).fetchall()
+    except sqlite3.OperationalError as e:
+        # Databases built before the index was added
+        if 'no such index' not in str(e):
+            raise
+        rows = conn.execute(query.format(indexed=''),params).fetchall()
+    return [dict(zip(PLACE_COLUMNS,row)) for row in rows]
+
+TOP_COLUMNS = ['geonameid','name','admin1','population','latitude','longitude']
+
+def largest_places(country,n=10,admin1=None,conn=None):
+    '''
+    Returns the n most populous places of a country (ISO2), or of one of its
+    admin1 areas, as a list of dictionaries. Read from the summary tables
+    built on import (see geosqlite.build_summaries), which hold at most
+    geosqlite.TOPK places each
+    '''
+    conn = conn or connection()
+    if admin1 is None:
+        rows = conn.execute(f"""select {','.join(TOP_COLUMNS)} from topplaces
+                                where country = ? order by rank limit ?;""",(country.upper(),n))
+    else:
+        rows = conn.execute(f"""select {','.join(TOP_COLUMNS)} from topadminplaces
+                                where country = ? and admin1 = ? order by rank limit ?;""",
+                            (country.upper(),admin1.upper(),n))
+    return [dict(zip(TOP_COLUMNS,row)) for row in rows]
+
+def feature_summary(country,conn=None):
+    '''
+    Returns {feature_class: {'features': .., 'population': ..}} for a country
+    '''
+    rows = (conn or connection()).execute("""select feature_class, features, population from featuresummary
+                                             where country = ?;""",(country.upper(),))
+    return {fclass:{'features':features,'population':population} for fclass,features,population in rows}
+
+def admin_summary(country,conn=None):
+    '''
+    Returns {admin1: {'features': .., 'places': .., 'population': ..}} for a
+    country, places and population counting the populated places only
+    '''
+    rows = (conn or connection()).execute("""select admin1, features, places, population from adminsummary
+                                             where country = ?;""",(country.upper(),))
+    return {admin1:{'features':features,'places':places,'population':population}
+            for admin1,features,places,population in rows}
+
+def capital(country,conn=None):
+    '''
+    Returns the geonameid, name, population and coordinates of the capital
+    of a country as a dictionary, None if it is not known
+    '''
+    columns = ['geonameid','name','population','latitude','longitude']
+    row = (conn or connection()).execute(f"""select {','.join(columns)} from capitals
+                                             where country = ?;""",(country.upper(),)).fetchone()
+    return dict(zip(columns,row)) if row else None
+
+def lookup_postcodes(keys,conn=None):
+    '''
+    Looks up a batch of (postcode, country) keys, country being an ISO2 code
+    or None for any country. Returns a dictionary of key to the list of
+    matching zipcodes rows (as dictionaries)
+    '''
+    results = {key:[] for key in keys}
+    codes = list({code for code,country in results})
+    for batch in batches(codes):
+        rows = (conn or connection()).execute(f"""select {','.join(ZIPCODE_COLUMNS)} from zipcodes
+                                                where zipcode in ({','.join('?' for i in batch)});""",batch)
+        for row in rows:
+            row = dict(zip(ZIPCODE_COLUMNS,row))
+            for key in ((row['zipcode'],None),(row['zipcode'],row['country'])):
+                if key in results:
+                    results[key].append(row)
+    return results
+
+def localized_names(ids,lang):
+    '''
+    Returns the name of every geonameid in ids in the language lang, in the
+    same order as ids. The name is picked with the fallback chain
+        preferred name -> short name -> any name -> default geonames name
+
+    None is returned for ids which are not known at all
+
+    Usage
+    -----
+    localized_names([2921044, 2635167], 'fr')   <-- ['Allemagne', 'Royaume-Uni']
+    '''
+    ids = [int(geoid) for geoid in ids]
+    unique = list(set(ids))
+    names = {}
+    conn = connection()
+
+    for batch in batches(unique):
+        params = ','.join('?' for i in batch)
+        rows = conn.execute(f"""select geonameId, name from preferrednames
+                                where isolanguage = ? and geonameId in ({params});""",
+                                [lang] + batch)
+        names.update(rows)
+
+    missing = [geoid for geoid in unique if geoid not in names]
+    for batch in batches(missing):
+        params = ','.join('?' for i in batch)
+        rows = conn.execute(f"""select geonameid, name from geonames
+                                where geonameid in ({params});""",batch)
+        names.update(rows)
+
+    return [names.get(geoid) for geoid in ids]
+
+def localized_name(geoid,lang):
+    '''
+    Returns the name of a single geonameid in the language lang.
+    See localized_names
+    '''
+    return localized_names([geoid],lang)[0]
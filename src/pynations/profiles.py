@@ -0,0 +1,134 @@
+"""
+Purpose : Import profiles, loading only the part of geonames that is used
+
+A profile lists the countries, languages, feature classes/codes and the
+minimum population to import. Rows outside of it are dropped while the
+files are streamed, before they are inserted, so the size of the database
+and the load time follow what is used rather than the full planet dump.
+
+    countries           ISO2 codes of the places and zipcodes to import
+    languages           isolanguage codes of the alternate names to import.
+                        Names without a language are kept
+    feature_classes     Feature classes of the places, e.g. ['P', 'A']
+    feature_codes       Feature codes of the places, e.g. ['PPLC', 'ADM1']
+    min_population      Places with fewer people are not imported
+    exclude_links       Drops the 'link' and 'wkdt' alternate names (default)
+
+Empty settings do not filter. Alternate names are only imported for the
+places that were imported. The names of the countries themselves are always
+kept in every language so that CountryInfo lookups keep working.
+
+Usage
+-----
+from pynations import geosqlite
+from pynations.profiles import ImportProfile
+profile = ImportProfile(countries=['US', 'DE'], languages=['en', 'de'],
+                        feature_classes=['P', 'A'], min_population=1000)
+geosqlite.setupdb(profile=profile)
+pipeline.stream_all('A', profile=ImportProfile.load('profile.json'))
+"""
+
+import json
+
+# isolanguage values of the alternate names dropped by exclude_links
+LINKS = ('link','wkdt')
+
+
+class ImportProfile:
+    '''
+    Row filters applied while importing. See the module documentation
+    '''
+    def __init__(self,countries=None,languages=None,feature_classes=None,feature_codes=None,
+                 min_population=0,exclude_links=True):
+        self.countries = sorted({code.upper() for code in countries or []})
+        self.languages = sorted(set(languages or []))
+        self.feature_classes = sorted({fclass.upper() for fclass in feature_classes or []})
+        self.feature_codes = sorted({fcode.upper() for fcode in feature_codes or []})
+        self.min_population = int(min_population or 0)
+        self.exclude_links = exclude_links
+        self.places = None
+        self.country_ids = set()
+
+    @classmethod
+    def load(cls,path):
+        '''
+        Reads a profile from a JSON file holding the settings as keys
+        '''
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def settings(self):
+        return {'countries':self.countries,'languages':self.languages,
+                'feature_classes':self.feature_classes,'feature_codes':self.feature_codes,
+                'min_population':self.min_population,'exclude_links':self.exclude_links}
+
+    def fingerprint(self):
+        '''
+        Returns a string which changes with the settings
+        '''
+        return json.dumps(self.settings(),sort_keys=True)
+
+    def restricts_places(self):
+        return bool(self.countries or self.feature_classes or self.feature_codes or self.min_population)
+
+    def wants_country(self,countrycode):
+        '''
+        False for per country files (ISO2 code) outside of the profile
+        '''
+        return not self.countries or countrycode == 'allCountries' or countrycode.upper() in self.countries
+
+    def prepare(self,conn):
+        '''
+        Reads the places imported so far, which decide the alternate names
+        kept. Call after the geonames files were imported
+        '''
+        self.country_ids = {row[0] for row in conn.execute('SELECT geonameId FROM countryinfo;')}
+        self.places = None
+        if self.restricts_places():
+            self.places = {row[0] for row in conn.execute('SELECT geonameid FROM geonames;')}
+
+    def predicate(self,recordtype):
+        '''
+        Returns a function telling if a row (text fields of a geonames file)
+        of recordtype is imported, None if every row is
+        '''
+        countries = set(self.countries)
+        if recordtype == 'geonames':
+            classes = set(self.feature_classes)
+            codes = set(self.feature_codes)
+            minimum = self.min_population
+            if not (countries or classes or codes or minimum):
+                return None
+
+            def keep(row):
+                return ((not countries or row[8] in countries) and
+                        (not classes or row[6] in classes) and
+                        (not codes or row[7] in codes) and
+                        (not minimum or int(row[14] or 0) >= minimum))
+            return keep
+
+        if recordtype == 'zipcodes':
+            return (lambda row: row[0] in countries) if countries else None
+
+        if recordtype == 'altnames':
+            languages = set(self.languages)
+            links = set(LINKS) if self.exclude_links else set()
+            places = self.places
+            country_ids = {str(geoid) for geoid in self.country_ids}
+            if places is not None:
+                places = {str(geoid) for geoid in places}
+            if not (languages or links or places is not None):
+                return None
+
+            def keep(row):
+                if row[2] in links:
+                    return False
+                if row[1] in country_ids:
+                    return True
+                return ((places is None or row[1] in places) and
+                        (not languages or row[2] == '' or row[2] in languages))
+            return keep
+        return None
+
+    def __repr__(self):
+        return f'ImportProfile({", ".join(f"{key}={value!r}" for key,value in self.settings().items())})'
@@ -0,0 +1,213 @@
+"""
+Purpose : Streaming batch resolver (pynations resolve)
+
+Reads CSV, TSV or JSON lines from a file or stdin, resolves one column in
+batches and writes every row with the resolved fields appended to stdout.
+Only a bounded number of batches is held in memory at any time, so files of
+any size can be piped through.
+
+Resolvers
+---------
+country     Country names in any language and ISO2/ISO3 codes
+postcode    Postcodes, optionally restricted by a country column
+latlon      Coordinates, resolved to the nearest place (needs numpy and scipy)
+
+Usage
+-----
+pynations resolve --type country --column country customers.csv > enriched.csv
+cat events.jsonl | pynations resolve --format jsonl --type latlon --lat lat --lon lng
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import csv
+import json
+import sys
+
+from pynations.CountryInfo import lookup_country
+from pynations.places import lookup_postcodes
+
+FIELDS = {'country':['pn_geonameid','pn_iso2','pn_iso3','pn_country','pn_continent'],
+          'postcode':['pn_place','pn_state','pn_state_code','pn_county','pn_country',
+                      'pn_latitude','pn_longitude'],
+          'latlon':['pn_geonameid','pn_country','pn_admin1','pn_admin2','pn_distance_km']}
+
+def resolve_countries(keys):
+    results = []
+    for name in keys:
+        country = lookup_country(name.strip()) if name else None
+        if country:
+            results.append([country['Geonameid'],country['ISO2'],country['ISO3'],
+                            country['Country'],country['Continent']])
+        else:
+            results.append(None)
+    return results
+
+def resolve_postcodes(keys):
+    keys = [(code.strip(),country.strip().upper() if country else None) for code,country in keys]
+    found = lookup_postcodes(keys)
+    results = []
+    for key in keys:
+        rows = found[key]
+        if rows:
+            row = rows[0]
+            results.append([row['place_name'],row['state_name'],row['state_code'],
+                            row['county_name'],row['country'],row['latitude'],row['longitude']])
+        else:
+            results.append(None)
+    return results
+
+def resolve_latlons(keys):
+    from pynations.reversegeo import reverse_geocode
+
+    valid = []
+    for idx,(lat,lon) in enumerate(keys):
+        try:
+            valid.append((idx,float(lat),float(lon)))
+        except (TypeError,ValueError):
+            pass
+
+    results = [None]*len(keys)
+    if valid:
+        found = reverse_geocode([lat for idx,lat,lon in valid],[lon for idx,lat,lon in valid])
+        for pos,(idx,lat,lon) in enumerate(valid):
+            results[idx] = [int(found['geonameid'][pos]),str(found['country'][pos]),
+                            str(found['admin1'][pos]),str(found['admin2'][pos]),
+                            round(float(found['distance'][pos]),3)]
+    return results
+
+RESOLVERS = {'country':resolve_countries,
+             'postcode':resolve_postcodes,
+             'latlon':resolve_latlons}
+
+def resolve_batch(kind,keys):
+    '''
+    Resolves a list of keys with the resolver kind. Returns one list of
+    field values (or None if not found) per key. Runs in the worker
+    processes when resolving in parallel
+    '''
+    return RESOLVERS[kind](keys)
+
+# Key of the fields of CSV/TSV rows which are longer than the header. They
+# are dropped from the output
+EXTRA = '_extra'
+
+def read_jsonl(infile):
+    '''
+    Yields the JSON objects of infile, one per line. Lines which are not JSON
+    objects are skipped with a message on stderr
+    '''
+    for lineno,line in enumerate(infile,1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            print(f'pynations resolve: skipping line {lineno}, invalid JSON: {e}',file=sys.stderr)
+            continue
+        if not isinstance(row,dict):
+            print(f'pynations resolve: skipping line {lineno}, not a JSON object',file=sys.stderr)
+            continue
+        yield row
+
+def read_rows(infile,fmt):
+    '''
+    Returns the field names (None for jsonl) and an iterator over the rows
+    as dictionaries
+    '''
+    if fmt == 'jsonl':
+        return None,read_jsonl(infile)
+    reader = csv.DictReader(infile,delimiter='\t' if fmt == 'tsv' else ',',restkey=EXTRA)
+    return reader.fieldnames,reader
+
+def batched(iterable,size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator,size))
+        if not batch:
+            return
+        yield batch
+
+def resolve_stream(infile,outfile,kind,column=None,lat=None,lon=None,country_column=None,
+                   fmt='csv',batchsize=10000,processes=None):
+    '''
+    Resolves the rows of infile and writes them with the pn_* fields of the
+    resolver appended to outfile. Returns the number of rows written.
+
+    With processes > 1 batches are resolved in a process pool, keeping at
+    most two batches per process in flight. Output order follows the input
+    '''
+    if kind not in RESOLVERS:
+        raise ValueError(f'Unknown resolver {kind}. Use one of {", ".join(RESOLVERS)}')
+    if kind == 'latlon' and not (lat and lon):
+        raise ValueError('The latlon resolver needs --lat and --lon')
+    if kind != 'latlon' and not column:
+        raise ValueError(f'The {kind} resolver needs --column')
+
+    fieldnames,rows = read_rows(infile,fmt)
+    fields = FIELDS[kind]
+
+    if fmt == 'jsonl':
+        def write(row):
+            outfile.write(json.dumps(row,ensure_ascii=False)+'\n')
+    else:
+        missing = [name for name in ([lat,lon] if kind == 'latlon' else [column]) if name not in (fieldnames or [])]
+        if missing:
+            raise ValueError(f'Column(s) {", ".join(missing)} not found in the input')
+        writer = csv.DictWriter(outfile,fieldnames=list(fieldnames)+fields,extrasaction='ignore',
+                                delimiter='\t' if fmt == 'tsv' else ',',lineterminator='\n')
+        writer.writeheader()
+        write = writer.writerow
+
+    def keys(batch):
+        if kind == 'latlon':
+            return [(row.get(lat),row.get(lon)) for row in batch]
+        if kind == 'postcode':
+            return [(str(row.get(column) or ''),row.get(country_column) if country_column else None) for row in batch]
+        return [str(row.get(column) or '') for row in batch]
+
+    def emit(batch,results):
+        for row,result in zip(batch,results):
+            row.update(zip(fields,result or ['']*len(fields)))
+            write(row)
+        return len(batch)
+
+    count = 0
+    if processes and processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            inflight = deque()
+            for batch in batched(rows,batchsize):
+                inflight.append((batch,pool.submit(resolve_batch,kind,keys(batch))))
+                if len(inflight) >= 2*processes:
+                    batch,future = inflight.popleft()
+                    count += emit(batch,future.result())
+            while inflight:
+                batch,future = inflight.popleft()
+                count += emit(batch,future.result())
+    else:
+        for batch in batched(rows,batchsize):
+            count += emit(batch,resolve_batch(kind,keys(batch)))
+
+    outfile.flush()
+    return count
+
+def guess_format(filename):
+    for ext,fmt in (('.tsv','tsv'),('.txt','tsv'),('.jsonl','jsonl'),('.ndjson','jsonl')):
+        if filename.lower().endswith(ext):
+            return fmt
+    return 'csv'
+
+def main(args):
+    fmt = args.format or ('csv' if args.input == '-' else guess_format(args.input))
+    infile = sys.stdin if args.input == '-' else open(args.input,newline='',encoding='utf-8')
+    try:
+        resolve_stream(infile,sys.stdout,args.type,args.column,args.lat,args.lon,args.country_column,
+                       fmt,args.batch_size,args.processes)
+    except ValueError as e:
+        print(f'pynations resolve: {e}',file=sys.stderr)
+        return 2
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+    return 0
@@ -0,0 +1,216 @@
+"""
+Purpose : Batch reverse geocoding of coordinates to the nearest place
+
+The places of the geonames table are put in a KD-tree on unit sphere (x,y,z)
+coordinates, so the nearest neighbour by chord length is also the nearest by
+great circle distance. The tree is pickled next to the database (or in
+TREEDIR if set) and reused until the database changes. The pickle is named
+after the filters, the database path and its size and modification time.
+
+Usage
+-----
+from pynations.reversegeo import reverse_geocode
+result = reverse_geocode([37.78, 52.52], [-122.42, 13.40])
+result['geonameid'], result['country'], result['admin1'], result['distance']
+
+Note: Requires numpy and scipy (pip install pynations[geocoding])
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import hashlib
+import os
+import pickle
+import sqlite3
+import numpy as np
+from scipy.spatial import cKDTree
+import pkg_resources
+
+from pynations.generations import generation
+
+DBFILE = Path(pkg_resources.resource_filename('pynations','data/pynations.sqlite'))
+TREEDIR = None      # Directory of the persisted trees. The directory of the database if None
+
+EARTH_RADIUS = 6371.0088    # Mean earth radius in km
+FETCHSIZE = 100000
+
+def to_xyz(lats,lons):
+    '''
+    Converts latitudes and longitudes in degrees to unit sphere coordinates
+    '''
+    lats = np.radians(np.asarray(lats,dtype=np.float64))
+    lons = np.radians(np.asarray(lons,dtype=np.float64))
+    coslat = np.cos(lats)
+    return np.column_stack((coslat*np.cos(lons),coslat*np.sin(lons),np.sin(lats)))
+
+
+class ReverseGeocoder:
+    '''
+    Nearest place lookup over the geonames table.
+
+    feature_classes limits the places to the given geonames feature classes
+    ('P' populated places, 'A' administrative areas, ...) and min_population
+    drops smaller places. Use ReverseGeocoder.load() to get a persisted tree
+    '''
+    def __init__(self,feature_classes=('P',),min_population=0,dbfile=DBFILE):
+        self.feature_classes = tuple(sorted(feature_classes)) if feature_classes else ()
+        self.min_population = min_population
+
+        query = 'select geonameid, latitude, longitude, country, admin1, admin2 from geonames where 1=1'
+        params = []
+        if self.feature_classes:
+            query += f" and feature_class in ({','.join('?' for i in self.feature_classes)})"
+            params += list(self.feature_classes)
+        if min_population:
+            query += ' and population >= ?'
+            params.append(min_population)
+
+        geonameids,lats,lons,countries,admin1s,admin2s = [],[],[],[],[],[]
+        conn = sqlite3.connect(f'file:{dbfile}?mode=ro',uri=True)
+        cursor = conn.execute(query+' order by geonameid;',params)
+        while True:
+            rows = cursor.fetchmany(FETCHSIZE)
+            if not rows:
+                break
+            for geonameid,lat,lon,country,admin1,admin2 in rows:
+                geonameids.append(geonameid)
+                lats.append(lat)
+                lons.append(lon)
+                countries.append(country or '')
+                admin1s.append(admin1 or '')
+                admin2s.append(admin2 or '')
+        conn.close()
+
+        if not geonameids:
+            raise ValueError('No places match the given filters')
+
+        self.geonameid = np.array(geonameids,dtype=np.int64)
+        self.country = np.array(countries,dtype=str)
+        self.admin1 = np.array(admin1s,dtype=str)
+        self.admin2 = np.array(admin2s,dtype=str)
+        self.tree = cKDTree(to_xyz(lats,lons))
+        self.dbfile = str(Path(dbfile).resolve())
+        self.dbstamp = dbstamp(dbfile)
+
+    @staticmethod
+    def treefile(feature_classes=('P',),min_population=0,dbfile=DBFILE,stamp=None):
+        '''
+        Returns the path of the persisted tree for the given filters, built
+        from dbfile when it had the dbstamp stamp (the current one if None)
+        '''
+        dbfile = Path(dbfile).resolve()
+        key = f"{','.join(sorted(feature_classes or ()))}|{min_population}|{dbfile}"
+        stamp = dbstamp(dbfile) if stamp is None else stamp
+        return Path(TREEDIR or dbfile.parent).joinpath(f'reversegeo_{hashlib.md5(key.encode()).hexdigest()[:12]}_'
+                                f'{hashlib.md5(repr(tuple(stamp)).encode()).hexdigest()[:8]}.pickle')
+
+    @classmethod
+    def load(cls,feature_classes=('P',),min_population=0,dbfile=DBFILE):
+        '''
+        Loads the persisted tree for the given filters and database. The tree
+        is built and saved if it does not exist yet or if the database
+        changed since
+        '''
+        path = cls.treefile(feature_classes,min_population,dbfile)
+        if path.exists():
+            with open(str(path),'rb') as f:
+                geocoder = pickle.load(f)
+            if geocoder.dbstamp == dbstamp(dbfile):
+                return geocoder
+
+        geocoder = cls(feature_classes,min_population,dbfile)
+        geocoder.save(path)
+        return geocoder
+
+    def save(self,path=None):
+        '''
+        Pickles the geocoder to path (its treefile by default). The file is
+        written under a temporary name first so readers never see a partial
+        file. Trees of earlier versions of the same database are removed
+        '''
+        path = Path(path or self.treefile(self.feature_classes,self.min_population,self.dbfile,self.dbstamp))
+        temp = Path(str(path)+'.tmp')
+        with open(str(temp),'wb') as f:
+            pickle.dump(self,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(str(temp),str(path))
+        prefix = path.name.rsplit('_',1)[0]
+        for stale in path.parent.glob(f'{prefix}_*.pickle'):
+            if stale != path:
+                os.remove(str(stale))
+
+    def query(self,lats,lons):
+        '''
+        Returns the index of the nearest place and its distance in km for
+        every coordinate
+        '''
+        chord,idx = self.tree.query(to_xyz(lats,lons),k=1)
+        distance = 2*np.arcsin(np.minimum(chord/2,1.0))*EARTH_RADIUS
+        return idx,distance
+
+    def reverse_geocode(self,lats,lons,workers=None,chunksize=1000000):
+        '''
+        Returns the nearest place of every (lat, lon) pair as a dictionary of
+        numpy arrays: geonameid, country, admin1, admin2 and distance (km).
+
+        With workers > 1 the coordinates are split in chunks of chunksize
+        and queried in a process pool. Each worker loads the persisted tree
+        of this geocoder once, which is saved first if needed
+        '''
+        lats = np.asarray(lats,dtype=np.float64)
+        lons = np.asarray(lons,dtype=np.float64)
+        if lats.shape != lons.shape:
+            raise ValueError('lats and lons must be of the same length')
+
+        if workers and workers > 1 and len(lats) > chunksize:
+            path = self.treefile(self.feature_classes,self.min_population,self.dbfile,self.dbstamp)
+            if not path.exists():
+                self.save(path)
+            chunks = range(0,len(lats),chunksize)
+            with ProcessPoolExecutor(max_workers=workers,initializer=_init_worker,initargs=(str(path),)) as pool:
+                results = list(pool.map(_query_chunk,
+                                        (lats[i:i+chunksize] for i in chunks),
+                                        (lons[i:i+chunksize] for i in chunks)))
+            idx = np.concatenate([r[0] for r in results])
+            distance = np.concatenate([r[1] for r in results])
+        else:
+            idx,distance = self.query(lats,lons)
+
+        return {'geonameid':self.geonameid[idx],
+                'country':self.country[idx],
+                'admin1':self.admin1[idx],
+                'admin2':self.admin2[idx],
+                'distance':distance}
+
+def dbstamp(dbfile):
+    '''
+    Size and modification time of the database. Used to detect a stale tree
+    '''
+    stat = os.stat(str(dbfile))
+    return (stat.st_size,stat.st_mtime_ns)
+
+_worker_geocoder = None
+
+def _init_worker(path):
+    global _worker_geocoder
+    with open(path,'rb') as f:
+        _worker_geocoder = pickle.load(f)
+
+def _query_chunk(lats,lons):
+    return _worker_geocoder.query(lats,lons)
+
+# (filters, database, generation): geocoder
+_geocoders = {}
+
+def reverse_geocode(lats,lons,feature_classes=('P',),min_population=0,workers=None):
+    '''
+    Returns the nearest place for arrays of latitudes and longitudes.
+    See ReverseGeocoder.reverse_geocode. The geocoder for each set of filters
+    is loaded once per process, and again once a new generation of the
+    database was promoted (see pynations.generations)
+    '''
+    key = (tuple(sorted(feature_classes or ())),min_population,DBFILE,generation(DBFILE))
+    if key not in _geocoders:
+        for old in [old for old in _geocoders if old[:3] == key[:3]]:
+            del _geocoders[old]
+        _geocoders[key] = ReverseGeocoder.load(feature_classes,min_population,DBFILE)
+    return _geocoders[key].reverse_geocode(lats,lons,workers=workers)
@@ -0,0 +1,253 @@
+"""
+Purpose : Local HTTP lookup service (pynations serve)
+
+Endpoints
+---------
+GET  /country/<name>                    Country information for any valid name
+GET  /places?name=..&country=..&admin1=..&feature_class=..&limit=..
+GET  /postcode/<code>?country=..        Matching zipcodes rows
+POST /batch                             {"countries": [...],
+                                         "postcodes": ["94103", ["10115", "DE"], ...],
+                                         "places": ["Springfield", ...]}
+GET  /health
+
+Responses are JSON. GET responses carry an ETag derived from the data
+generation (the database and country files) so clients can revalidate with
+If-None-Match. Responses larger than GZIP_MINSIZE are gzip compressed for
+clients that accept it.
+
+The country files are loaded once at startup and shared by all the request
+threads; every thread has its own read only SQLite connection.
+"""
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+import gzip
+import hashlib
+import json
+import os
+import threading
+import pkg_resources
+
+from pynations import instrument
+from pynations.generations import generation
+from pynations.CountryInfo import COUNTRYINFOFILE
+from pynations.CountryInfo import COUNTRYLOOKUPFILE
+from pynations.CountryInfo import load_json
+from pynations.CountryInfo import lookup_country
+from pynations.places import lookup_postcodes
+from pynations.places import find_places
+
+DBFILE = Path(pkg_resources.resource_filename('pynations','data/pynations.sqlite'))
+
+GZIP_MINSIZE = 1024
+MAX_BATCH = 10000
+MAX_LIMIT = 1000
+
+
+def data_generation(files=(DBFILE,COUNTRYINFOFILE,COUNTRYLOOKUPFILE)):
+    '''
+    Returns a short token which changes whenever any of the data files change
+    '''
+    stamp = hashlib.sha1()
+    for path in files:
+        if Path(path).exists():
+            stat = os.stat(str(path))
+            stamp.update(f'{path}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return stamp.hexdigest()[:16]
+
+
+def parse_batch(request):
+    '''
+    Returns the countries, (postcode, country) keys and places of a /batch
+    request body. Raises ValueError if any of them is not a string (or a
+    [postcode, country] pair of strings)
+    '''
+    if not isinstance(request,dict):
+        raise ValueError('the body must be a JSON object')
+    countries = request.get('countries',[])
+    places = request.get('places',[])
+    if not isinstance(request.get('postcodes',[]),list):
+        raise ValueError('postcodes must be a list')
+    postcodes = []
+    for code in request.get('postcodes',[]):
+        if isinstance(code,list) and len(code) == 2 and (code[1] is None or isinstance(code[1],str)):
+            code,country = code
+        else:
+            country = None
+        if not isinstance(code,str):
+            raise ValueError(f'postcodes must be strings or [postcode, country] pairs, not {code!r}')
+        postcodes.append((code,country.upper() if country else None))
+    for key,values in (('countries',countries),('places',places)):
+        if not isinstance(values,list) or not all(isinstance(value,str) for value in values):
+            raise ValueError(f'{key} must be a list of strings')
+    return countries,postcodes,places
+
+
+class LookupServer(ThreadingMixIn,HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    verbose = False
+
+    def __init__(self,address,dbfile=DBFILE):
+        self.dbfile = dbfile
+        self.local = threading.local()
+        # Warm the shared country index before accepting requests
+        load_json(COUNTRYLOOKUPFILE)
+        load_json(COUNTRYINFOFILE)
+        self.generation = data_generation((dbfile,COUNTRYINFOFILE,COUNTRYLOOKUPFILE))
+        super().__init__(address,LookupHandler)
+
+    def connection(self):
+        '''
+        Returns the read only connection of the calling request thread,
+        reopened once a new generation of the database was promoted
+        '''
+        conn = getattr(self.local,'conn',None)
+        current = generation(self.dbfile)
+        if conn is None or current != self.local.generation:
+            if conn is not None:
+                conn.close()
+            conn = instrument.connect(f'file:{self.dbfile}?mode=ro',uri=True)
+            self.local.conn = conn
+            self.local.generation = current
+            self.generation = data_generation((self.dbfile,COUNTRYINFOFILE,COUNTRYLOOKUPFILE))
+        return conn
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'pynations'
+    # Headers and body go out in separate writes. Without this keep-alive
+    # clients wait on delayed ACKs for every response
+    disable_nagle_algorithm = True
+
+    def log_message(self,format,*args):
+        if self.server.verbose:
+            super().log_message(format,*args)
+
+    def send_json(self,status,body,etag=None):
+        data = json.dumps(body).encode('utf-8')
+        headers = {'Content-Type':'application/json'}
+        if etag:
+            headers['ETag'] = etag
+            headers['Cache-Control'] = 'no-cache'
+        if len(data) >= GZIP_MINSIZE and 'gzip' in self.headers.get('Accept-Encoding',''):
+            data = gzip.compress(data,compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+
+        self.send_response(status)
+        for key,value in headers.items():
+            self.send_header(key,value)
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def send_error_json(self,status,message):
+        self.send_json(status,{'error':message})
+
+    def etag(self):
+        key = f'{self.server.generation}:{self.path}'
+        return '"'+hashlib.sha1(key.encode()).hexdigest()[:20]+'"'
+
+    def do_GET(self):
+        try:
+            self.handle_get()
+        except Exception as e:
+            self.send_internal_error(e)
+
+    def send_internal_error(self,error):
+        '''
+        Answers requests which failed unexpectedly (e.g. sqlite3 errors)
+        with a JSON 500 error rather than dropping the connection
+        '''
+        self.log_error('%s failed: %r',self.path,error)
+        self.send_json(500,{'error':f'Internal error: {type(error).__name__}'})
+
+    def handle_get(self):
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        query = {key:values[-1] for key,values in parse_qs(url.query).items()}
+
+        # Checking the connection out first moves the ETag to a newly
+        # promoted database generation
+        self.server.connection()
+        etag = self.etag()
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match','').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag',etag)
+            self.send_header('Content-Length','0')
+            self.end_headers()
+            return
+
+        try:
+            if parts == ['health']:
+                body = {'status':'ok','generation':self.server.generation}
+            elif parts[0] == 'country' and len(parts) == 2:
+                body = lookup_country(parts[1])
+                if body is None:
+                    return self.send_error_json(404,f'Country {parts[1]} not found')
+            elif parts == ['places'] and query.get('name'):
+                limit = min(int(query.get('limit',10)),MAX_LIMIT)
+                body = find_places(query['name'],query.get('country'),query.get('admin1'),
+                                   query.get('feature_class'),limit,self.server.connection())
+            elif parts[0] == 'postcode' and len(parts) == 2:
+                key = (parts[1],query['country'].upper() if query.get('country') else None)
+                body = lookup_postcodes([key],self.server.connection())[key]
+            else:
+                return self.send_error_json(404,'Not found')
+        except ValueError as e:
+            return self.send_error_json(400,str(e))
+        self.send_json(200,body,etag)
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        try:
+            self.handle_post()
+        except Exception as e:
+            self.send_internal_error(e)
+
+    def handle_post(self):
+        if urlsplit(self.path).path.rstrip('/') != '/batch':
+            return self.send_error_json(404,'Not found')
+        try:
+            length = int(self.headers.get('Content-Length',0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            countries,postcodes,places = parse_batch(request)
+        except (ValueError,TypeError,AttributeError) as e:
+            return self.send_error_json(400,f'Invalid batch request: {e}')
+
+        if len(countries)+len(postcodes)+len(places) > MAX_BATCH:
+            return self.send_error_json(413,f'At most {MAX_BATCH} keys per batch')
+
+        conn = self.server.connection()
+        found = lookup_postcodes(postcodes,conn) if postcodes else {}
+        self.send_json(200,{'countries':[lookup_country(name) for name in countries],
+                            'postcodes':[found[key] for key in postcodes],
+                            'places':[find_places(name,conn=conn) for name in places]})
+
+
+def serve(host='127.0.0.1',port=8080,verbose=False,dbfile=DBFILE):
+    '''
+    Starts the lookup server and serves until interrupted
+    '''
+    if not Path(dbfile).exists():
+        raise FileNotFoundError(f'{dbfile} not found. Please run geosqlite.setupdb() first')
+
+    server = LookupServer((host,port),dbfile)
+    server.verbose = verbose
+    print(f'Serving pynations data generation {server.generation} on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,193 @@
+"""
+Purpose : Convert UTC timestamps to local time for places and timezones
+
+The offsets come from the numeric timezones table built by geosqlite.
+The table holds the offsets of January and July but not the dates on which
+they change, so daylight saving transitions are taken from the system
+timezone database (zoneinfo). Zones it does not know are converted with the
+table only if their offset is the same all year; the others give NaN.
+
+Usage
+-----
+from pynations.timezones import utc_offsets, local_times
+utc_offsets([5391959, 'Europe/Berlin'], [1593561600, 1593561600])
+    <-- array([-7.,  2.])
+local_times([5391959], [1593561600])
+    <-- array([1593536400])
+
+Note: Requires numpy (pip install pynations[numpy])
+"""
+
+from datetime import datetime
+import warnings
+import numpy as np
+
+from pynations.places import batches
+from pynations.places import connection
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:     # Python < 3.9
+    try:
+        from backports.zoneinfo import ZoneInfo
+    except ImportError:
+        ZoneInfo = None
+
+# Offsets are sampled at this interval when searching for DST transitions
+SAMPLE = 7*24*3600
+
+def timezone_offsets(zones):
+    '''
+    Returns a dictionary of timezone id to its (GMT_offset, DST_offset,
+    RAW_offset) tuple in hours for the given timezone ids
+    '''
+    offsets = {}
+    zones = list(set(zones))
+    for batch in batches(zones):
+        params = ','.join('?' for i in batch)
+        rows = connection().execute(f"""select timezoneid, GMT_offset, DST_offset, RAW_offset
+                                        from timezones where timezoneid in ({params});""",batch)
+        offsets.update((row[0],row[1:]) for row in rows)
+    return offsets
+
+def resolve_timezones(keys):
+    '''
+    Returns the timezone id of every key in keys. A key is either a
+    geonameid or a timezone id. None is returned for unknown geonameids
+    '''
+    geoids = list({int(key) for key in keys if not isinstance(key,str)})
+    zones = {}
+    for batch in batches(geoids):
+        params = ','.join('?' for i in batch)
+        rows = connection().execute(f"""select geonameid, timezone from geonames
+                                        where geonameid in ({params});""",batch)
+        zones.update((geoid,zone or None) for geoid,zone in rows)
+    return [key if isinstance(key,str) else zones.get(int(key)) for key in keys]
+
+def zone_transitions(zone,start,end):
+    '''
+    Returns the UTC instants (unix seconds) from which the utc offset of zone
+    changes between start and end, along with the offset in hours in effect
+    from each instant on. The first instant is always start.
+
+    zoneinfo has no bulk access to the transitions, so the offset is
+    sampled every SAMPLE seconds and every change is bisected down to the
+    second. This costs a few hundred calls per zone and year, independent of
+    the number of timestamps converted.
+
+    Returns None if the zone is not in the system timezone database
+    '''
+    if ZoneInfo is None:
+        return None
+    try:
+        tz = ZoneInfo(zone)
+    except Exception:
+        return None
+
+    def offset(ts):
+        return datetime.fromtimestamp(ts,tz).utcoffset().total_seconds()/3600
+
+    instants = [start]
+    offsets = [offset(start)]
+    previous = start
+    for sample in range(start+SAMPLE,end+SAMPLE,SAMPLE):
+        current = offset(sample)
+        if current != offsets[-1]:
+            # Bisect down to the second at which the offset changed
+            low,high = previous,sample
+            while high - low > 1:
+                middle = (low+high)//2
+                if offset(middle) == offsets[-1]:
+                    low = middle
+                else:
+                    high = middle
+            instants.append(high)
+            offsets.append(current)
+        previous = sample
+
+    return np.array(instants,dtype=np.int64),np.array(offsets,dtype=np.float64)
+
+def utc_offsets(keys,timestamps):
+    '''
+    Returns the utc offset in hours at every (key, timestamp) pair as a numpy
+    array. keys are geonameids or timezone ids and timestamps are UTC unix
+    seconds.
+
+    The transitions of all the timezones involved are put in one table
+    sorted by (timezone, instant), and every pair is looked up in it with a
+    single searchsorted, so arrays with millions of pairs over a few hundred
+    timezones are fine. Zones missing from the system timezone database use
+    the offset of the timezones table if it is the same in January and July.
+
+    NaN is returned for keys without a known timezone, and with a warning
+    for zones observing daylight saving time which are missing from the
+    system timezone database
+    '''
+    keys = list(keys)
+    timestamps = np.asarray(timestamps,dtype=np.int64)
+    if len(keys) != len(timestamps):
+        raise ValueError('keys and timestamps must be of the same length')
+    result = np.full(len(timestamps),np.nan)
+    if not keys:
+        return result
+
+    zones = resolve_timezones(keys)
+    codes = {}
+    zonecodes = np.array([codes.setdefault(zone,len(codes)) for zone in zones],dtype=np.int64)
+    table = timezone_offsets([zone for zone in codes if zone])
+
+    # Range of the timestamps of every timezone
+    lows = np.full(len(codes),np.iinfo(np.int64).max,dtype=np.int64)
+    highs = np.full(len(codes),np.iinfo(np.int64).min,dtype=np.int64)
+    np.minimum.at(lows,zonecodes,timestamps)
+    np.maximum.at(highs,zonecodes,timestamps)
+
+    tzcodes,instants,offsets = [],[],[]
+    unknown = []
+    for zone,code in codes.items():
+        if zone is None:
+            continue
+        start = int(lows[code])-SAMPLE
+        transitions = zone_transitions(zone,start,int(highs[code]))
+        if transitions is None:
+            if zone not in table:
+                continue
+            gmt,dst,raw = table[zone]
+            if gmt != dst:
+                # The offset changes during the year, but not known when
+                unknown.append(zone)
+                continue
+            transitions = (np.array([start],dtype=np.int64),np.array([gmt],dtype=np.float64))
+        tzcodes.append(np.full(len(transitions[0]),code,dtype=np.int64))
+        instants.append(transitions[0])
+        offsets.append(transitions[1])
+    if unknown:
+        warnings.warn(f"No daylight saving transitions for {', '.join(sorted(unknown))}, their offsets are NaN. "
+                      'Install tzdata (and backports.zoneinfo before Python 3.9)')
+    if not instants:
+        return result
+    tzcodes = np.concatenate(tzcodes)
+    instants = np.concatenate(instants)
+    offsets = np.concatenate(offsets)
+
+    # (timezone, instant) as one sortable key. Codes are in insertion
+    # order and instants ascending per timezone, so the keys are sorted
+    base = min(int(instants.min()),int(timestamps.min()))
+    span = max(int(instants.max()),int(timestamps.max()))-base+1
+    if span*len(codes) >= 2**62:
+        raise ValueError('timestamps out of range')
+    idx = np.searchsorted(tzcodes*span+(instants-base),zonecodes*span+(timestamps-base),side='right')-1
+    found = (idx >= 0) & (tzcodes[np.maximum(idx,0)] == zonecodes)
+    result[found] = offsets[idx[found]]
+    return result
+
+def local_times(keys,timestamps):
+    '''
+    Converts UTC unix seconds to local wall clock time (as unix seconds) for
+    every (key, timestamp) pair. See utc_offsets
+    '''
+    timestamps = np.asarray(timestamps,dtype=np.int64)
+    offsets = utc_offsets(keys,timestamps)
+    if np.isnan(offsets).any():
+        raise ValueError('Timezone not found for some of the keys')
+    return timestamps + np.rint(offsets*3600).astype(np.int64)
@@ -1,6 +1,1028 @@
+from http.server import SimpleHTTPRequestHandler
+
+import pytest
 
 from pynations.cli import main
 
 
 def test_main():
     assert main([]) == 0
+
+
+def test_zone_transitions():
+    pytest.importorskip('numpy')
+    from pynations.timezones import zone_transitions
+
+    transitions = zone_transitions('Europe/Berlin', 1577836800, 1609459200)
+    if transitions is None:
+        pytest.skip('zoneinfo is not available')
+    instants, offsets = transitions
+    # 2020-03-29 01:00 UTC and 2020-10-25 01:00 UTC
+    assert list(instants[1:]) == [1585443600, 1603587600]
+    assert list(offsets) == [1.0, 2.0, 1.0]
+
+
+
+def test_utc_offsets(tmp_path, monkeypatch):
+    np = pytest.importorskip('numpy')
+    import sqlite3
+    import threading
+
+    from pynations import places
+    from pynations import timezones
+
+    monkeypatch.setattr(places, 'DBFILE', tmp_path / 'pynations.sqlite')
+    monkeypatch.setattr(places, '_local', threading.local())
+    # Checked before the (missing) database is opened
+    with pytest.raises(ValueError):
+        timezones.utc_offsets(['Europe/Berlin', 'Europe/Berlin'], [0])
+
+    conn = sqlite3.connect(str(places.DBFILE))
+    conn.execute('create table geonames (geonameid INTEGER PRIMARY KEY, timezone TEXT);')
+    conn.execute('create table timezones (country, timezoneid, GMT_offset, DST_offset, RAW_offset);')
+    conn.executemany('insert into geonames values (?,?);', [(2950159, 'Europe/Berlin'), (1, 'Etc/Nowhere')])
+    conn.executemany('insert into timezones values (?,?,?,?,?);',
+                     [('DE', 'Europe/Berlin', 1.0, 2.0, 1.0), ('XX', 'Etc/Nowhere', 5.0, 5.0, 5.5),
+                      ('XX', 'Etc/Summertime', 1.0, 2.0, 1.0)])
+    conn.commit()
+    conn.close()
+
+    # DST starts in Berlin on 2020-03-29 at 01:00 UTC
+    before, after = 1585443599, 1585443600
+    keys = [2950159, 'Europe/Berlin', 'Europe/Berlin', 'America/Chicago', 1, 42, 'Mars/Olympus']
+    offsets = timezones.utc_offsets(keys, [before, after, before, after, after, after, after])
+    if timezones.zone_transitions('Europe/Berlin', before, after) is None:
+        pytest.skip('zoneinfo is not available')
+    assert list(offsets[:5]) == [1.0, 2.0, 1.0, -5.0, 5.0]
+    assert np.isnan(offsets[5]) and np.isnan(offsets[6])
+    # Zones unknown to zoneinfo are only converted if they have no DST
+    with pytest.warns(UserWarning, match='Etc/Summertime'):
+        assert np.isnan(timezones.utc_offsets(['Etc/Summertime'], [after])[0])
+
+    assert list(timezones.local_times([2950159, 'Europe/Berlin'], [before, after])) == [before + 3600, after + 7200]
+    with pytest.raises(ValueError):
+        timezones.local_times([42], [after])
+
+def test_resolve_countries():
+    import io
+
+    from pynations.resolve import resolve_stream
+
+    infile = io.StringIO('id,name\n1,deutschland\n2,USA\n3,nowhere\n')
+    outfile = io.StringIO()
+    assert resolve_stream(infile, outfile, 'country', 'name', batchsize=2) == 3
+    assert outfile.getvalue().splitlines() == [
+        'id,name,pn_geonameid,pn_iso2,pn_iso3,pn_country,pn_continent',
+        '1,deutschland,2921044,DE,DEU,Germany,Europe',
+        '2,USA,6252001,US,USA,United States,North America',
+        '3,nowhere,,,,,',
+    ]
+
+
+def test_resolve_malformed_rows(capsys):
+    import io
+    import json
+
+    from pynations.resolve import resolve_stream
+
+    # Fields beyond the header are dropped, short rows are padded
+    infile = io.StringIO('id,name\n1,usa,extra,fields\n2\n')
+    outfile = io.StringIO()
+    assert resolve_stream(infile, outfile, 'country', 'name') == 2
+    assert outfile.getvalue().splitlines()[1:] == ['1,usa,6252001,US,USA,United States,North America', '2,,,,,,']
+
+    infile = io.StringIO('{"name": "usa"}\n[1, 2]\n"germany"\n{broken\n{"name": "deutschland"}\n')
+    outfile = io.StringIO()
+    assert resolve_stream(infile, outfile, 'country', 'name', fmt='jsonl') == 2
+    assert [json.loads(line)['pn_iso2'] for line in outfile.getvalue().splitlines()] == ['US', 'DE']
+    assert 'skipping line 2, not a JSON object' in capsys.readouterr().err
+
+
+def test_find_places():
+    import sqlite3
+
+    from pynations.places import PLACE_COLUMNS
+    from pynations.places import find_places
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table geonames (%s);' % ','.join(PLACE_COLUMNS))
+    conn.execute('create index onplacekey on geonames(lower(asciiname),country,admin1,feature_class,'
+                  'population DESC,asciiname);')
+    rows = [(4250542, 'Springfield', 'Springfield', 39.8, -89.6, 'P', 'PPLA', 'US', 'IL', '167', 116565, ''),
+            (4409896, 'Springfield', 'Springfield', 37.2, -93.3, 'P', 'PPLA2', 'US', 'MO', '077', 166810, ''),
+            (4951788, 'Springfield', 'Springfield', 42.1, -72.6, 'P', 'PPLA2', 'US', 'MA', '013', 155929, ''),
+            (2867714, 'München', 'Muenchen', 48.1, 11.6, 'P', 'PPLA', 'DE', '02', '091', 1260391, '')]
+    conn.executemany('insert into geonames values (%s);' % ','.join('?' * len(PLACE_COLUMNS)), rows)
+
+    assert [p['admin1'] for p in find_places('SPRINGFIELD', 'us', conn=conn)] == ['MO', 'MA', 'IL']
+    assert [p['geonameid'] for p in find_places('springfield', 'US', 'il', 'p', conn=conn)] == [4250542]
+    assert len(find_places('springfield', limit=2, conn=conn)) == 2
+    assert find_places('Muenchen', conn=conn)[0]['name'] == 'München'
+    assert find_places('springfield', 'DE', conn=conn) == []
+
+
+
+@pytest.fixture
+def geodb(tmp_path):
+    pytest.importorskip('tqdm')
+    from pynations import geosqlite
+
+    previous = geosqlite.DBFILE
+    geosqlite.use_database(tmp_path / 'pynations.sqlite')
+    geosqlite.connect()
+    yield geosqlite
+    geosqlite.use_database(previous)
+
+
+def geonames_row(geonameid, name, fclass, fcode, country, admin1, population, lat=1.0, lon=2.0):
+    return [geonameid, name, name, '', lat, lon, fclass, fcode, country, '', admin1, '', '', '',
+            population, None, None, '', '2020-01-01']
+
+
+def test_find_places_plan(geodb):
+    from pynations.places import find_places
+
+    statements = []
+    geodb.conn.set_trace_callback(statements.append)
+    find_places('springfield', 'US', feature_class='P', conn=geodb.conn)
+    find_places('springfield', conn=geodb.conn)
+    geodb.conn.set_trace_callback(None)
+
+    for statement in statements:
+        plan = ' '.join(row[3] for row in geodb.conn.execute('explain query plan ' + statement))
+        assert 'USING COVERING INDEX onplacekey' in plan and 'oncountry' not in plan
+
+
+def test_summaries(geodb, monkeypatch):
+    import threading
+
+    from pynations import places
+    from pynations.CountryInfo import CountryInfo
+
+    rows = [geonames_row(1, 'Berlin', 'P', 'PPLC', 'DE', '16', 3400000, 52.5, 13.4),
+            geonames_row(2, 'Hamburg', 'P', 'PPLA', 'DE', '04', 1700000),
+            geonames_row(3, 'Munich', 'P', 'PPLA', 'DE', '02', 1200000),
+            geonames_row(4, 'Rhine', 'H', 'STM', 'DE', '', 0),
+            geonames_row(5, 'New York City', 'P', 'PPL', 'US', 'NY', 8000000),
+            geonames_row(6, 'Washington', 'P', 'PPL', 'US', 'DC', 600000, 38.9, -77.0)]
+    countries = [['DE', 'DEU', 276, 'GM', 'Germany', 'Berlin'] + [''] * 10 + [2921044, '', ''],
+                 ['US', 'USA', 840, 'US', 'United States', 'Washington'] + [''] * 10 + [6252001, '', '']]
+    with geodb.conn:
+        geodb.conn.executemany('insert into geonames values (%s);' % ','.join('?' * 19), rows)
+        geodb.conn.executemany('insert into countryinfo values (%s);' % ','.join('?' * 19), countries)
+    geodb.build_summaries()
+
+    conn = geodb.conn
+    assert places.feature_summary('de', conn) == {'P': {'features': 3, 'population': 6300000},
+                                                  'H': {'features': 1, 'population': 0}}
+    assert places.admin_summary('DE', conn)['16'] == {'features': 1, 'places': 1, 'population': 3400000}
+    assert [p['name'] for p in places.largest_places('DE', 2, conn=conn)] == ['Berlin', 'Hamburg']
+    assert [p['name'] for p in places.largest_places('US', admin1='ny', conn=conn)] == ['New York City']
+    # PPLC first, otherwise the place named as capital in countryinfo
+    assert places.capital('DE', conn)['geonameid'] == 1
+    assert places.capital('US', conn) == {'geonameid': 6, 'name': 'Washington', 'population': 600000,
+                                          'latitude': 38.9, 'longitude': -77.0}
+
+    # Only the countries given are rebuilt
+    with geodb.conn:
+        geodb.conn.execute('update geonames set population = population * 2;')
+    geodb.build_summaries(['US'])
+    assert places.feature_summary('US', conn)['P']['population'] == 17200000
+    assert places.feature_summary('DE', conn)['P']['population'] == 6300000
+
+    monkeypatch.setattr(places, 'DBFILE', geodb.DBFILE)
+    monkeypatch.setattr(places, '_local', threading.local())
+    germany = CountryInfo('germany')
+    assert germany.capital_place()['name'] == 'Berlin'
+    assert [p['name'] for p in germany.largest_cities(1)] == ['Berlin']
+    assert germany.feature_counts()['H']['features'] == 1
+    assert germany.admin_counts()['04']['places'] == 1
+
+
+def test_localized_names(geodb, tmp_path, monkeypatch):
+    import json
+    import threading
+
+    from pynations import CountryInfo
+    from pynations import places
+
+    rows = [geonames_row(1, 'Munich', 'P', 'PPLA', 'DE', '02', 1200000),
+            geonames_row(2, 'Cologne', 'P', 'PPLA2', 'DE', '07', 1000000),
+            geonames_row(3, 'Hamburg', 'P', 'PPLA', 'DE', '04', 1700000),
+            geonames_row(4, 'Bonn', 'P', 'PPLA3', 'DE', '07', 300000)]
+    # alternateNameId, geonameId, isolanguage, name, isPreferredName, isShortName, isColloquial, isHistoric
+    altnames = [(10, 1, 'de', 'Muenchen', '', '', '', ''),
+                (11, 1, 'de', 'Mchn', '', 1, '', ''),
+                (12, 1, 'de', 'München', 1, '', '', ''),
+                (20, 2, 'de', 'Kölle', '', '', 1, ''),
+                (21, 2, 'de', 'Coeln', '', '', '', ''),
+                (22, 2, 'de', 'Köln', '', 1, '', ''),
+                (30, 3, 'de', 'Hammaburg', '', '', '', 1),
+                (31, 3, 'de', 'Hamborg', '', '', '', ''),
+                (32, 3, 'fr', 'Hambourg', '', '', '', 1),
+                (40, 4, '', 'Bonna', '', '', '', ''),
+                (41, 4, 'link', 'https://en.wikipedia.org/wiki/Bonn', '', '', '', '')]
+    with geodb.conn:
+        geodb.conn.executemany('insert into geonames values (%s);' % ','.join('?' * 19), rows)
+        geodb.conn.executemany("insert into altnames values (?,?,?,?,?,?,?,?,'','');", altnames)
+    geodb.build_preferrednames()
+    monkeypatch.setattr(places, 'DBFILE', geodb.DBFILE)
+    monkeypatch.setattr(places, '_local', threading.local())
+
+    # preferred -> short -> any other name (colloquial and historic last) -> default name
+    assert places.localized_names([1, 2, 3, 4], 'de') == ['München', 'Köln', 'Hamborg', 'Bonn']
+    assert places.localized_name(3, 'fr') == 'Hambourg'
+    # Results follow the order of the ids, repeated and unknown ones included
+    assert places.localized_names(['4', 1, 999, 2, 1], 'de') == ['Bonn', 'München', None, 'Köln', 'München']
+    # Languages without names and unlabeled names give the default names
+    assert places.localized_names([1, 4], 'xx') == ['Munich', 'Bonn']
+    assert places.localized_names([4], '') == ['Bonn']
+
+    path = tmp_path / 'countryinfo.json'
+    path.write_text(json.dumps({'2921044': {'Country': 'Germany', 'ISO2': 'DE', 'LocalizedNames': {'fr': 'Allemagne'}}}))
+    monkeypatch.setattr(CountryInfo, 'COUNTRYINFOFILE', path)
+    path = tmp_path / 'countrylookup.json'
+    path.write_text(json.dumps({'germany': 2921044}))
+    monkeypatch.setattr(CountryInfo, 'COUNTRYLOOKUPFILE', path)
+    germany = CountryInfo.CountryInfo('germany')
+    assert germany.localized_name('fr') == 'Allemagne' and germany.localized_name('xx') == 'Germany'
+
+
+def test_source_skipping(geodb, tmp_path, monkeypatch):
+    import shutil
+
+    source = tmp_path / 'source'
+    source.mkdir()
+    monkeypatch.setattr(geodb, 'SOURCE', source)
+    zones = source / 'timeZones.txt'
+    zones.write_text('CountryCode\tTimeZoneId\tGMT\tDST\tRAW\nDE\tEurope/Berlin\t1.0\t2.0\t1.0\n')
+
+    digest = geodb.check_source(str(zones))
+    assert digest == (zones.stat().st_size, geodb.source_digest(str(zones))[1])
+    geodb.record_source(str(zones), digest)
+    assert geodb.check_source(str(zones)) is None
+    assert geodb.check_source(str(zones), force=True) == digest
+    geodb.conn.execute('delete from sourcefiles;')
+
+    assert geodb.load_timezones() is True
+    assert geodb.load_timezones() is False
+    assert geodb.load_timezones(force=True) is True
+    zones.write_text(zones.read_text() + 'US\tAmerica/Chicago\t-6.0\t-5.0\t-6.0\n')
+    assert geodb.load_timezones() is True
+    assert geodb.conn.execute('select count(*) from timezones;').fetchone()[0] == 2
+
+    # Forcing without any admin code files must keep the table
+    with geodb.conn:
+        geodb.conn.execute("insert into admincodes values ('DE.02', 'Bavaria', 'Bavaria', 2951839);")
+    assert geodb.load_admincodes(force=True) is False
+    assert geodb.conn.execute('select count(*) from admincodes;').fetchone()[0] == 1
+
+    if shutil.which('sqlite3') and shutil.which('bash'):
+        (source / 'admin1CodesASCII.txt').write_text('DE.02\tBavaria\tBavaria\t2951839\n'
+                                                     'DE.16\tBerlin\tBerlin\t2950157\n')
+        assert geodb.load_admincodes() is True
+        assert geodb.load_admincodes() is False
+        assert geodb.load_admincodes(force=True) is True
+        assert geodb.conn.execute('select count(*) from admincodes;').fetchone()[0] == 2
+
+def test_generations(tmp_path, monkeypatch):
+    import json
+    import sqlite3
+    import threading
+
+    from pynations import generations
+    from pynations import places
+    from pynations.aio import AsyncPyNations
+    from pynations.CountryInfo import load_json
+
+    dbfile = tmp_path / 'pynations.sqlite'
+    with sqlite3.connect(str(dbfile)) as conn:
+        conn.execute('create table countryinfo (iso2 TEXT);')
+        conn.execute("insert into countryinfo values ('DE');")
+    conn.close()
+
+    pn = AsyncPyNations(max_workers=1, dbfile=dbfile)
+    reader = pn.connection()
+    assert pn.connection() is reader
+    monkeypatch.setattr(places, 'DBFILE', dbfile)
+    monkeypatch.setattr(places, '_local', threading.local())
+    shared = places.connection()
+
+    for iso2 in ['US', 'GB']:
+        path = generations.new_generation(dbfile)
+        with sqlite3.connect(str(path)) as conn:
+            conn.execute('insert into countryinfo values (?);', [iso2])
+        conn.close()
+        generations.promote(path, dbfile, keep=1)
+
+    # The open connection still reads the generation it started with
+    assert reader.execute('select count(*) from countryinfo;').fetchone()[0] == 1
+    assert pn.connection().execute('select count(*) from countryinfo;').fetchone()[0] == 3
+    assert len(generations.old_generations(dbfile)) == 1
+    # The connection of the previous generation is closed once replaced
+    assert places.connection() is not shared
+    with pytest.raises(sqlite3.ProgrammingError):
+        shared.execute('select 1;')
+
+    empty = generations.new_generation(dbfile, copy=False)
+    sqlite3.connect(str(empty)).execute('create table countryinfo (iso2 TEXT);')
+    with pytest.raises(generations.GenerationError):
+        generations.promote(empty, dbfile)
+
+    generations.rollback(dbfile)
+    assert pn.connection().execute('select count(*) from countryinfo;').fetchone()[0] == 2
+    assert generations.old_generations(dbfile) == []
+    pn.close()
+
+    # Country files rebuilt by a refresh are read again
+    path = tmp_path / 'countrylookup.json'
+    path.write_text(json.dumps({'de': 1}))
+    assert load_json(path) == {'de': 1}
+    path.write_text(json.dumps({'de': 1, 'germany': 1}))
+    assert load_json(path) == {'de': 1, 'germany': 1}
+
+
+def test_import_profile():
+    from pynations.profiles import ImportProfile
+
+    profile = ImportProfile(countries=['us'], languages=['de'], feature_classes=['p'], min_population=1000)
+    place = ['1', 'Springfield', 'Springfield', '', '39.8', '-89.6', 'P', 'PPLA', 'US'] + [''] * 5 + ['116565'] + [''] * 4
+    keep = profile.predicate('geonames')
+    assert keep(place)
+    assert not keep(place[:8] + ['DE'] + place[9:])
+    assert not keep(place[:6] + ['H'] + place[7:])
+    assert not keep(place[:14] + ['999'] + place[15:])
+
+    assert profile.predicate('zipcodes')(['US', '62701'] + [''] * 10)
+    assert not profile.predicate('zipcodes')(['DE', '10115'] + [''] * 10)
+
+    profile.places = {1}
+    profile.country_ids = {6252001}
+    keep = profile.predicate('altnames')
+    assert keep(['10', '1', 'de', 'Springfield'] + [''] * 6)
+    assert keep(['11', '1', '', 'Springfield'] + [''] * 6)
+    assert not keep(['12', '1', 'fr', 'Springfield'] + [''] * 6)
+    assert not keep(['13', '2', 'de', 'Elsewhere'] + [''] * 6)
+    assert keep(['14', '6252001', 'fr', 'Etats-Unis'] + [''] * 6)
+    assert not keep(['15', '6252001', 'link', 'https://en.wikipedia.org/wiki/USA'] + [''] * 6)
+
+    assert ImportProfile().predicate('geonames') is None
+    assert profile.fingerprint() != ImportProfile().fingerprint()
+
+
+def test_instrument():
+    from pynations import instrument
+    from pynations.CountryInfo import lookup_country
+
+    events = []
+    instrument.add_hook(events.append)
+    instrument.reset_metrics()
+    try:
+        with instrument.stage('test.import', file='x.txt') as stats:
+            stats['rows_inserted'] = 10
+        instrument.trace_sql(True)
+        conn = instrument.connect(':memory:')
+        conn.execute('create table t (a INTEGER);')
+        conn.executemany('insert into t values (?);', [(1,), (2,)])
+        lookup_country('usa')
+        lookup_country('nowhere')
+    finally:
+        instrument.trace_sql(False)
+        instrument.remove_hook(events.append)
+
+    assert events[0]['event'] == 'stage' and events[0]['stage'] == 'test.import'
+    assert events[0]['file'] == 'x.txt' and events[0]['rows_inserted'] == 10 and 'rows_per_s' in events[0]
+    assert [e['rowcount'] for e in events if e['event'] == 'sql'] == [-1, 2]
+    metrics = instrument.metrics()
+    assert metrics['counters'] == {'lookup_country.hit': 1, 'lookup_country.miss': 1}
+    assert metrics['histograms']['lookup_country']['count'] == 2
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    import functools
+    import threading
+    from http.server import HTTPServer
+
+    class Handler(SimpleHTTPRequestHandler):
+        failures = {'flaky.txt': 1}
+        # Answered with half of the body before the connection is dropped
+        truncated = {'broken.txt': 1, 'dead.txt': 100}
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            name = self.path.lstrip('/')
+            if self.failures.get(name):
+                self.failures[name] -= 1
+                self.send_error(503)
+                return
+            path = root / name
+            if self.truncated.get(name):
+                self.truncated[name] -= 1
+                data = path.read_bytes()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data[:len(data) // 2])
+                self.close_connection = True
+                return
+            if 'Range' in self.headers and path.exists() and \
+                    self.headers.get('If-Range') == self.date_time_string(int(path.stat().st_mtime)):
+                start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+                size = path.stat().st_size
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                data = path.read_bytes()[start:]
+                self.send_response(206)
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('Last-Modified', self.date_time_string(int(path.stat().st_mtime)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            super().do_GET()
+
+    root = tmp_path / 'remote'
+    root.mkdir()
+    server = HTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=str(root)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield root, f'http://127.0.0.1:{server.server_port}/'
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_files(http_server, tmp_path):
+    pytest.importorskip('requests')
+    pytest.importorskip('menu')
+    from pynations.geodownloader import download_files
+
+    root, url = http_server
+    (root / 'US.zip').write_bytes(b'x' * 3000000)
+    (root / 'flaky.txt').write_bytes(b'flaky')
+    local = tmp_path / 'local'
+    local.mkdir()
+
+    report = download_files([(url + 'US.zip', 'geonames_US.zip'), url + 'flaky.txt', url + 'missing.zip'],
+                            destination=local, workers=3, backoff=0.01, progress=False)
+    assert sorted(report['files']) == ['flaky.txt', 'geonames_US.zip']
+    assert [failed[0] for failed in report['failed']] == [url + 'missing.zip']
+    assert report['bytes'] == 3000005
+    assert (local / 'geonames_US.zip').read_bytes() == b'x' * 3000000
+    assert (local / 'flaky.txt').read_bytes() == b'flaky'
+    assert not (local / 'geonames_US.zip.part').exists()
+
+
+def test_download_conditional_and_resume(http_server, tmp_path):
+    pytest.importorskip('requests')
+    pytest.importorskip('menu')
+    from pynations.geodownloader import download_files
+    from pynations.geodownloader import read_metadata
+    from pynations.geodownloader import write_metadata
+
+    root, url = http_server
+    (root / 'a.txt').write_bytes(b'0123456789' * 1000)
+    (root / 'b.txt').write_bytes(b'abcdefghij' * 1000)
+    local = tmp_path / 'local'
+    local.mkdir()
+
+    report = download_files([url + 'a.txt'], destination=local, progress=False)
+    assert report['files'] == ['a.txt'] and report['bytes'] == 10000
+    assert read_metadata(local / 'a.txt')['last_modified']
+
+    # Unchanged, so the conditional request comes back 304
+    report = download_files([url + 'a.txt'], destination=local, progress=False)
+    assert report['skipped'] == ['a.txt'] and report['bytes'] == 0
+
+    # An interrupted transfer of b.txt is resumed from the .part file
+    (local / 'b.txt.part').write_bytes(b'abcdefghij' * 400)
+    write_metadata(local / 'b.txt', {'url': url + 'b.txt', 'partial': True, 'etag': None,
+                                     'last_modified': SimpleHTTPRequestHandler.date_time_string(
+                                         None, int((root / 'b.txt').stat().st_mtime))})
+    report = download_files([url + 'b.txt'], destination=local, progress=False)
+    assert report['files'] == ['b.txt'] and report['bytes'] == 6000
+    assert (local / 'b.txt').read_bytes() == b'abcdefghij' * 1000
+    assert not (local / 'b.txt.part').exists()
+
+    # Nothing left to fetch after the .part: a complete one is kept, a longer
+    # one is dropped and the file fetched again
+    for name, part, fetched in (('c.txt', b'0123456789' * 1000, 0), ('d.txt', b'0123456789' * 1001, 10000)):
+        (root / name).write_bytes(b'0123456789' * 1000)
+        (local / (name + '.part')).write_bytes(part)
+        write_metadata(local / name, {'url': url + name, 'partial': True, 'etag': None,
+                                      'last_modified': SimpleHTTPRequestHandler.date_time_string(
+                                          None, int((root / name).stat().st_mtime))})
+        report = download_files([url + name], destination=local, retries=0, progress=False)
+        assert report['files'] == [name] and report['bytes'] == fetched
+        assert (local / name).read_bytes() == b'0123456789' * 1000
+        assert not (local / (name + '.part')).exists() and not read_metadata(local / name)['partial']
+
+
+class _Unseekable(object):
+    def __init__(self, raw):
+        self.raw = raw
+
+    def write(self, data):
+        return self.raw.write(data)
+
+    def flush(self):
+        pass
+
+
+@pytest.mark.parametrize('seekable', [True, False])
+def test_stream_job(http_server, seekable):
+    pytest.importorskip('requests')
+    pytest.importorskip('menu')
+    import io
+    import zipfile
+
+    from pynations.geodownloader import make_session
+    from pynations.pipeline import StreamJob
+
+    root, url = http_server
+    lines = ['%d\tPlace %d\tPlace\t\t1.5\t2.5' % (i, i) for i in range(2500)]
+    raw = io.BytesIO()
+    # Zips written to unseekable streams use data descriptors after each member
+    with zipfile.ZipFile(raw if seekable else _Unseekable(raw), 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('readme.txt', 'readme')
+        archive.writestr('XX.txt', '\n'.join(lines) + '\n')
+    (root / 'XX.zip').write_bytes(raw.getvalue())
+
+    job = StreamJob(url + 'XX.zip', 'geonames', 'XX.txt', 'XX', make_session(1),
+                    chunksize=1024, batchsize=1000, columns=8).start()
+    rows = [row for batch in job.batches() for row in batch]
+    assert len(rows) == 2500
+    assert rows[7] == ['7', 'Place 7', 'Place', '', '1.5', '2.5', '', '']
+    assert job.bytes == len(raw.getvalue())
+
+
+def test_stream(http_server, geodb):
+    pytest.importorskip('requests')
+    pytest.importorskip('menu')
+    import io
+    import sqlite3
+    import zipfile
+
+    from pynations.pipeline import stream
+    from pynations.profiles import ImportProfile
+
+    root, url = http_server
+    sizes = {}
+    for name, member, rows in (('DE.zip', 'DE.txt', [geonames_row(1, 'Berlin', 'P', 'PPLC', 'DE', '16', 3400000),
+                                                      geonames_row(2, 'Rhine', 'H', 'STM', 'DE', '', 0)]),
+                               ('alternateNamesV2.zip', 'alternateNamesV2.txt',
+                                [[10, 1, 'fr', 'Berlin', 1, '', '', '', '', ''],
+                                 [11, 2, 'fr', 'Rhin', '', '', '', '', '', ''],
+                                 [12, 2921044, 'fr', 'Allemagne', 1, '', '', '', '', '']])):
+        raw = io.BytesIO()
+        with zipfile.ZipFile(raw, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(member, ''.join('\t'.join('' if value is None else str(value) for value in row) + '\n'
+                                             for row in rows))
+        (root / name).write_bytes(raw.getvalue())
+        sizes[name] = len(raw.getvalue())
+
+    with geodb.conn:
+        geodb.conn.execute("insert into countryinfo (iso2, name, geonameId) values ('DE', 'Germany', 2921044);")
+        geodb.conn.execute('insert into geonames values (%s);' % ','.join('?' * 19),
+                           geonames_row(99, 'Bonn', 'P', 'PPLA', 'DE', '07', 300000))
+    reader = sqlite3.connect(str(geodb.DBFILE))
+
+    # The alternate names are filtered on the places streamed in the same call
+    jobs = [(url + 'alternateNamesV2.zip', 'alternateNamesV2.zip', 'A'),
+            (url + 'DE.zip', 'geonames_DE.zip', 'G'),
+            (url + 'XX.zip', 'geonames_XX.zip', 'G')]
+    report = stream(jobs, profile=ImportProfile(feature_classes=['P']), dbfile=geodb.DBFILE)
+    assert report['rows'] == {url + 'DE.zip': 1, url + 'alternateNamesV2.zip': 2}
+    assert [failed[0] for failed in report['failed']] == [url + 'XX.zip']
+
+    # Readers keep the previous generation, new connections get the new one
+    assert reader.execute('select geonameid from geonames;').fetchall() == [(99,)]
+    reader.close()
+    conn = geodb.connect()
+    assert conn.execute('select geonameid from geonames;').fetchall() == [(1,)]
+    assert conn.execute('select alternateNameId from altnames order by 1;').fetchall() == [(10,), (12,)]
+    assert dict(conn.execute('select filename, size from sourcefiles;')) == {
+        'geonames_DE.zip': sizes['DE.zip'], 'alternateNamesV2.zip': sizes['alternateNamesV2.zip']}
+    assert conn.execute('select name from preferrednames where geonameId = 1;').fetchall() == [('Berlin',)]
+    assert conn.execute('select geonameId from countryaltnames;').fetchall() == [(2921044,)]
+
+
+def test_autocomplete(tmp_path, monkeypatch):
+    pytest.importorskip('numpy')
+    pytest.importorskip('tqdm')
+    import sqlite3
+
+    from pynations import autocomplete
+    from pynations import generations
+    from pynations.places import PLACE_COLUMNS
+
+    dbfile = tmp_path / 'pynations.sqlite'
+    conn = sqlite3.connect(str(dbfile))
+    conn.execute('create table geonames (%s);' % ','.join(PLACE_COLUMNS))
+    conn.execute('create table altnames (alternateNameId, geonameId, isolanguage, alternate_name);')
+    rows = [(1, 'Springfield', 'Springfield', 39.8, -89.6, 'P', 'PPLA', 'US', 'IL', '', 116565, ''),
+            (2, 'Springdale', 'Springdale', 36.2, -94.1, 'P', 'PPL', 'US', 'AR', '', 84161, ''),
+            (3, 'Spring Lake', 'Spring Lake', 43.1, -86.2, 'H', 'LK', 'US', 'MI', '', 0, ''),
+            (4, 'München', 'Muenchen', 48.1, 11.6, 'P', 'PPLA', 'DE', '02', '', 1260391, '')]
+    conn.executemany('insert into geonames values (%s);' % ','.join('?' * len(PLACE_COLUMNS)), rows)
+    conn.executemany('insert into altnames values (?,?,?,?);',
+                     [(1, 4, 'en', 'Munich'), (2, 4, 'fr', 'Munich'), (3, 1, 'link', 'https://springfield'),
+                      (4, 2, '', 'Sprangdale')])
+    conn.commit()
+    conn.close()
+
+    assert autocomplete.build_autocomplete(dbfile, tmp_path / 'index', languages=['en']) == 12
+    index = autocomplete.load_autocomplete(tmp_path / 'index')
+    assert [p['name'] for p in index.complete('SPRING')] == ['Springfield', 'Springdale']
+    assert [p['name'] for p in index.complete('mu')] == ['München']
+    assert index.complete('mün', 1) == [{'geonameid': 4, 'name': 'München', 'country': 'DE', 'population': 1260391}]
+    assert [p['geonameid'] for p in index.complete('', country='us')] == [1, 2]
+    assert index.complete('spring', country='DE') == []
+    assert index.complete('') == [] and index.complete('https') == []
+    assert [p['name'] for p in index.complete('spra')] == ['Sprangdale']
+
+    # Names without a language are kept with all the languages as well
+    monkeypatch.setattr(autocomplete, 'DBFILE', dbfile)
+    monkeypatch.setattr(autocomplete, 'AUTOCOMPLETEDIR', tmp_path / 'default')
+    monkeypatch.setattr(autocomplete, '_autocompleter', None)
+    assert [p['name'] for p in autocomplete.autocomplete('spra')] == ['Sprangdale']
+    assert autocomplete.autocomplete('https') == []
+
+    # A promoted generation is picked up by the cached index
+    path = generations.new_generation(dbfile)
+    with sqlite3.connect(str(path)) as conn:
+        conn.execute('create table countryinfo (iso2 TEXT);')
+        conn.execute("insert into countryinfo values ('US');")
+        conn.execute("insert into geonames values (5, 'Sprague', 'Sprague', 47.3, -117.9, 'P', 'PPL', 'US', 'WA', "
+                     "'', 446, '');")
+    conn.close()
+    generations.promote(path, dbfile)
+    assert [p['name'] for p in autocomplete.autocomplete('spra')] == ['Sprangdale', 'Sprague']
+
+
+def test_country_distances(tmp_path, monkeypatch):
+    np = pytest.importorskip('numpy')
+    import sqlite3
+
+    from pynations import CountryInfo
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table countryinfo (iso2 TEXT, geonameId INTEGER);')
+    conn.execute('create table capitals (country TEXT, latitude REAL, longitude REAL);')
+    conn.execute('create table geonames (geonameid INTEGER, latitude REAL, longitude REAL);')
+    conn.executemany('insert into countryinfo values (?,?);', [('DE', 2921044), ('US', 6252001), ('FR', 3017382)])
+    conn.executemany('insert into capitals values (?,?,?);',
+                     [('DE', 52.52437, 13.41053), ('US', 38.89511, -77.03637), ('FR', 48.85341, 2.3488)])
+    conn.execute('insert into geonames values (2921044, 51.5, 10.5);')
+
+    path = tmp_path / 'countrydistances.npz'
+    assert CountryInfo.build_distances(conn, path) == 3
+    monkeypatch.setattr(CountryInfo, 'COUNTRYDISTANCEFILE', path)
+
+    assert round(CountryInfo.distance('germany', 'fr')) == 878
+    result = CountryInfo.distances([('de', 'usa'), ('us', 'de'), ('fr', 'fr')])
+    assert result.dtype == np.float32 and list(np.round(result)) == [6711, 6711, 0]
+    assert np.isnan(CountryInfo.distance('de', 'fr', 'centroid'))
+    with pytest.raises(KeyError):
+        CountryInfo.distance('de', 'nowhere')
+
+
+def test_country_coordinates(tmp_path, monkeypatch):
+    import json
+
+    from pynations import CountryInfo
+
+    info = {'2921044': {'Country': 'Germany', 'ISO2': 'DE'},
+            '3017382': {'Country': 'France', 'ISO2': 'FR', 'CapitalCoordinates': [48.86, 2.35], 'Centroid': [46.0, 2.0]}}
+    lookup = {'germany': 2921044, 'france': 3017382}
+    for name, data in (('COUNTRYINFOFILE', info), ('COUNTRYLOOKUPFILE', lookup)):
+        path = tmp_path / f'{name.lower()}.json'
+        path.write_text(json.dumps(data))
+        monkeypatch.setattr(CountryInfo, name, path)
+
+    # Records from before the coordinates were added have no such keys
+    germany = CountryInfo.CountryInfo('germany')
+    assert germany.capital_coordinates() is None and germany.centroid() is None
+    france = CountryInfo.CountryInfo('france')
+    assert france.capital_coordinates() == [48.86, 2.35] and france.centroid() == [46.0, 2.0]
+    assert CountryInfo.CountryInfo('atlantis').capital_coordinates() is None
+
+
+def test_build_countryinfo_old_database(tmp_path, monkeypatch):
+    import json
+    import sqlite3
+
+    from pynations import CountryInfo
+
+    # A database from before the capitals and preferrednames tables
+    dbfile = tmp_path / 'pynations.sqlite'
+    conn = sqlite3.connect(str(dbfile))
+    conn.execute('create table countryinfo (iso2, iso3, iso_numeric, fips_code, name, capital, area, population, '
+                 'continent, tld, currency, currencyName, phone, zipcode_format, zipcode_regex, languages, '
+                 'geonameId, neighbours, equivalent_fipscode);')
+    conn.execute('create table languages (ISO639_3, ISO639_2, ISO639_1, language);')
+    conn.execute('create table countryaltnames (geonameId, isolanguage, alternate_name);')
+    conn.execute('create table admincodes (code, name);')
+    conn.execute('create table timezones (country, timezoneid, GMT_offset);')
+    conn.execute('create table geonames (geonameid, latitude, longitude);')
+    conn.execute("insert into countryinfo values ('DE', 'DEU', 276, 'GM', 'Germany', 'Berlin', 357021, 82927922, "
+                 "'EU', '.de', 'EUR', 'Euro', '49', '#####', '', 'de', 2921044, '', '');")
+    conn.execute("insert into languages values ('deu', 'ger', 'de', 'German');")
+    conn.execute("insert into countryaltnames values (2921044, 'fr', 'Allemagne');")
+    conn.execute('insert into geonames values (2921044, 51.5, 10.5);')
+    conn.commit()
+    conn.close()
+
+    previous = {'2921044': {'Country': 'Germany', 'ISO2': 'DE', 'CapitalCoordinates': [52.52, 13.41],
+                            'LocalizedNames': {'fr': 'Allemagne'}}}
+    for name in ('COUNTRYINFOFILE', 'COUNTRYLOOKUPFILE', 'COUNTRYDISTANCEFILE'):
+        monkeypatch.setattr(CountryInfo, name, tmp_path / getattr(CountryInfo, name).name)
+    CountryInfo.COUNTRYINFOFILE.write_text(json.dumps(previous))
+    monkeypatch.setattr(CountryInfo, 'DBFILE', dbfile)
+
+    assert CountryInfo.build_CountryInfo(force=True)
+    germany = CountryInfo.CountryInfo('allemagne')
+    assert germany.capital_coordinates() == [52.52, 13.41] and germany.centroid() == [51.5, 10.5]
+    assert germany.localized_name('fr') == 'Allemagne' and germany.languages() == ['German']
+
+
+def test_export(tmp_path, capsysbinary):
+    import csv
+    import gzip
+    import json
+    import sqlite3
+
+    from pynations.export import FIELDS
+    from pynations.export import export_places
+
+    dbfile = tmp_path / 'pynations.sqlite'
+    conn = sqlite3.connect(str(dbfile))
+    conn.execute('create table geonames (geonameid INTEGER PRIMARY KEY, name, asciiname, latitude, longitude, '
+                 'feature_class, feature_code, country, admin1, admin2, population, elevation, timezone, '
+                 'modification_date);')
+    conn.execute('create table countryinfo (iso2 TEXT PRIMARY KEY, name TEXT);')
+    conn.execute('create table admincodes (code TEXT PRIMARY KEY, name TEXT);')
+    conn.execute('create table timezones (timezoneid TEXT PRIMARY KEY, GMT_offset REAL);')
+    conn.executemany('insert into geonames values (?,?,?,?,?,?,?,?,?,?,?,?,?,?);',
+                     [(i, f'Place {i}', f'Place {i}', 1.5, 2.5, 'P' if i % 2 else 'H', 'PPL',
+                       'DE' if i < 6 else 'US', '02', '091', i * 100, None,
+                       'Europe/Berlin' if i < 6 else 'America/Chicago', '2020-01-01') for i in range(1, 11)])
+    conn.executemany('insert into countryinfo values (?,?);', [('DE', 'Germany'), ('US', 'United States')])
+    conn.executemany('insert into admincodes values (?,?);', [('DE.02', 'Bavaria'), ('DE.02.091', 'Upper Bavaria')])
+    conn.executemany('insert into timezones values (?,?);', [('Europe/Berlin', 1.0), ('America/Chicago', -6.0)])
+    conn.commit()
+    conn.close()
+
+    path = tmp_path / 'places.jsonl.gz'
+    assert export_places(path, chunksize=3, dbfile=dbfile) == 10
+    rows = [json.loads(line) for line in gzip.open(str(path), 'rt')]
+    assert [row['geonameid'] for row in rows] == list(range(1, 11))
+    assert rows[0]['country_name'] == 'Germany' and rows[0]['admin1_name'] == 'Bavaria'
+    assert rows[0]['admin2_name'] == 'Upper Bavaria' and rows[0]['gmt_offset'] == 1.0
+    assert rows[9]['admin1_name'] is None and rows[9]['gmt_offset'] == -6.0
+
+    path = tmp_path / 'places.csv'
+    assert export_places(path, countries=['us'], feature_classes=['p'], min_population=700,
+                         chunksize=1, dbfile=dbfile) == 2
+    rows = list(csv.reader(open(str(path))))
+    assert rows[0] == FIELDS and [row[0] for row in rows[1:]] == ['7', '9']
+
+    assert export_places(tmp_path / 'parts', 'tsv', partition=True, processes=2, dbfile=dbfile) == 10
+
+    # -z with stdout compresses too
+    assert export_places('-', compress=True, countries=['de'], dbfile=dbfile) == 5
+    rows = [json.loads(line) for line in gzip.decompress(capsysbinary.readouterr().out).splitlines()]
+    assert [row['geonameid'] for row in rows] == [1, 2, 3, 4, 5]
+    assert sorted(p.name for p in (tmp_path / 'parts').iterdir()) == ['DE.tsv', 'US.tsv']
+    assert len(open(str(tmp_path / 'parts' / 'US.tsv')).readlines()) == 6
+
+
+def test_columnar(tmp_path):
+    np = pytest.importorskip('numpy')
+    import sqlite3
+
+    from pynations.columnar import COLUMNS
+    from pynations.columnar import export_columnar
+    from pynations.columnar import load_columnar
+
+    dbfile = tmp_path / 'pynations.sqlite'
+    conn = sqlite3.connect(str(dbfile))
+    conn.execute('create table geonames (%s);' % ','.join(name for name, dtype in COLUMNS))
+    conn.commit()
+    destination = tmp_path / 'columnar'
+    # An empty table gives an empty snapshot
+    assert export_columnar(dbfile, destination) == 0
+    snap = load_columnar(destination)
+    assert len(snap) == 0 and len(snap.top_populous('US')) == 0
+    assert not snap.in_polygon([(0, 0), (0, 1), (1, 1)]).any()
+
+    conn.executemany('insert into geonames values (?,?,?,?,?,?,?,?,?,?,?);',
+                     [(1, 52.52, 13.40, 3400000, 34, '', 'P', 'PPLC', 'DE', '16', None),
+                      (2, 53.55, 10.00, 1700000, '', 5, 'P', 'PPLA', 'DE', '04', None),
+                      (3, -18.14, 178.44, 77000, 10, 3, 'P', 'PPLC', 'FJ', '01', None),
+                      (4, -16.80, -179.90, 500, 0, 0, 'P', 'PPL', 'FJ', '03', None),
+                      (5, 47.00, 8.00, 0, 0, 0, 'H', 'LK', 'CH', '', None)])
+    conn.commit()
+    conn.close()
+    assert export_columnar(dbfile, destination) == 5
+    assert not destination.with_name('columnar.tmp').exists()
+    snap = load_columnar(destination)
+    assert len(snap) == 5 and list(snap.geonameid) == [1, 2, 3, 4, 5]
+    assert list(snap.decode('country', snap.country)) == ['DE', 'DE', 'FJ', 'FJ', 'CH']
+    assert snap.code('country', 'XX') == -1 and snap.elevation[1] == 0
+    assert list(snap.top_populous('DE', 1)) == [1]
+    assert list(snap.top_populous(n=3)) == [1, 2, 3]
+    assert snap.population_in_bbox(50, 5, 55, 15) == 5100000
+
+    # Vertices on both sides of the antimeridian
+    fiji = [(-20, 177), (-20, -179), (-15, -179), (-15, 177)]
+    assert list(np.flatnonzero(snap.in_polygon(fiji))) == [2, 3]
+    assert snap.population_in_polygon(fiji) == 77500
+    assert not snap.in_polygon([(-20, 177), (-20, 179), (-15, 179), (-15, 177)])[3]
+    with pytest.raises(ValueError):
+        snap.in_polygon([(80, 0), (80, 120), (80, -120)])
+
+
+def test_reverse_geocode(tmp_path, monkeypatch):
+    pytest.importorskip('scipy')
+    import sqlite3
+
+    from pynations import generations
+    from pynations import reversegeo
+
+    dbfiles = []
+    for name, places in (('a', [(1, 52.52, 13.40, 'DE', '16'), (2, 48.86, 2.35, 'FR', '11')]),
+                         ('b', [(3, 40.71, -74.01, 'US', 'NY'), (4, 34.05, -118.24, 'US', 'CA')])):
+        dbfile = tmp_path / f'{name}.sqlite'
+        conn = sqlite3.connect(str(dbfile))
+        conn.execute('create table geonames (geonameid, latitude, longitude, country, admin1, admin2, '
+                     'feature_class, population);')
+        conn.executemany("insert into geonames values (?,?,?,?,?,'','P',1000);", places)
+        conn.commit()
+        conn.close()
+        dbfiles.append(dbfile)
+
+    a = reversegeo.ReverseGeocoder.load(dbfile=dbfiles[0])
+    b = reversegeo.ReverseGeocoder.load(dbfile=dbfiles[1])
+    # Trees of different databases do not overwrite each other
+    treefile = reversegeo.ReverseGeocoder.treefile
+    assert treefile(dbfile=dbfiles[0]) != treefile(dbfile=dbfiles[1])
+    assert len(list(tmp_path.glob('reversegeo_*.pickle'))) == 2
+
+    result = a.reverse_geocode([52.0, 49.0], [13.0, 2.0])
+    assert list(result['geonameid']) == [1, 2] and list(result['country']) == ['DE', 'FR']
+    assert 60 < result['distance'][0] < 70
+
+    # Workers answer from the tree of the geocoder's own database
+    built = reversegeo.ReverseGeocoder(dbfile=dbfiles[1])
+    result = built.reverse_geocode([40.0, 35.0, 41.0], [-74.0, -118.0, -73.0], workers=2, chunksize=1)
+    assert list(result['geonameid']) == [3, 4, 3]
+    assert list(b.reverse_geocode([40.0], [-74.0])['admin1']) == ['NY']
+
+    # The cached geocoder follows the promoted generations, trees are kept next to the database
+    monkeypatch.setattr(reversegeo, 'DBFILE', dbfiles[0])
+    monkeypatch.setattr(reversegeo, '_geocoders', {})
+    assert list(reversegeo.reverse_geocode([48.0], [2.0])['geonameid']) == [2]
+    path = generations.new_generation(dbfiles[0])
+    with sqlite3.connect(str(path)) as conn:
+        conn.execute('create table countryinfo (iso2 TEXT);')
+        conn.execute("insert into countryinfo values ('FR');")
+        conn.execute("insert into geonames values (5, 43.30, 5.37, 'FR', '93', '', 'P', 1000);")
+    conn.close()
+    generations.promote(path, dbfiles[0])
+    assert list(reversegeo.reverse_geocode([43.0, 48.0], [5.0, 2.0])['geonameid']) == [5, 2]
+    assert len(reversegeo._geocoders) == 1
+    assert len(list(tmp_path.glob('reversegeo_*.pickle'))) == 2
+
+
+def lookup_db(tmp_path):
+    import sqlite3
+
+    from pynations.places import PLACE_COLUMNS
+    from pynations.places import ZIPCODE_COLUMNS
+
+    dbfile = tmp_path / 'pynations.sqlite'
+    conn = sqlite3.connect(str(dbfile))
+    conn.execute('create table geonames (%s);' % ','.join(PLACE_COLUMNS))
+    conn.execute('create index onplacekey on geonames(lower(asciiname),country,admin1,feature_class,'
+                 'population DESC,asciiname);')
+    conn.execute("insert into geonames values (2950159, 'Berlin', 'Berlin', 52.5, 13.4, 'P', 'PPLC', 'DE', '16', "
+                 "'', 3426354, 'Europe/Berlin');")
+    conn.execute('create table zipcodes (%s);' % ','.join(ZIPCODE_COLUMNS))
+    conn.executemany("insert into zipcodes values (?, ?, 'Berlin', 'Berlin', 'BE', '', '', '', '', 52.5, 13.4, 4);",
+                     [('DE', '10115'), ('DE', '10117')])
+    conn.commit()
+    conn.close()
+    return dbfile
+
+
+def test_server(tmp_path):
+    import json
+    import sqlite3
+    import threading
+    import urllib.error
+    import urllib.request
+
+    from pynations.server import LookupServer
+
+    dbfile = lookup_db(tmp_path)
+
+    server = LookupServer(('127.0.0.1', 0), dbfile)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    def request(path, body=None, headers={}):
+        data = None if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode())
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url + path, data, headers)) as response:
+                return response.status, json.loads(response.read() or b'null'), response.headers
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read() or b'null'), e.headers
+
+    try:
+        status, body, headers = request('/country/germany')
+        assert status == 200 and body['ISO2'] == 'DE'
+        assert request('/country/germany', headers={'If-None-Match': headers['ETag']})[0] == 304
+        assert request('/country/nowhere')[0] == 404
+        assert request('/places?name=berlin&country=de')[1][0]['geonameid'] == 2950159
+        assert request('/postcode/10115?country=DE')[1][0]['place_name'] == 'Berlin'
+
+        status, body, headers = request('/batch', {'countries': ['usa'], 'postcodes': [['10115', 'de']],
+                                                   'places': ['Berlin']})
+        assert status == 200 and body['countries'][0]['ISO2'] == 'US'
+        assert body['postcodes'][0][0]['zipcode'] == '10115' and body['places'][0][0]['name'] == 'Berlin'
+        for bad in ({'countries': [1]}, {'places': 'Berlin'}, {'postcodes': [{'code': 1}]}, [1], b'{'):
+            status, body, headers = request('/batch', bad)
+            assert status == 400 and body['error'].startswith('Invalid batch request')
+
+        sqlite3.connect(str(dbfile)).execute('drop table zipcodes;')
+        status, body, headers = request('/postcode/10115')
+        assert status == 500 and 'error' in body
+        assert request('/health')[0] == 200
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_aio(tmp_path):
+    import asyncio
+    import sqlite3
+
+    from pynations.aio import AsyncPyNations
+
+    dbfile = lookup_db(tmp_path)
+    batches = []
+
+    async def lookups():
+        async with AsyncPyNations(max_workers=2, dbfile=dbfile) as pn:
+            lookup = pn._lookup_postcodes
+            pn._lookup_postcodes = lambda keys: batches.append(keys) or lookup(keys)
+            results = await asyncio.gather(pn.resolve_country('deutschland'), pn.resolve_country('nowhere'),
+                                           pn.lookup_postcode('10115', 'de'), pn.lookup_postcode('10117'),
+                                           pn.lookup_postcode('99999'), pn.find_places('BERLIN', 'DE'),
+                                           pn.find_places('BERLIN', 'DE'), pn.search_places('Berlin'),
+                                           pn.lookup_postcode('10115', 'DE'), pn.resolve_country('deutschland'))
+            opened = set(pn.connections)
+        return pn, opened, results
+
+    pn, opened, (germany, nowhere, first, second, missing, found, again, searched, first_again, germany_again) = \
+        asyncio.run(lookups())
+    assert germany['ISO2'] == 'DE' and nowhere is None
+    assert first[0]['zipcode'] == '10115' and second[0]['zipcode'] == '10117' and missing == []
+    # The concurrent postcodes were answered with one query
+    assert len(batches) == 1 and len(batches[0]) == 3
+    assert found[0]['geonameid'] == 2950159 and again == found and searched[0]['name'] == 'Berlin'
+    # Coalesced callers get their own copies
+    found[0]['name'] = 'changed'
+    first.clear()
+    germany['ISO2'] = 'XX'
+    assert again[0]['name'] == 'Berlin' and first_again[0]['zipcode'] == '10115' and germany_again['ISO2'] == 'DE'
+    assert opened and pn.connections == set()
+    for conn in opened:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute('select 1;')
+
+
+def test_download_broken_streams(http_server, tmp_path):
+    pytest.importorskip('requests')
+    pytest.importorskip('menu')
+    from pynations.geodownloader import download_files
+
+    root, url = http_server
+    for name in ('broken.txt', 'dead.txt', 'fine.txt'):
+        (root / name).write_bytes(b'0123456789' * 10000)
+    local = tmp_path / 'local'
+    local.mkdir()
+
+    # A stream dying partway is retried, one that keeps dying fails alone
+    report = download_files([url + 'broken.txt', url + 'dead.txt', url + 'fine.txt'], destination=local,
+                            retries=2, backoff=0.01, progress=False)
+    assert sorted(report['files']) == ['broken.txt', 'fine.txt']
+    assert [failed[0] for failed in report['failed']] == [url + 'dead.txt']
+    assert (local / 'broken.txt').read_bytes() == b'0123456789' * 10000